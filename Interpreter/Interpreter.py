@@ -1,22 +1,53 @@
-from parser import  Var, ReturnNode, IfNode, FunctionCallNode, LambdaNode
+import sys
+from parser import  ReturnNode, IfNode, FunctionCallNode, BlockNode, BinOp, Num, LocalVar
+from memo import MISSING
+from resolver import Resolver, UNSET
+from environment import Environment, Closure
+from control import Metered
+import errors
+from native import compiled, rerun
 
-"""Global variables / functions"""
-functions = {}
-variables = {}
+# Default limit on nested (non-tail) calls
+MAX_DEPTH = 10000
+# Python frames used per nested call, to size the host recursion limit
+PYTHON_FRAMES_PER_CALL = 20
 
 
-class Interpreter:
-    def __init__(self, parser):
+class TailCall:
+    """A call in tail position, returned to the caller's trampoline instead of being made."""
+
+    def __init__(self, func_def, args, position=None, captured=None):
+        self.func_def = func_def  # a FunctionDecNode, or the LambdaNode of a closure
+        self.args = args
+        self.position = position  # of the call
+        self.captured = captured  # the closure's captured values, None for a defun
+
+
+class Interpreter(Metered):
+    def __init__(self, parser, max_depth=MAX_DEPTH, memo=None, env=None, max_steps=None, control=None):
         self.parser = parser
         self.call_stack = []
+        self.max_depth = max_depth
+        self.memo = memo  # a memo.Memoizer, or None to evaluate every call
+        self.env = env if env is not None else Environment()
+        self.natives = {}  # int-only FunctionDecNode -> its Python translation, see native.py
+        self.init_budget(max_steps, control)
 
     def visit(self, node):
         method_name = f'visit_{type(node).__name__}'
         method = getattr(self, method_name, self.generic_visit)
-        return method(node)
+        try:
+            return method(node)
+        except errors.RuntimeError as error:
+            # The innermost node with a position locates the error
+            error.locate(getattr(node, 'position', None))
+            raise
+        except errors.PYTHON_ERRORS as error:
+            # An operator applied to values it does not take
+            raise errors.RuntimeError(str(error), getattr(node, 'position', None)) from None
 
     def generic_visit(self, node):
-        raise Exception(f'No visit_{type(node).__name__} method')
+        raise errors.RuntimeError(f'No visit_{type(node).__name__} method', getattr(node, 'position', None))
 
     def visit_IfNode(self, node):
         condition = self.visit(node.condition)
@@ -25,30 +56,85 @@ class Interpreter:
         elif node.else_block is not None:
             return self.visit(node.else_block)
 
-    def visit_LambdaNode(self, node):
-        if node.arg is not None:
-            local_scope = {}
-            # Map parameters to argument values in the local scope
-            for param, arg in zip(node.params, node.arg):
-                local_scope[param] = arg
-
-            # Push the local scope onto the call stack
-            self.call_stack.append(local_scope)
-
-            if isinstance(node.expr, FunctionCallNode):
-                new_args = []
-                func = local_scope[node.expr.name]
-                for arg in node.expr.args:
-                    new_args.append(arg)
-                func.arg = new_args
-                result = self.visit(func)
-            else:
-                result = self.visit(node.expr)
-
-            # Pop the local scope off the call stack
-            self.call_stack.pop()
+    def visit_tail(self, node):
+        """Evaluate a node in tail position: calls come back as TailCall instead of being made."""
+        if node is None:
+            # The expression of a bare `return`
+            return None
+        if isinstance(node, FunctionCallNode):
+            closure = self.call_stack[-1][node.slot] if node.slot is not None else None
+            func_def = self.env.functions.get(node.name) if type(closure) is not Closure else None
+            if func_def is None:
+                if type(closure) is not Closure:
+                    # A global variable holding a lambda, or a builtin, which is called right away
+                    closure = self.env.callee(node.name)
+                    if type(closure) is not Closure:
+                        return self.visit(node)
+                return TailCall(closure.function, [self.visit(arg) for arg in node.args], node.position,
+                                closure.captured)
+            # Every argument is evaluated, as the VM does; the ones without a parameter are then dropped
+            args = [self.visit(arg) for arg in node.args]
+            return TailCall(func_def, args[:len(func_def.params)], node.position)
+        if isinstance(node, BlockNode):
+            statements = node.statements
+            for statement in statements[:-1]:
+                if isinstance(statement, ReturnNode):
+                    return self.visit_tail(statement.expr)
+                self.visit(statement)
+            return self.visit_tail(statements[-1]) if statements else None
+        if isinstance(node, IfNode):
+            if self.visit(node.condition):
+                return self.visit_tail(node.block)
+            elif node.else_block is not None:
+                return self.visit_tail(node.else_block)
+            return None
+        if isinstance(node, ReturnNode):
+            return self.visit_tail(node.expr)
+        if type(node) is BinOp:
+            # && and ||, the only BinOps left: the right side is in tail position, as the VM compiles it
+            left_value = self.visit(node.left)
+            if self.fuel is not None:
+                try:
+                    self.charge(1)
+                except errors.RuntimeError as error:
+                    error.locate(node.position)
+                    raise
+            if node.op == 'AND':
+                return self.visit_tail(node.right) if left_value else left_value
+            if node.op == 'OR':
+                return left_value if left_value else self.visit_tail(node.right)
+        return self.visit(node)
+
+    def push_frame(self, local_scope, name):
+        if len(self.call_stack) >= self.max_depth:
+            raise errors.RuntimeError(f"Maximum recursion depth of {self.max_depth} exceeded in '{name}'")
+        self.call_stack.append(local_scope)
 
-            return result
+    def visit_LambdaNode(self, node):
+        # The enclosing locals the body reads are copied now, whenever the lambda is called
+        captured = tuple([self.call_stack[-1][slot] for slot in node.captures]) if node.captures else ()
+        if node.arg is None:
+            # A lambda without arguments evaluates to a function value
+            return Closure(node, captured)
+        return self.call_lambda(node, captured, [self.visit(arg) for arg in node.arg])
+
+    def call_value(self, value, args):
+        """Call a closure, or a builtin (see sequences.BUILTINS)."""
+        if type(value) is Closure:
+            return self.call_lambda(value.function, value.captured, args)
+        return value(self, args)
+
+    def call_lambda(self, node, captured, args):
+        return self.call_function(node, args, captured)
+
+    def lambda_frame(self, node, captured, args):
+        # Extra arguments are ignored, missing ones stay unset
+        frame = args[:len(node.params)]
+        if len(frame) < len(node.params):
+            frame += [UNSET] * (len(node.params) - len(frame))
+        frame += captured
+        frame += [UNSET] * (len(node.local_names) - len(frame))
+        return frame
 
     def visit_BlockNode(self, node):
         result = None
@@ -58,65 +144,102 @@ class Interpreter:
                 return result  # Return immediately if a return statement is encountered
         return result  # Return the result of the last statement in the block
 
-    def visit_Var(self, node):
-        var_name = node.name
-
-        # Check the top of the call stack (local scope)
-        if self.call_stack and var_name in self.call_stack[-1]:
-            return self.call_stack[-1][var_name]
+    def visit_LocalVar(self, node):
+        value = self.call_stack[-1][node.slot]
+        if value is UNSET:
+            # Not assigned in this call yet, so the global of the same name is visible
+            return self.env.globals.lookup(node.name)
+        return value
 
-        # If not found in the local scope, check the global scope
-        if var_name in variables:
-            return variables[var_name]
+    def visit_GlobalVar(self, node):
+        return self.env.globals.load(node.slot)
 
-        raise Exception(f"Variable '{var_name}' not found.")
+    def visit_LocalAssign(self, node):
+        self.call_stack[-1][node.slot] = self.visit(node.expr)
 
-    def visit_Assign(self, node):
-        var_name = node.variable.name
-        var_value = self.visit(node.expr)
+    def visit_GlobalAssign(self, node):
+        self.env.globals.store(node.slot, self.visit(node.expr))
 
-        # Assign to the local scope if a function is active
-        if self.call_stack:
-            self.call_stack[-1][var_name] = var_value
-        else:
-            variables[var_name] = var_value
-
-    def visit_int(self, node):
-        return node
+    def visit_Num(self, node):
+        return node.value
 
     def visit_Boolean(self, node):
         return node.value
 
     def visit_FunctionDecNode(self, node):
-        functions[node.name] = node
+        self.env.define(node.name, node)
+        self.natives.clear()
+        if self.memo is not None:
+            self.memo.invalidate(node.name)
 
     def visit_FunctionCallNode(self, node):
-        if isinstance(node, LambdaNode):
-            lambda_result = self.visit_LambdaNode(node.name)
-            return lambda_result
-        func_def = functions.get(node.name)
-        if not func_def:
-            raise Exception(f"Function '{node.name}' is not defined.")
-
-        local_vars = {}
-        for parameter, argument in zip(func_def.params, node.args):
-            local_vars[parameter.name] = self.visit(argument)  # Evaluate the argument
-
-        # Push the new local scope onto the call stack
-        self.call_stack.append(local_vars)
-
-        # Execute the function body
-        result = self.visit(func_def.block)
-
-        self.call_stack.pop()
+        if node.slot is not None:
+            value = self.call_stack[-1][node.slot]
+            if type(value) is Closure:
+                return self.call_value(value, [self.visit(arg) for arg in node.args])
+        func_def = self.env.functions.get(node.name)
+        if func_def is None:
+            # A global variable holding a lambda, or a builtin
+            return self.call_value(self.env.callee(node.name), [self.visit(arg) for arg in node.args])
+        # Every argument is evaluated, as the VM does; the ones without a parameter are then dropped
+        args = [self.visit(arg) for arg in node.args][:len(func_def.params)]
+        if func_def.int_only:
+            function = compiled(self, func_def, len(node.args), self.max_depth - len(self.call_stack))
+            if function is not None:
+                try:
+                    return function(*args)
+                except errors.RuntimeError:
+                    # Native code keeps no positions; interpreted, the call raises the error where it happens
+                    return rerun(self, self.call_function, func_def, args)
+        if self.memo is not None:
+            return self.call_memoized(func_def, args)
+        return self.call_function(func_def, args)
+
+    def call_memoized(self, func_def, args):
+        table = self.memo.table_for(func_def.name, self.env.functions)
+        # Only plain int arguments are used as keys: True == 1 would otherwise collide
+        if table is None or len(args) != len(func_def.params) or any(type(arg) is not int for arg in args):
+            return self.call_function(func_def, args)
+        key = tuple(args)
+        result = table.get(key)
+        if result is MISSING:
+            result = self.call_function(func_def, args)
+            table.put(key, result)
         return result
 
+    def call_function(self, func_def, args, captured=None):
+        """Run a defun, or a closure's LambdaNode with its `captured` values; tail calls in its body reuse this
+        frame instead of nesting."""
+        self.push_frame(None, func_def.name if captured is None else '<lambda>')
+        try:
+            while True:
+                if self.fuel is not None:
+                    self.charge(1)
+                if captured is None:
+                    # Parameters first, then the body's other locals, still unset
+                    self.call_stack[-1] = args + [UNSET] * (len(func_def.local_names) - len(args))
+                    result = self.visit_tail(func_def.block)
+                else:
+                    self.call_stack[-1] = self.lambda_frame(func_def, captured, args)
+                    result = self.visit_tail(func_def.expr)
+                if type(result) is not TailCall:
+                    return result
+                func_def, args, captured = result.func_def, result.args, result.captured
+        except errors.RuntimeError as error:
+            error.leave(func_def.name if captured is None else '<lambda>')
+            raise
+        finally:
+            self.call_stack.pop()
+
     def visit_ReturnNode(self, node):
-        return self.visit(node.expr)
+        # A bare `return` returns None
+        return self.visit(node.expr) if node.expr is not None else None
 
     def visit_UnaryOp(self, node):
-        op_type = node.op.type
+        op_type = node.op
         operand = self.visit(node.expr)
+        if self.fuel is not None:
+            self.charge(1)
 
         if op_type == 'NOT':
             return not operand
@@ -125,45 +248,71 @@ class Interpreter:
         elif op_type == 'MINUS':
             return -operand
         else:
-            raise Exception(f"Unsupported unary operator {op_type}")
+            raise errors.RuntimeError(f"Unsupported unary operator {op_type}")
+
+    def visit_Operation(self, node):
+        # Literal and local operands, as in `n - 1` or `n <= 1`, are read here instead of through visit()
+        left = node.left
+        if type(left) is Num:
+            left = left.value
+        elif type(left) is LocalVar and self.call_stack[-1][left.slot] is not UNSET:
+            left = self.call_stack[-1][left.slot]
+        else:
+            left = self.visit(left)
+        right = node.right
+        if type(right) is Num:
+            right = right.value
+        elif type(right) is LocalVar and self.call_stack[-1][right.slot] is not UNSET:
+            right = self.call_stack[-1][right.slot]
+        else:
+            right = self.visit(right)
+        if self.fuel is not None:
+            self.charge(1)
+        return node.handler(left, right)
 
     def visit_BinOp(self, node):
+        # The resolver leaves only && and || as BinOps; the right side runs when it decides the result
         left_value = self.visit(node.left)
-        right_value = self.visit(node.right)
-
-        if node.op.type == 'PLUS':
-            return left_value + right_value
-        elif node.op.type == 'MINUS':
-            return left_value - right_value
-        elif node.op.type == 'MUL':
-            return left_value * right_value
-        elif node.op.type == 'DIV':
-            if right_value == 0:
-                raise Exception("Division by zero error")
-            return left_value // right_value
-        elif node.op.type == 'EQEQ':
-            return left_value == right_value
-        elif node.op.type == 'NEQUAL':
-            return left_value != right_value
-        elif node.op.type == 'GT':
-            return left_value > right_value
-        elif node.op.type == 'LT':
-            return left_value < right_value
-        elif node.op.type == 'GTE':
-            return left_value >= right_value
-        elif node.op.type == 'LTE':
-            return left_value <= right_value
-        elif node.op.type == 'AND':
-            return left_value and right_value
-        elif node.op.type == 'OR':
-            return left_value or right_value
+        if self.fuel is not None:
+            self.charge(1)
+        if node.op == 'AND':
+            return left_value and self.visit(node.right)
+        elif node.op == 'OR':
+            return left_value or self.visit(node.right)
         else:
-            raise Exception(f"Unsupported binary operator {node.op.type}")
-
-    def interpret(self):
-        tree = self.parser.parse()
-        for node in tree.statements:
-            result = self.visit(node)
-            if result is not None:
-                print(result)
-        return
+            raise errors.RuntimeError(f"Unsupported binary operator {node.op}")
+
+    def interpret(self, tree=None):
+        """Run a parsed program (by default, whatever self.parser parses), printing each statement's result.
+
+        Returns the last statement's result, or None when it printed nothing.
+        """
+        statements = tree.statements if tree is not None else self.parser.parse_statements()
+        resolver = Resolver(self.env.globals)
+        # Nested calls are bounded by max_depth, not by the host's recursion limit
+        limit = self.max_depth * PYTHON_FRAMES_PER_CALL + 1000
+        if sys.getrecursionlimit() < limit:
+            sys.setrecursionlimit(limit)
+        result = node = None
+        try:
+            # Statements are resolved as they run, so a flattree.FlatTree is rebuilt (and a
+            # StatementStream parsed) one at a time
+            for node in statements:
+                result = self.visit(resolver.visit(node))
+                # Function values print nothing
+                if type(result) is Closure:
+                    result = None
+                if result is not None:
+                    print(result)
+        except errors.RuntimeError as error:
+            # Printing a sequence computes it, outside of any node
+            error.locate(getattr(node, 'position', None))
+            error.leave('<module>')
+            raise
+        except errors.PYTHON_ERRORS as python_error:
+            error = errors.RuntimeError(str(python_error), getattr(node, 'position', None))
+            error.leave('<module>')
+            raise error from None
+        except RecursionError:
+            raise errors.RuntimeError("Maximum nesting depth exceeded") from None
+        return result
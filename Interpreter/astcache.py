@@ -0,0 +1,117 @@
+# astcache.py
+
+"""On-disk cache of parsed programs, so warm starts skip the Lexer and Parser.
+
+Each `prog.lambda` gets `__lambdacache__/prog.lambda.ast` next to it: a digest
+of the source and the interpreter fingerprint, followed by the pickled BlockNode
+and the file id its positions use (see errors.py). An entry whose digest does
+not match is simply re-parsed and overwritten. File ids are given out per
+process: when the stored one names another file in this process, or the file
+already has an id of its own, the loaded positions are moved to the file's id.
+"""
+
+import gc
+import hashlib
+import os
+import pickle
+import sys
+
+import lexer
+import parser
+from lexer import Lexer
+from parser import Parser, AST
+import errors
+
+CACHE_DIR = '__lambdacache__'
+SUFFIX = '.ast'
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+_fingerprint = None
+
+
+def interpreter_fingerprint():
+    """Hash of the Python version and the lexer/parser/position sources; changing any invalidates every entry."""
+    global _fingerprint
+    if _fingerprint is None:
+        digest = hashlib.sha256(repr(sys.version_info[:2]).encode())
+        for module in (lexer, parser, errors):
+            with open(module.__file__, 'rb') as file:
+                digest.update(file.read())
+        _fingerprint = digest.digest()
+    return _fingerprint
+
+
+def source_digest(code):
+    return hashlib.sha256(interpreter_fingerprint() + code.encode('utf-8', 'surrogatepass')).digest()
+
+
+def cache_path(file_path):
+    directory, name = os.path.split(os.path.abspath(file_path))
+    return os.path.join(directory, CACHE_DIR, name + SUFFIX)
+
+
+def load(file_path, code):
+    """Return the cached tree for `code`, or None when there is no valid entry."""
+    # The tree is acyclic, so the cyclic GC is paused while it is rebuilt
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(cache_path(file_path), 'rb') as file:
+            if file.read(DIGEST_SIZE) != source_digest(code):
+                return None
+            tree, number = pickle.load(file)
+        if errors.claim_file_id(file_path, number):
+            return tree
+        return relocate(tree, (errors.file_id(file_path) - number) << errors.FILE_SHIFT)
+    except (OSError, EOFError, pickle.UnpicklingError, RecursionError, AttributeError, ImportError):
+        return None
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def relocate(value, shift):
+    """`value` (a node, or a list or tuple of them) with `shift` added to its positions; unchanged parts are shared."""
+    if isinstance(value, AST):
+        fields = []
+        changed = False
+        for name in value.__slots__:
+            field = getattr(value, name)
+            if name == 'position':
+                moved = field + shift if field is not None else None
+            else:
+                moved = relocate(field, shift)
+            changed = changed or moved is not field
+            fields.append(moved)
+        return type(value)(*fields) if changed else value
+    if isinstance(value, (list, tuple)):
+        items = [relocate(item, shift) for item in value]
+        if any(item is not original for item, original in zip(items, value)):
+            return type(value)(items)
+    return value
+
+
+def store(file_path, code, tree):
+    """Write the entry atomically; a read-only or unpicklable program is just left uncached."""
+    path = cache_path(file_path)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'wb') as file:
+            file.write(source_digest(code))
+            pickle.dump((tree, errors.file_id(file_path)), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except (OSError, pickle.PicklingError, RecursionError):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def parse_file(file_path, code):
+    """Parse `code` read from `file_path`, going through the cache."""
+    tree = load(file_path, code)
+    if tree is None:
+        tree = Parser(Lexer(code, file_path)).parse()
+        store(file_path, code, tree)
+    return tree
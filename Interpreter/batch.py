@@ -0,0 +1,216 @@
+# batch.py
+
+"""Run many .lambda programs over a pool of long-lived worker processes.
+
+    python3 batch.py TARGET... [--jobs N] [--timeout SECONDS] [--recycle N] [--report FILE]
+
+A TARGET is a directory (searched recursively for .lambda files), a glob
+pattern, a single .lambda file, or a manifest: a text file listing one path
+per line, relative to the manifest. Blank lines and lines starting with `#`
+are skipped in a manifest.
+
+Workers import the interpreter once and run one file after another, so each
+file costs its own run time and no process start-up. A file that runs past
+--timeout has its worker killed and replaced. With --recycle, a worker is also
+replaced after that many files.
+
+One JSON object per file is written to the report (stdout by default) as soon
+as the file finishes:
+
+    {"file", "status": "ok" | "error" | "timeout" | "crashed", "exit_code",
+     "seconds", "output", "error"}
+
+The exit code is the one `main.py FILE` would give: 0 or 1. A timeout gives
+124. A crashed worker gives that worker's exit code.
+"""
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from multiprocessing.connection import wait
+
+from Interpreter import Interpreter
+from vm import VirtualMachine
+from main import add_engine_arguments, run_code_from_file
+from check import collect_files
+import memo
+from optimizer import Optimizer
+
+TIMEOUT_EXIT_CODE = 124
+
+
+def run_file(file_path, options):
+    """Run one program the way `main.py FILE` does and describe the outcome as a report record."""
+    engine = VirtualMachine if options.vm else Interpreter
+    if options.max_steps is not None:
+        engine = functools.partial(engine, max_steps=options.max_steps)
+    memoizer = memo.Memoizer(options.memo_size) if options.memo else None
+    optimizer = Optimizer() if options.optimize else None
+    output = io.StringIO()
+    error = None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            run_code_from_file(file_path, engine, options.max_depth, not options.no_cache, memoizer, optimizer,
+                               options.flat)
+    except Exception as exc:
+        error = str(exc)
+    return {
+        'file': file_path,
+        'status': 'ok' if error is None else 'error',
+        'exit_code': 0 if error is None else 1,
+        'seconds': round(time.perf_counter() - start, 6),
+        'output': output.getvalue(),
+        'error': error,
+    }
+
+
+def worker_main(conn, options):
+    """Run the files sent over `conn` until told to stop (None) or the parent goes away."""
+    while True:
+        try:
+            file_path = conn.recv()
+        except EOFError:
+            return
+        if file_path is None:
+            return
+        conn.send(run_file(file_path, options))
+
+
+class Worker:
+    def __init__(self, context, options):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn, options), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0         # files sent to this process so far
+        self.file_path = None  # file being run, None when idle
+        self.started = None
+
+    def submit(self, file_path):
+        self.conn.send(file_path)
+        self.jobs += 1
+        self.file_path = file_path
+        self.started = time.monotonic()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def run_batch(files, options, jobs=None, timeout=None, recycle=None, report=sys.stdout):
+    """Run `files` over `jobs` workers, writing a JSON line per file to `report`; returns the records."""
+    context = multiprocessing.get_context()
+    pending = list(reversed(files))
+    workers = [Worker(context, options) for _ in range(min(jobs or os.cpu_count() or 1, len(files)))]
+    records = []
+
+    def finish(record):
+        records.append(record)
+        report.write(json.dumps(record) + '\n')
+        report.flush()
+
+    try:
+        for worker in workers:
+            worker.submit(pending.pop())
+        while any(worker.file_path is not None for worker in workers):
+            busy = [worker for worker in workers if worker.file_path is not None]
+            wait_for = None
+            if timeout is not None:
+                now = time.monotonic()
+                wait_for = max(0, min(worker.started + timeout - now for worker in busy))
+            ready = wait([worker.conn for worker in busy], wait_for)
+
+            for index, worker in enumerate(workers):
+                if worker.file_path is None:
+                    continue
+                replace = False
+                if worker.conn in ready:
+                    try:
+                        finish(worker.conn.recv())
+                    except EOFError:
+                        worker.process.join()
+                        finish({'file': worker.file_path, 'status': 'crashed',
+                                'exit_code': worker.process.exitcode,
+                                'seconds': round(time.monotonic() - worker.started, 6),
+                                'output': '', 'error': 'worker exited unexpectedly'})
+                        replace = True
+                elif timeout is not None and time.monotonic() - worker.started >= timeout:
+                    worker.kill()
+                    finish({'file': worker.file_path, 'status': 'timeout', 'exit_code': TIMEOUT_EXIT_CODE,
+                            'seconds': round(time.monotonic() - worker.started, 6),
+                            'output': '', 'error': f'timed out after {timeout} seconds'})
+                    replace = True
+                else:
+                    continue
+
+                worker.file_path = None
+                if recycle is not None and worker.jobs >= recycle and not replace:
+                    worker.stop()
+                    replace = True
+                if not pending:
+                    continue
+                if replace:
+                    worker = workers[index] = Worker(context, options)
+                worker.submit(pending.pop())
+    finally:
+        for worker in workers:
+            worker.stop()
+    return records
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Run many .lambda programs over a pool of worker processes.')
+    arg_parser.add_argument('targets', nargs='+', metavar='TARGET',
+                            help='directory, glob pattern, .lambda file, or manifest listing one path per line')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='number of worker processes, default one per CPU')
+    arg_parser.add_argument('--timeout', type=float, default=None, metavar='SECONDS',
+                            help='kill a program (and its worker) running longer than this')
+    arg_parser.add_argument('--recycle', type=int, default=None, metavar='N',
+                            help='replace each worker after it has run N files')
+    arg_parser.add_argument('--report', default=None, metavar='FILE',
+                            help='write the JSON-lines report here instead of stdout')
+    add_engine_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    try:
+        files = collect_files(args.targets)
+    except OSError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        sys.exit(1)
+
+    start = time.perf_counter()
+    if args.report:
+        with open(args.report, 'w') as report:
+            records = run_batch(files, args, args.jobs, args.timeout, args.recycle, report)
+    else:
+        records = run_batch(files, args, args.jobs, args.timeout, args.recycle)
+
+    counts = {}
+    for record in records:
+        counts[record['status']] = counts.get(record['status'], 0) + 1
+    summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items()))
+    print(f"{len(records)} files in {time.perf_counter() - start:.2f}s: {summary or 'nothing to run'}",
+          file=sys.stderr)
+    sys.exit(0 if all(record['exit_code'] == 0 for record in records) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# bytecode.py
+
+"""Instruction set shared by the compiler and the virtual machine.
+
+Every instruction is two slots wide in the flat ``code`` list:
+an opcode followed by a single integer argument (0 when unused).
+"""
+
+from resolver import UNSET
+
+# Opcodes
+LOAD_CONST = 0       # push consts[arg]
+LOAD_FAST = 1        # push local slot arg, falling back to the global of the same name
+STORE_FAST = 2       # pop into local slot arg, push None
+LOAD_GLOBAL = 3      # push global slot arg
+STORE_GLOBAL = 4     # pop into global slot arg, push None
+POP_TOP = 5          # discard the top of the stack
+# The operators, BINARY_ADD to UNARY_POS, are consecutive: the VM charges each a step with one range check
+BINARY_ADD = 6
+BINARY_SUB = 7
+BINARY_MUL = 8
+BINARY_DIV = 9
+BINARY_MOD = 10
+COMPARE_EQ = 11
+COMPARE_NE = 12
+COMPARE_GT = 13
+COMPARE_LT = 14
+COMPARE_GE = 15
+COMPARE_LE = 16
+JUMP_IF_FALSE_OR_POP = 17  # pc = arg when the top is falsy, else pop it (&&)
+JUMP_IF_TRUE_OR_POP = 18   # pc = arg when the top is truthy, else pop it (||)
+UNARY_NOT = 19
+UNARY_NEG = 20
+UNARY_POS = 21
+JUMP = 22            # pc = arg
+JUMP_IF_FALSE = 23   # pop, pc = arg when the value is falsy
+MAKE_FUNCTION = 24   # push a Closure of the lambda Function consts[arg] over the current frame
+DEFINE_FUNCTION = 25 # register the defun Function consts[arg], push None
+# The three calls are consecutive: the VM tests for them with one range check
+CALL_NAME = 26       # call the defun names[arg >> 8] with (arg & 0xFF) arguments
+CALL_FAST = 27       # call the function in local slot (arg >> 8) with (arg & 0xFF) arguments
+CALL_VALUE = 28      # call the value below the top (arg) arguments
+RETURN_VALUE = 29    # return the top of the stack to the caller
+PRINT_RESULT = 30    # print a top-level statement result, leaving it (or None if nothing printed) on the stack
+# push handler(local slot (arg & 0xFFFF), right), for the (handler, right, position of the local) in consts[arg >> 16]
+BINARY_FAST_CONST = 31
+
+OPNAMES = {value: name for name, value in globals().items() if name.isupper() and isinstance(value, int)}
+
+# Token type -> opcode for Operation / UnaryOp nodes
+BINARY_OPCODES = {
+    'PLUS': BINARY_ADD,
+    'MINUS': BINARY_SUB,
+    'MUL': BINARY_MUL,
+    'DIV': BINARY_DIV,
+    'MODULO': BINARY_MOD,
+    'EQEQ': COMPARE_EQ,
+    'NEQUAL': COMPARE_NE,
+    'GT': COMPARE_GT,
+    'LT': COMPARE_LT,
+    'GTE': COMPARE_GE,
+    'LTE': COMPARE_LE,
+}
+
+# && and || jump over their right side when the left side decides the result
+SHORT_CIRCUIT_OPCODES = {
+    'AND': JUMP_IF_FALSE_OR_POP,
+    'OR': JUMP_IF_TRUE_OR_POP,
+}
+
+UNARY_OPCODES = {
+    'NOT': UNARY_NOT,
+    'MINUS': UNARY_NEG,
+    'PLUS': UNARY_POS,
+}
+
+MAX_ARGS = 0xFF
+MAX_SLOT = 0xFFFF  # highest local slot BINARY_FAST_CONST can address
+
+
+class CodeObject:
+    def __init__(self, name, code, consts, names, varnames, positions=None):
+        self.name = name
+        self.code = code
+        self.consts = consts
+        self.names = names
+        self.varnames = varnames  # local slot -> name, parameters first
+        # Source position of the node each instruction was compiled from (see errors.pack), or None
+        self.positions = positions if positions is not None else [None] * (len(code) // 2)
+
+    def position_at(self, pc):
+        """Position of the instruction at `pc`, or of the nearest one before it that has one."""
+        for index in range(pc // 2, -1, -1):
+            if self.positions[index] is not None:
+                return self.positions[index]
+        return None
+
+    def __repr__(self):
+        return f'<code {self.name}, {len(self.code) // 2} instructions>'
+
+
+class Function:
+    """A compiled defun or lambda."""
+
+    def __init__(self, name, params, code, node=None, captures=()):
+        self.name = name
+        self.params = params
+        self.code = code
+        self.node = node  # the FunctionDecNode / LambdaNode it was compiled from
+        self.captures = captures  # enclosing frame slots a lambda copies, see environment.Closure
+        # Slots past the parameters and captured values start out unset
+        self.padding = [UNSET] * (len(code.varnames) - len(params) - len(captures))
+
+    def __repr__(self):
+        return f'<function {self.name}>'
+
+
+def disassemble(code_obj):
+    """Return a readable listing of a code object and the functions it defines."""
+    lines = [f'{code_obj.name}:']
+    nested = []
+    code = code_obj.code
+    for pc in range(0, len(code), 2):
+        op, arg = code[pc], code[pc + 1]
+        detail = ''
+        if op == LOAD_CONST:
+            detail = f'({code_obj.consts[arg]!r})'
+        elif op in (LOAD_FAST, STORE_FAST):
+            detail = f'({code_obj.varnames[arg]})'
+        elif op == BINARY_FAST_CONST:
+            handler, right, position = code_obj.consts[arg >> 16]
+            detail = f'({code_obj.varnames[arg & MAX_SLOT]} {handler.__name__} {right!r})'
+        elif op in (JUMP, JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP):
+            detail = f'(to {arg})'
+        elif op in (MAKE_FUNCTION, DEFINE_FUNCTION):
+            nested.append(code_obj.consts[arg])
+            detail = f'({code_obj.consts[arg].name})'
+        elif op == CALL_NAME:
+            detail = f'({code_obj.names[arg >> 8]}, {arg & MAX_ARGS} args)'
+        elif op == CALL_FAST:
+            detail = f'({code_obj.varnames[arg >> 8]}, {arg & MAX_ARGS} args)'
+        lines.append(f'  {pc:>5} {OPNAMES[op]:<18} {arg} {detail}'.rstrip())
+    for func in nested:
+        lines.append('')
+        lines.append(disassemble(func.code))
+    return '\n'.join(lines)
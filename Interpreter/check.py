@@ -0,0 +1,87 @@
+# check.py
+
+"""Syntax checking of .lambda files without running them.
+
+    python3 main.py --check TARGET [--jobs N]
+
+Each file is lexed and parsed with error recovery (Parser.parse_recovering),
+so one pass reports every syntax error in it, one `path:line:column: message`
+line each. Several files are spread over a pool of processes.
+"""
+
+import glob
+import multiprocessing
+import os
+
+from lexer import Lexer
+from parser import Parser
+import errors
+
+# Files handed to a worker at a time; most take well under a millisecond to check
+CHUNK_SIZE = 16
+
+
+def collect_files(targets):
+    """The .lambda files named by `targets`, in order, each listed once."""
+    files = []
+    for target in targets:
+        if os.path.isdir(target):
+            for root, dirs, names in os.walk(target):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith('.lambda'))
+        elif glob.has_magic(target):
+            files.extend(sorted(glob.glob(target, recursive=True)))
+        elif target.endswith('.lambda'):
+            files.append(target)
+        else:
+            base = os.path.dirname(target)
+            with open(target, 'r') as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        files.append(os.path.join(base, line))
+    return list(dict.fromkeys(files))
+
+
+def check_source(code, file_path=None):
+    """(partial BlockNode, LexErrors and ParseErrors in source order) for the program `code`.
+
+    The tree is None when checking stopped early: at a line past the position
+    limits, or at nesting deeper than the parser's recursion allows. The
+    error it stopped at is the last one.
+    """
+    lexer = Lexer(code, file_path)
+    lexer.diagnostics = []
+    parser = None
+    stopped = []
+    try:
+        parser = Parser(lexer)
+        tree, diagnostics = parser.parse_recovering()
+    except errors.LanguageError as error:
+        tree, diagnostics, stopped = None, parser.diagnostics if parser else [], [error]
+    except RecursionError:
+        # Where the recursion runs out depends on the stack; the line it happens on does not
+        line_start = parser.current_token.line_position
+        tree, diagnostics = None, parser.diagnostics
+        stopped = [errors.ParseError("Nesting too deep to parse", line_start | 1)]
+    return tree, sorted(lexer.diagnostics + diagnostics, key=lambda error: error.position) + stopped
+
+
+def check_file(file_path):
+    """(file_path, a message per error), as text: file ids are not the same in every process."""
+    try:
+        with open(file_path, 'r') as file:
+            code = file.read()
+    except (OSError, UnicodeDecodeError) as error:
+        return file_path, [f'{file_path}: {error}']
+    return file_path, [str(error) for error in check_source(code, file_path)[1]]
+
+
+def check_files(files, jobs=None):
+    """Yield (file path, messages) for each of `files`, in order, checked by `jobs` processes (one per CPU)."""
+    jobs = min(jobs or os.cpu_count() or 1, len(files))
+    if jobs <= 1:
+        yield from map(check_file, files)
+        return
+    with multiprocessing.get_context().Pool(jobs) as pool:
+        yield from pool.imap(check_file, files, CHUNK_SIZE)
@@ -0,0 +1,216 @@
+from parser import ReturnNode, LocalVar, Num, Boolean
+from bytecode import (
+    CodeObject, Function, BINARY_OPCODES, SHORT_CIRCUIT_OPCODES, UNARY_OPCODES, MAX_ARGS, MAX_SLOT,
+    BINARY_FAST_CONST, LOAD_CONST, LOAD_FAST, STORE_FAST, LOAD_GLOBAL, STORE_GLOBAL, POP_TOP, JUMP, JUMP_IF_FALSE,
+    MAKE_FUNCTION, DEFINE_FUNCTION, CALL_NAME, CALL_FAST, CALL_VALUE, RETURN_VALUE, PRINT_RESULT,
+)
+import errors
+
+
+class CodeBuilder:
+    """Accumulates the instructions, constants and names of one code object."""
+
+    def __init__(self, name, varnames=None):
+        self.name = name
+        self.code = []
+        self.consts = []
+        self.names = []
+        self.varnames = varnames
+        self.positions = []  # one per instruction
+        self.position = None  # of the node being compiled
+        self._const_index = {}
+        self._name_index = {}
+
+    def emit(self, op, arg=0):
+        self.code.append(op)
+        self.code.append(arg)
+        self.positions.append(self.position)
+        return len(self.code) - 2
+
+    def patch(self, pc, target):
+        """Point the jump instruction at `pc` to `target`."""
+        self.code[pc + 1] = target
+
+    def here(self):
+        return len(self.code)
+
+    def const(self, value):
+        # bool == int in Python, so key constants by type as well
+        key = (type(value), value) if isinstance(value, (int, str)) else id(value)
+        if key not in self._const_index:
+            self._const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return self._const_index[key]
+
+    def name_index(self, name):
+        if name not in self._name_index:
+            self._name_index[name] = len(self.names)
+            self.names.append(name)
+        return self._name_index[name]
+
+    def build(self):
+        code = self.code
+        # A jump straight to a return is replaced by the return itself
+        for pc in range(0, len(code), 2):
+            if code[pc] == JUMP and code[pc + 1] < len(code) and code[code[pc + 1]] == RETURN_VALUE:
+                code[pc] = RETURN_VALUE
+                code[pc + 1] = 0
+        return CodeObject(self.name, code, self.consts, self.names, self.varnames or [], self.positions)
+
+
+class Compiler:
+    """Translate a resolved AST (see resolver.Resolver) into bytecode for the VirtualMachine."""
+
+    def __init__(self):
+        self.builder = None
+
+    def compile_module(self, tree):
+        """Compile a top-level BlockNode, printing each statement's result like Interpreter.interpret.
+
+        The code returns the last statement's result, as Interpreter.interpret does.
+        """
+        self.builder = CodeBuilder('<module>')
+        statements = tree.statements
+        if not statements:
+            self.builder.emit(LOAD_CONST, self.builder.const(None))
+        for index, statement in enumerate(statements):
+            if index:
+                self.builder.emit(POP_TOP)
+            self.visit(statement)
+            self.builder.emit(PRINT_RESULT)
+        self.builder.emit(RETURN_VALUE)
+        return self.builder.build()
+
+    def compile_function(self, name, params, body, node, captures=()):
+        outer = self.builder
+        self.builder = CodeBuilder(name, node.local_names)
+        self.visit(body)
+        self.builder.emit(RETURN_VALUE)
+        code = self.builder.build()
+        self.builder = outer
+        return Function(name, params, code, node, captures)
+
+    def visit(self, node):
+        method_name = f'compile_{type(node).__name__}'
+        method = getattr(self, method_name, self.generic_visit)
+        position = getattr(node, 'position', None)
+        if position is None:
+            return method(node)
+        # Instructions emitted for the node itself, after its children, get its position
+        builder = self.builder
+        outer, builder.position = builder.position, position
+        try:
+            return method(node)
+        finally:
+            builder.position = outer
+
+    def generic_visit(self, node):
+        raise Exception(f'No compile_{type(node).__name__} method')
+
+    def compile_Num(self, node):
+        self.builder.emit(LOAD_CONST, self.builder.const(node.value))
+
+    def compile_Boolean(self, node):
+        self.builder.emit(LOAD_CONST, self.builder.const(node.value))
+
+    def compile_NoneType(self, node):
+        # `return` without an expression
+        self.builder.emit(LOAD_CONST, self.builder.const(None))
+
+    def compile_LocalVar(self, node):
+        self.builder.emit(LOAD_FAST, node.slot)
+
+    def compile_GlobalVar(self, node):
+        self.builder.emit(LOAD_GLOBAL, node.slot)
+
+    def compile_LocalAssign(self, node):
+        self.visit(node.expr)
+        self.builder.emit(STORE_FAST, node.slot)
+
+    def compile_GlobalAssign(self, node):
+        self.visit(node.expr)
+        self.builder.emit(STORE_GLOBAL, node.slot)
+
+    def compile_BlockNode(self, node):
+        """A block evaluates to its last statement, or to the first `return` it reaches."""
+        if not node.statements:
+            self.builder.emit(LOAD_CONST, self.builder.const(None))
+            return
+        for index, statement in enumerate(node.statements):
+            self.visit(statement)
+            if isinstance(statement, ReturnNode):
+                return
+            if index < len(node.statements) - 1:
+                self.builder.emit(POP_TOP)
+
+    def compile_ReturnNode(self, node):
+        self.visit(node.expr)
+
+    def compile_IfNode(self, node):
+        self.visit(node.condition)
+        jump_to_else = self.builder.emit(JUMP_IF_FALSE)
+        self.visit(node.block)
+        jump_to_end = self.builder.emit(JUMP)
+        self.builder.patch(jump_to_else, self.builder.here())
+        if node.else_block is not None:
+            self.visit(node.else_block)
+        else:
+            self.builder.emit(LOAD_CONST, self.builder.const(None))
+        self.builder.patch(jump_to_end, self.builder.here())
+
+    def compile_UnaryOp(self, node):
+        self.visit(node.expr)
+        op = UNARY_OPCODES.get(node.op)
+        if op is None:
+            raise errors.RuntimeError(f"Unsupported unary operator {node.op}", self.builder.position)
+        self.builder.emit(op)
+
+    def compile_Operation(self, node):
+        left, right = node.left, node.right
+        if type(left) is LocalVar and type(right) in (Num, Boolean) and left.slot <= MAX_SLOT:
+            # `n - 1`, `n <= 1`: one instruction instead of three
+            operation = (node.handler, right.value, left.position)
+            self.builder.emit(BINARY_FAST_CONST, (self.builder.const(operation) << 16) | left.slot)
+            return
+        self.visit(node.left)
+        self.visit(node.right)
+        op = BINARY_OPCODES.get(node.op)
+        if op is None:
+            raise errors.RuntimeError(f"Unsupported binary operator {node.op}", self.builder.position)
+        self.builder.emit(op)
+
+    def compile_BinOp(self, node):
+        """&& and ||: the left value is the result when it decides it, else the right one."""
+        op = SHORT_CIRCUIT_OPCODES.get(node.op)
+        if op is None:
+            raise errors.RuntimeError(f"Unsupported binary operator {node.op}", self.builder.position)
+        self.visit(node.left)
+        jump_to_end = self.builder.emit(op)
+        self.visit(node.right)
+        self.builder.patch(jump_to_end, self.builder.here())
+
+    def compile_FunctionDecNode(self, node):
+        params = [param.name for param in node.params]
+        func = self.compile_function(node.name, params, node.block, node)
+        self.builder.emit(DEFINE_FUNCTION, self.builder.const(func))
+
+    def compile_LambdaNode(self, node):
+        func = self.compile_function('<lambda>', list(node.params), node.expr, node, node.captures)
+        self.builder.emit(MAKE_FUNCTION, self.builder.const(func))
+        if node.arg is not None:
+            self._compile_args(node.arg)
+            self.builder.emit(CALL_VALUE, len(node.arg))
+
+    def compile_FunctionCallNode(self, node):
+        self._compile_args(node.args)
+        if node.slot is not None:
+            self.builder.emit(CALL_FAST, (node.slot << 8) | len(node.args))
+        else:
+            self.builder.emit(CALL_NAME, (self.builder.name_index(node.name) << 8) | len(node.args))
+
+    def _compile_args(self, args):
+        if len(args) > MAX_ARGS:
+            raise errors.RuntimeError(f"Too many arguments ({len(args)}), the limit is {MAX_ARGS}",
+                                      self.builder.position)
+        for arg in args:
+            self.visit(arg)
@@ -0,0 +1,101 @@
+# control.py
+
+"""Step budgets and cooperative suspension of a running program.
+
+Both engines charge one step per function call, since calls are the only way
+a program repeats, one per operator evaluated, so a long expression or one
+over ever larger numbers is counted too, and one per item the sequence
+builtins consume. The engine's `fuel` is the number of steps left before the
+next checkpoint, or None when there is neither a max_steps budget nor a
+Control. Without either, counting costs a test per call or operator.
+
+At a checkpoint, the budget is enforced and the Control may suspend or cancel
+the run. A Control is driven from another thread. A subclass can also poll
+anything else, as server.py polls a flag shared between processes.
+"""
+
+import threading
+
+import errors
+
+# Steps between two checkpoints when a Control is attached
+CHECK_INTERVAL = 1000
+
+
+class Cancelled(Exception):
+    """Raised at a checkpoint once the run was cancelled."""
+
+
+class Control:
+    """Suspend, resume or cancel a program running in another thread.
+
+    The engine calls checkpoint() every CHECK_INTERVAL steps. It blocks there
+    while the run is suspended and raises Cancelled once it was cancelled.
+    """
+
+    def __init__(self):
+        self._running = threading.Event()
+        self._running.set()
+        self.cancelled = False
+
+    @property
+    def suspended(self):
+        return not self._running.is_set()
+
+    def suspend(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self.cancelled = True
+        # A suspended run wakes up to stop
+        self._running.set()
+
+    def checkpoint(self):
+        self._running.wait()
+        if self.cancelled:
+            raise Cancelled("Evaluation cancelled")
+
+
+class Metered:
+    """Step accounting of Interpreter and VirtualMachine."""
+
+    def init_budget(self, max_steps=None, control=None):
+        self.max_steps = max_steps
+        self.control = control
+        self._steps = 0      # steps charged before the current period
+        self._period = None  # fuel the current period started with
+        self._refuel()
+
+    def _refuel(self):
+        period = CHECK_INTERVAL if self.control is not None else None
+        if self.max_steps is not None:
+            left = max(self.max_steps - self._steps, 0)
+            period = left if period is None else min(period, left)
+        self._period = self.fuel = period
+
+    @property
+    def steps_taken(self):
+        """Steps charged so far, or None when nothing is counted."""
+        return None if self.fuel is None else self._steps + self._period - self.fuel
+
+    @property
+    def out_of_steps(self):
+        return self.max_steps is not None and self.steps_taken > self.max_steps
+
+    def charge(self, steps):
+        self.fuel -= steps
+        if self.fuel < 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Reached when the fuel runs out: enforce max_steps, then let the Control suspend or cancel the run."""
+        self._steps = self.steps_taken
+        self._period = self.fuel = 0
+        if self.out_of_steps:
+            raise errors.RuntimeError(f"Step limit of {self.max_steps} exceeded")
+        if self.control is not None:
+            self.control.checkpoint()
+        self._refuel()
@@ -0,0 +1,66 @@
+# environment.py
+
+"""Runtime state of one program: the functions it defined and its global variables.
+
+Each Interpreter / VirtualMachine owns an Environment, so separate instances
+never see each other's definitions. An environment holds what its engine
+defines: FunctionDecNodes for Interpreter, compiled Functions for the VM.
+Only fork it for instances of the same engine.
+"""
+
+from resolver import GlobalTable, UNSET
+from sequences import BUILTINS
+import errors
+
+
+class Closure:
+    """The value of a lambda: its function and the enclosing locals it reads.
+
+    `function` is the LambdaNode for Interpreter and the compiled Function for
+    the VM. `captured` holds the values of the enclosing frame's slots listed
+    in the lambda's `captures`, taken when the lambda was evaluated; they fill
+    the frame slots right after the parameters on every call. A closure is
+    never modified, so it can be stored, passed around and called from any
+    number of places, or threads, at once.
+    """
+    __slots__ = ('function', 'captured')
+
+    def __init__(self, function, captured):
+        self.function = function
+        self.captured = captured
+
+
+class Environment:
+    def __init__(self):
+        self.functions = {}
+        self.globals = GlobalTable()
+        self._shared_functions = False  # `functions` is also used by a fork
+
+    def fork(self):
+        """A copy-on-write child: a prelude is loaded once, then forked for every program that uses it.
+
+        Forking costs the same however much the environment holds. Each side
+        copies the functions or globals it changes, the first time it does so.
+        """
+        child = Environment.__new__(Environment)
+        child.functions = self.functions
+        child.globals = self.globals.fork()
+        child._shared_functions = self._shared_functions = True
+        return child
+
+    def define(self, name, func):
+        if self._shared_functions:
+            self.functions = dict(self.functions)
+            self._shared_functions = False
+        self.functions[name] = func
+
+    def callee(self, name):
+        """What a call to `name` runs when no defun has that name: a lambda stored in the global, or a builtin."""
+        slot = self.globals.slots.get(name)
+        value = self.globals.values[slot] if slot is not None else UNSET
+        if type(value) is Closure:
+            return value
+        builtin = BUILTINS.get(name)
+        if builtin is None:
+            raise errors.RuntimeError(f"Function '{name}' is not defined.")
+        return builtin
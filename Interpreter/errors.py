@@ -0,0 +1,145 @@
+# errors.py
+
+"""Source positions and the errors a program can fail with.
+
+A position is one int: the file id, line and column packed together, so an
+AST node carries it in a single slot. Tokens keep their line's position,
+one int shared by the line, and their column, and add them up when the
+parser asks (lexer.Token.position). File id 0 is source without a file (the REPL,
+standard input, a server request); other ids come from file_id(path).
+
+    LexError      a character no token starts with
+    ParseError    tokens that do not form a program
+    RuntimeError  a failure while the program runs, with the calls that led to it
+
+A RuntimeError raised by the interpreter has no position yet. The engines add
+positions while the exception unwinds: the innermost node with a position
+locates the error, and each call it leaves adds a frame to `trace`, at the
+position of the call being made in that frame. Nothing is recorded while
+the program runs normally.
+"""
+
+COLUMN_BITS = 24
+LINE_BITS = 28
+MAX_COLUMN = (1 << COLUMN_BITS) - 1
+MAX_LINE = (1 << LINE_BITS) - 1
+FILE_SHIFT = COLUMN_BITS + LINE_BITS
+
+# Traces longer than this show only their ends
+TRACE_LIMIT = 50
+
+_file_ids = {}
+_file_names = ['']
+
+
+def file_id(path):
+    """The id positions use for the file at `path`, registered on first use."""
+    number = _file_ids.get(path)
+    if number is None:
+        number = _file_ids[path] = len(_file_names)
+        _file_names.append(path)
+    return number
+
+
+def claim_file_id(path, number):
+    """Register `path` under a given id, as in a cached tree; False when the id already names another file."""
+    if path in _file_ids:
+        return _file_ids[path] == number
+    if number < len(_file_names) and _file_names[number] is not None or number == 0:
+        return False
+    # Ids skipped on the way stay free
+    _file_names.extend([None] * (number + 1 - len(_file_names)))
+    _file_names[number] = path
+    _file_ids[path] = number
+    return True
+
+
+def pack(file, line, column):
+    return file << FILE_SHIFT | line << COLUMN_BITS | column
+
+
+def unpack(position):
+    """(file id, line, column) of a position."""
+    return position >> FILE_SHIFT, position >> COLUMN_BITS & MAX_LINE, position & MAX_COLUMN
+
+
+def line_of(position):
+    return position >> COLUMN_BITS & MAX_LINE if position is not None else None
+
+
+def describe(position):
+    """`prog.lambda:3:5`, or `line 3, column 5` for source without a file.
+
+    A file id this process never gave out, as in a tree parsed elsewhere, shows as `<unknown>`.
+    """
+    file, line, column = unpack(position)
+    if file:
+        name = _file_names[file] if file < len(_file_names) else None
+        return f"{name if name is not None else '<unknown>'}:{line}:{column}"
+    return f'line {line}, column {column}'
+
+
+class LanguageError(Exception):
+    """An error in the program being run, as opposed to one in the interpreter."""
+
+    def __init__(self, message, position=None):
+        super().__init__(message)
+        self.message = message
+        self.position = position
+
+    def __str__(self):
+        if self.position is None:
+            return self.message
+        return f'{describe(self.position)}: {self.message}'
+
+
+class LexError(LanguageError):
+    pass
+
+
+class ParseError(LanguageError):
+    pass
+
+
+class RuntimeError(LanguageError):
+    def __init__(self, message, position=None):
+        super().__init__(message, position)
+        self.trace = []  # (function name, position or None) of every call in progress, innermost first
+        self._pending = position  # position in the frame being unwound, once known
+
+    def locate(self, position):
+        """Called by the engines, innermost first, with the positions of the nodes the error unwinds through."""
+        if self._pending is None and position is not None:
+            self._pending = position
+            if self.position is None:
+                self.position = position
+
+    def leave(self, name):
+        """Called as the error leaves a call of `name` (or the program); the next position located is the call."""
+        self.trace.append((name, self._pending))
+        self._pending = None
+
+    def format_trace(self):
+        """The calls in progress, outermost first, one line each; repeated lines are counted instead."""
+        lines = []
+        previous, repeats = None, 0
+        for name, position in reversed(self.trace):
+            where = describe(position) if position is not None else '<unknown>'
+            line = f"  {where}, in {name if name.startswith('<') else repr(name)}"
+            if line == previous:
+                repeats += 1
+                continue
+            if repeats:
+                lines.append(f'  [previous line repeated {repeats} more times]')
+            lines.append(line)
+            previous, repeats = line, 0
+        if repeats:
+            lines.append(f'  [previous line repeated {repeats} more times]')
+        if len(lines) > TRACE_LIMIT:
+            lines[TRACE_LIMIT // 2:-TRACE_LIMIT // 2] = [f'  ... {len(lines) - TRACE_LIMIT} more lines ...']
+        return ['Traceback (most recent call last):'] + lines
+
+
+# Errors Python raises for values the language's operators cannot take
+PYTHON_ERRORS = (TypeError, ValueError, ArithmeticError)
+
@@ -0,0 +1,144 @@
+# flattree.py
+
+"""Struct-of-arrays encoding of a whole AST, for very large programs.
+
+Every node is a run of int64 words in one array('q'): the index of its class
+in NODE_TYPES, then one tagged word per field in __slots__ order. A node is
+referred to by the position of its first word. Children are written before
+their parent, so the tree is built in a single pass. The tag lives in the low
+bits of a word:
+
+    NODE   position of a child node
+    INT    a plain int field (slots)
+    STR    index into the string table (names, operators)
+    NONE   None
+    TUPLE  position of a length word followed by the tagged items
+    NUM    an integer literal, stored inline instead of as a Num node
+    OBJ    index into `objects`, for anything else (booleans, huge literals)
+
+Nodes are rebuilt on access, so a program can be stored flat and executed one
+top-level statement at a time with only that statement held as objects.
+"""
+
+from array import array
+
+from parser import (
+    TRUE, FALSE, LambdaNode, FunctionCallNode, FunctionDecNode, ReturnNode, Assign, Var, LocalVar, GlobalVar,
+    LocalAssign, GlobalAssign, Boolean, Num, BinOp, BlockNode, UnaryOp, IfNode,
+)
+
+NODE_TYPES = (
+    LambdaNode, FunctionCallNode, FunctionDecNode, ReturnNode, Assign, Var, LocalVar, GlobalVar,
+    LocalAssign, GlobalAssign, Boolean, Num, BinOp, BlockNode, UnaryOp, IfNode,
+)
+NODE_KINDS = {cls: kind for kind, cls in enumerate(NODE_TYPES)}
+
+TAG_BITS = 3
+TAG_MASK = (1 << TAG_BITS) - 1
+NODE, INT, STR, NONE, TUPLE, NUM, OBJ = range(7)
+
+# Payloads must survive the shift into a signed 64-bit word
+MAX_PAYLOAD = (1 << (63 - TAG_BITS)) - 1
+MIN_PAYLOAD = -(1 << (63 - TAG_BITS))
+
+
+class FlatTree:
+    def __init__(self):
+        self.words = array('q')
+        self.strings = []
+        self.objects = []
+        self.roots = array('q')  # tagged word of each top-level statement
+        self._string_index = {}
+        self._object_index = {}
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Encode the top-level statements of a BlockNode."""
+        return cls.from_statements(tree.statements)
+
+    @classmethod
+    def from_statements(cls, statements):
+        """Encode statements as they are produced, e.g. by Parser.parse_statements."""
+        flat = cls()
+        for statement in statements:
+            flat.append(statement)
+        return flat
+
+    def append(self, statement):
+        """Add a top-level statement."""
+        self.roots.append(self._value(statement))
+
+    @property
+    def statements(self):
+        """The top-level statements, rebuilt one at a time as the caller iterates."""
+        return map(self._decode, self.roots)
+
+    def to_tree(self):
+        return BlockNode(self.statements)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def nbytes(self):
+        """Bytes held by the word arrays (the string and object tables are shared or small)."""
+        return self.words.itemsize * len(self.words) + self.roots.itemsize * len(self.roots)
+
+    def node(self, pos):
+        """Rebuild the node starting at word `pos`."""
+        words = self.words
+        cls = NODE_TYPES[words[pos]]
+        return cls(*[self._decode(words[pos + 1 + index]) for index in range(len(cls.__slots__))])
+
+    def _decode(self, word):
+        tag = word & TAG_MASK
+        payload = word >> TAG_BITS
+        if tag == NODE:
+            return self.node(payload)
+        if tag == NUM:
+            return Num(payload)
+        if tag == STR:
+            return self.strings[payload]
+        if tag == NONE:
+            return None
+        if tag == INT:
+            return payload
+        if tag == TUPLE:
+            words = self.words
+            return tuple(self._decode(words[payload + 1 + index]) for index in range(words[payload]))
+        return self.objects[payload]
+
+    def _value(self, value):
+        """Append whatever `value` needs to the arrays and return the tagged word referring to it."""
+        if type(value) is Num and type(value.value) is int and MIN_PAYLOAD <= value.value <= MAX_PAYLOAD:
+            return value.value << TAG_BITS | NUM
+        if type(value) is Boolean:
+            value = TRUE if value.value else FALSE
+        kind = NODE_KINDS.get(type(value))
+        if kind is not None and type(value) is not Boolean:
+            fields = [self._value(getattr(value, name)) for name in value.__slots__]
+            pos = len(self.words)
+            self.words.append(kind)
+            self.words.extend(fields)
+            return pos << TAG_BITS | NODE
+        if value is None:
+            return NONE
+        if type(value) is str:
+            index = self._string_index.get(value)
+            if index is None:
+                index = self._string_index[value] = len(self.strings)
+                self.strings.append(value)
+            return index << TAG_BITS | STR
+        if type(value) is int and MIN_PAYLOAD <= value <= MAX_PAYLOAD:
+            return value << TAG_BITS | INT
+        if type(value) is tuple:
+            items = [self._value(item) for item in value]
+            pos = len(self.words)
+            self.words.append(len(items))
+            self.words.extend(items)
+            return pos << TAG_BITS | TUPLE
+        # The two Boolean nodes, out-of-range literals and anything unexpected
+        index = self._object_index.get(id(value))
+        if index is None:
+            index = self._object_index[id(value)] = len(self.objects)
+            self.objects.append(value)
+        return index << TAG_BITS | OBJ
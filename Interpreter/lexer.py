@@ -1,5 +1,11 @@
 # lexer.py
 
+import gc
+import re
+import sys
+
+from errors import LexError, COLUMN_BITS, FILE_SHIFT, MAX_COLUMN, MAX_LINE, pack, unpack, file_id
+
 # Token types
 tokens = (
     'INTEGER',
@@ -43,11 +49,120 @@ t_GTE = r'>='
 t_LTE = r'<='
 t_COLLON = r':'
 
+KEYWORDS = {
+    'true': 'BOOLEAN',
+    'false': 'BOOLEAN',
+    'defun': 'DEFUN',
+    'return': 'RETURN',
+    'if': 'IF',
+    'else': 'ELSE',
+    'lambda': 'LAMBDA',
+}
+
+# Operator and punctuation lexemes; two-character ones are matched first
+OPERATORS = {
+    '++': 'PLUSONE',
+    '--': 'MINUSONE',
+    '==': 'EQEQ',
+    '!=': 'NEQUAL',
+    '>=': 'GTE',
+    '<=': 'LTE',
+    '&&': 'AND',
+    '||': 'OR',
+    '+': 'PLUS',
+    '-': 'MINUS',
+    '*': 'MUL',
+    '/': 'DIV',
+    '%': 'MODULO',
+    '=': 'EQUAL',
+    '!': 'NOT',
+    '>': 'GT',
+    '<': 'LT',
+    ',': 'COMMA',
+    '(': 'LPAREN',
+    ')': 'RPAREN',
+    '{': 'LBRACE',
+    '}': 'RBRACE',
+    ':': 'COLON',
+}
+
+# One master pattern for the whole language, applied line by line. Whitespace
+# never matches, so finditer skips it in C; a comment runs to the end of its line.
+TOKEN_RE = re.compile('|'.join((
+    r'(?P<NAME>[^\W\d_]\w*)',
+    r'(?P<INTEGER>\d+)',
+    '(?P<OP>' + '|'.join(re.escape(op) for op in sorted(OPERATORS, key=len, reverse=True)) + ')',
+    r'(?P<COMMENT>#.*)',
+    r'(?P<MISMATCH>\S)',
+)))
+
+# The same language over bytes, for Lexer.scan_buffer. Bytes past ASCII count
+# as name characters: UTF-8 names are decoded only when their value is read.
+BYTES_TOKEN_RE = re.compile(b'|'.join((
+    rb'(?P<NAME>[A-Za-z\x80-\xff][\w\x80-\xff]*)',
+    rb'(?P<INTEGER>\d+)',
+    b'(?P<OP>' + b'|'.join(re.escape(op.encode()) for op in sorted(OPERATORS, key=len, reverse=True)) + b')',
+    rb'(?P<COMMENT>#.*)',
+    rb'(?P<MISMATCH>\S)',
+)))
+BYTES_KEYWORDS = {keyword.encode(): keyword for keyword in KEYWORDS}
+KEYWORD_MAX_LENGTH = max(map(len, KEYWORDS))
+BYTES_OPERATORS = {op.encode(): (token_type, op) for op, token_type in OPERATORS.items()}
+
 
 class Token:
-    def __init__(self, type, value):
+    """A lexeme with its position, kept as its line's position (shared by the line's tokens) and its column."""
+    __slots__ = ('type', 'value', 'line_position', 'column')
+
+    def __init__(self, type, value, line_position=0, column=0):
         self.type = type
         self.value = value
+        self.line_position = line_position  # file id and line packed by errors.pack, with column 0
+        self.column = column
+
+    @property
+    def position(self):
+        """File id, line and column packed into one int, as AST nodes and errors keep them."""
+        return self.line_position + self.column
+
+    @property
+    def line(self):
+        return unpack(self.line_position)[1]
+
+    def __str__(self):
+        return f'Token({self.type}, {repr(self.value)})'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class SpanToken:
+    """A VARIABLE or INTEGER token that points into the source buffer.
+
+    The lexeme is only decoded (to an interned str or an int) when `value`
+    is first read.
+    """
+    __slots__ = ('type', 'buffer', 'start', 'end', 'line_position', 'column', '_value')
+
+    def __init__(self, type, buffer, start, end, line_position=0, column=0):
+        self.type = type
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        self.line_position = line_position
+        self.column = column
+        self._value = None
+
+    position = Token.position
+    line = Token.line
+
+    @property
+    def value(self):
+        value = self._value
+        if value is None:
+            lexeme = self.buffer[self.start:self.end]
+            value = self._value = int(lexeme) if self.type == 'INTEGER' else sys.intern(lexeme.decode('utf-8'))
+        return value
 
     def __str__(self):
         return f'Token({self.type}, {repr(self.value)})'
@@ -57,188 +172,211 @@ class Token:
 
 
 class Lexer:
-    def __init__(self, text):
+    """Tokenizes source text with the single TOKEN_RE scanner.
+
+    tokens() streams Token objects (ending with EOF) and tokenize() returns
+    them as a list; TokenStream provides lookahead for the parser.
+
+    Every token's position packs `file` (a path, registered with
+    errors.file_id) with its line and column. With `diagnostics` set to a
+    list, unexpected characters are recorded there as LexErrors and skipped.
+    """
+
+    def __init__(self, text, file=None):
         self.text = text
+        self.file = file_id(file) if file is not None else 0
         self.pos = 0
-        self.current_char = self.text[self.pos]
+        self.line = 1
+        self.column = 1
+        self.diagnostics = None
 
     def error(self, message="Invalid character"):
-        raise Exception(f"Lexer error: {message} at position {self.pos}")
-
-    def advance(self):
-        """Advance the token by one character."""
-        self.pos += 1
-        if self.pos > len(self.text) - 1:
-            self.current_char = None
-        else:
-            self.current_char = self.text[self.pos]
-
-    def skip_comment(self):
-        """Comment handling"""
-        while self.current_char is not None and self.current_char != '\n':
-            self.advance()  # Move to the next character
-        self.advance()  # Skip the newline character
-
-    def skip_whitespace(self):
-        while self.current_char is not None and self.current_char.isspace():
-            self.advance()
-
-    def identifier(self):
-        """Handle identifiers and keywords like WHILE, DEFUN, etc."""
-        result = ''
-        while self.current_char is not None and (self.current_char.isalnum() or self.current_char == '_'):
-            result += self.current_char
-            self.advance()
-
-        if result == 'true' or result == 'false':
-            return Token('BOOLEAN', result)
-        elif result == 'defun':
-            return Token('DEFUN', result)
-        elif result == 'return':
-            return Token('RETURN', result)
-        elif result == 'if':
-            return Token('IF', result)
-        elif result == 'else':
-            return Token('ELSE', result)
-        elif result == 'lambda':
-            return Token('LAMBDA', result)
+        raise LexError(message, pack(self.file, self.line, min(self.column, MAX_COLUMN)))
+
+    def mismatch(self, char):
+        """Report `char`, at self.line and self.column, which no token starts with."""
+        if char == '&':
+            message = "Expected '&' after '&' for '&&'"
+        elif char == '|':
+            message = "Expected '|' after '|' for '||'"
         else:
-            return Token('VARIABLE', result)
-
-    def number(self):
-        result = ''
-        while self.current_char is not None and self.current_char.isdigit():
-            result += self.current_char
-            self.advance()
-        return Token('INTEGER', int(result))
-
-    def get_next_token(self):
-        while self.current_char is not None:
-
-            if self.current_char.isspace():
-                self.skip_whitespace()
-                continue
-
-            if self.current_char == '#':
-                self.skip_comment()
-                continue
-
-            if self.current_char.isalpha():
-                return self.identifier()
-
-            if self.current_char.isdigit():
-                return self.number()
-
-            if self.current_char == '+':
-                self.advance()
-                if self.current_char == '+':
-                    self.advance()
-                    return Token('PLUSONE', '++')
-                return Token('PLUS', '+')
-
-            if self.current_char == '-':
-                self.advance()
-                if self.current_char == '-':
-                    self.advance()
-                    return Token('MINUSONE', '--')
-                return Token('MINUS', '-')
-
-            if self.current_char == '*':
-                self.advance()
-                return Token('MUL', '*')
-
-            if self.current_char == '/':
-                self.advance()
-                return Token('DIV', '/')
-
-            if self.current_char == '%':
-                self.advance()
-                return Token('MODULO', '%')
-
-            if self.current_char == '=':
-                self.advance()
-                if self.current_char == '=':
-                    self.advance()
-                    return Token('EQEQ', '==')
-                return Token('EQUAL', '=')
-
-            if self.current_char == '!':
-                self.advance()
-                if self.current_char == '=':
-                    self.advance()
-                    return Token('NEQUAL', '!=')
+            message = f"Unexpected character '{char}'"
+        if self.diagnostics is None:
+            self.error(message)
+        self.diagnostics.append(LexError(message, pack(self.file, self.line, self.column)))
+
+    def _beyond_limits(self, line):
+        # Positions have room for MAX_COLUMN columns and MAX_LINE lines
+        self.line, self.column = min(line, MAX_LINE), 1
+        self.error(f"Line {line} is too long or too far, the limits are {MAX_COLUMN} columns and {MAX_LINE} lines")
+
+    def tokens(self):
+        """Yield every token in the text, followed by a single EOF token."""
+        return self.scan_lines(self.text.split('\n'))
+
+    def scan_lines(self, lines, line=1, pos=0):
+        """Tokenize an iterable of lines (without their newlines) numbered from `line`."""
+        keywords = KEYWORDS
+        operators = OPERATORS
+        intern = sys.intern
+        finditer = TOKEN_RE.finditer
+        line -= 1
+        line_text = ''
+        file_bits = self.file << FILE_SHIFT
+        for line_text in lines:
+            line += 1
+            if len(line_text) > MAX_COLUMN or line > MAX_LINE:
+                self._beyond_limits(line)
+            # One int per line; a token's position adds its column to it
+            line_position = file_bits | line << COLUMN_BITS
+            for match in finditer(line_text):
+                kind = match.lastgroup
+                if kind == 'NAME':
+                    name = intern(match.group())
+                    yield Token(keywords.get(name, 'VARIABLE'), name, line_position, match.start() + 1)
+                elif kind == 'OP':
+                    lexeme = match.group()
+                    yield Token(operators[lexeme], lexeme, line_position, match.start() + 1)
+                elif kind == 'INTEGER':
+                    yield Token('INTEGER', int(match.group()), line_position, match.start() + 1)
+                elif kind == 'COMMENT':
+                    break
                 else:
-                    return Token('NOT', '!')
-                self.error()
-
-            if self.current_char == '>':
-                self.advance()
-                if self.current_char == '=':
-                    self.advance()
-                    return Token('GTE', '>=')
-                return Token('GT', '>')
-
-            if self.current_char == '<':
-                self.advance()
-                if self.current_char == '=':
-                    self.advance()
-                    return Token('LTE', '<=')
-                return Token('LT', '<')
-
-            if self.current_char == ',':
-                self.advance()
-                return Token('COMMA', ',')
-
-            if self.current_char == '(':
-                self.advance()
-                return Token('LPAREN', '(')
-
-            if self.current_char == ')':
-                self.advance()
-                return Token('RPAREN', ')')
-
-            if self.current_char == '{':
-                self.advance()
-                return Token('LBRACE', '{')
-
-            if self.current_char == '}':
-                self.advance()
-                return Token('RBRACE', '}')
-
-            if self.current_char == '\n':
-                self.advance()
-                return Token('NEWLINE', '\n')
-            if self.current_char == ':':
-                self.advance()
-                return Token('COLON', ':')
-            if self.current_char == '&':
-                self.advance()
-                if self.current_char == '&':
-                    self.advance()
-                    return Token('AND', '&&')
-                self.error("Expected '&' after '&' for '&&'")
-
-            if self.current_char == '|':
-                self.advance()
-                if self.current_char == '|':
-                    self.advance()
-                    return Token('OR', '||')
-                self.error("Expected '|' after '|' for '||'")
-
-            self.error(f"Unexpected character '{self.current_char}'")
-
-        return Token('EOF', None)
-
-    def peek_next_token(self):
-        # Save the current state
-        current_pos = self.pos
-        current_char = self.current_char
-
-        # Get the next token
-        next_token = self.get_next_token()
-
-        # Restore the state
-        self.pos = current_pos
-        self.current_char = current_char
-
-        return next_token
+                    self.pos, self.line, self.column = pos + match.start(), line, match.start() + 1
+                    self.mismatch(match.group())
+            pos += len(line_text) + 1
+        self.pos, self.line, self.column = pos - 1, max(line, 1), len(line_text) + 1
+        yield Token('EOF', None, pack(self.file, self.line, 0), min(self.column, MAX_COLUMN))
+
+    def scan_buffer(self, buffer):
+        """Tokenize UTF-8 source in a bytes-like buffer, typically an mmap of the file, without copying it.
+
+        Lines are scanned in place between offsets. Names and integers come
+        out as SpanTokens; only keywords and operators, a few bytes each, are
+        copied out to be looked up.
+        """
+        keywords = KEYWORDS
+        bytes_keywords = BYTES_KEYWORDS
+        operators = BYTES_OPERATORS
+        finditer = BYTES_TOKEN_RE.finditer
+        find = buffer.find
+        size = len(buffer)
+        line = 0
+        start = 0
+        while True:
+            end = find(b'\n', start)
+            if end < 0:
+                end = size
+            line += 1
+            if end - start > MAX_COLUMN or line > MAX_LINE:
+                self._beyond_limits(line)
+            line_position = self.file << FILE_SHIFT | line << COLUMN_BITS
+            for match in finditer(buffer, start, end):
+                kind = match.lastgroup
+                if kind == 'NAME':
+                    # Only names as short as a keyword are looked at
+                    token_start, token_end = match.span()
+                    keyword = None
+                    if token_end - token_start <= KEYWORD_MAX_LENGTH:
+                        keyword = bytes_keywords.get(match.group())
+                    if keyword is None:
+                        yield SpanToken('VARIABLE', buffer, token_start, token_end, line_position,
+                                        token_start - start + 1)
+                    else:
+                        yield Token(keywords[keyword], keyword, line_position, token_start - start + 1)
+                elif kind == 'OP':
+                    token_type, lexeme = operators[match.group()]
+                    yield Token(token_type, lexeme, line_position, match.start() - start + 1)
+                elif kind == 'INTEGER':
+                    yield SpanToken('INTEGER', buffer, match.start(), match.end(), line_position,
+                                    match.start() - start + 1)
+                elif kind == 'COMMENT':
+                    break
+                elif kind == 'MISMATCH':
+                    self.pos, self.line, self.column = match.start(), line, match.start() - start + 1
+                    char = bytes(buffer[match.start():match.start() + 1]).decode('latin-1')
+                    self.mismatch(char)
+            if end >= size:
+                break
+            start = end + 1
+        self.pos, self.line, self.column = size, line, size - start + 1
+        yield Token('EOF', None, pack(self.file, line, 0), min(self.column, MAX_COLUMN))
+
+    def scan_file(self, file):
+        """Tokenize a text file or pipe as its lines are read; `self.text` is not used."""
+        return self.scan_lines(line[:-1] if line.endswith('\n') else line for line in file)
+
+    def __iter__(self):
+        return self.tokens()
+
+    def tokenize(self):
+        """Return all tokens, EOF included, as a list."""
+        # Tokens never form reference cycles, so pausing the cyclic GC while
+        # allocating hundreds of thousands of them only saves time
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return list(self.tokens())
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+
+class TokenStream:
+    """Buffered tokens with O(1) lookahead at any distance.
+
+    Wraps a ready token list (used in place) or any token iterator, which is
+    read lazily and compacted as the parser moves past it.
+    """
+
+    # Consumed tokens dropped from a lazily read buffer in one go
+    COMPACT_AFTER = 4096
+
+    def __init__(self, tokens):
+        if isinstance(tokens, list):
+            self.buffer = tokens
+            self.source = None
+        else:
+            self.buffer = []
+            self.source = iter(tokens)
+        self.index = 0
+        self.eof = None
+
+    def peek(self, k=0):
+        """Return the token k positions ahead of the current one."""
+        index = self.index + k
+        if index < len(self.buffer):
+            return self.buffer[index]
+        return self._fill(index)
+
+    def advance(self):
+        """Move past the current token and return the new current token."""
+        if self.index < len(self.buffer):
+            self.index += 1
+            if self.source is not None and self.index >= self.COMPACT_AFTER:
+                del self.buffer[:self.index]
+                self.index = 0
+        return self.peek()
+
+    def _fill(self, index):
+        buffer = self.buffer
+        if self.source is not None:
+            for token in self.source:
+                buffer.append(token)
+                if token.type == 'EOF':
+                    self.source = None
+                    break
+                if index < len(buffer):
+                    return buffer[index]
+            else:
+                self.source = None
+        # Past the end, the stream repeats its EOF
+        if self.eof is None:
+            last = buffer[-1] if buffer else None
+            if last is None:
+                self.eof = Token('EOF', None, pack(0, 1, 0), 1)
+            elif last.type == 'EOF':
+                self.eof = last
+            else:
+                self.eof = Token('EOF', None, last.line_position, last.column)
+        return buffer[index] if index < len(buffer) else self.eof
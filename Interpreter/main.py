@@ -1,55 +1,261 @@
 from lexer import Lexer
-from parser import Parser
-from Interpreter import Interpreter
+from parser import Parser, BlockNode, StatementStream
+from flattree import FlatTree
+from Interpreter import Interpreter, MAX_DEPTH
+from vm import VirtualMachine
+import astcache
+import memo
+from optimizer import Optimizer
+from profiler import Profiler, ProfilingInterpreter
+from repl import ReplSession
+import typecheck
+import check
+import errors
+from control import Cancelled
+import argparse
+import functools
+import mmap
+import os
 import sys
 
 
+# Failures of the program or of its input, reported as `Error: ...`; anything else is a bug and shows its traceback
+REPORTED_ERRORS = (errors.LanguageError, Cancelled, RecursionError, OSError, UnicodeDecodeError)
+
+
 def read_code_from_file(file_path):
     with open(file_path, 'r') as file:
         code = file.read()
     return code
 
 
-def run_code_from_file(file_path):
+def run_stream(tokens, engine=Interpreter, max_depth=MAX_DEPTH, memoizer=None, optimizer=None):
+    """Run a program from a token stream, each top-level statement as soon as it is parsed.
+
+    Only the statement being parsed (and a bounded window of tokens) is held
+    in memory, whatever the size of the program.
+    """
+    statements = Parser(tokens).parse_statements()
+    if optimizer is not None:
+        statements = map(optimizer.optimize, statements)
+    interpreter = engine(None, max_depth=max_depth, memo=memoizer)
+    interpreter.interpret(StatementStream(statements))
+
+
+def run_mapped_file(file_path, engine=Interpreter, max_depth=MAX_DEPTH, memoizer=None, optimizer=None):
+    """Stream a program straight from a read-only memory map of its file; the source is never copied into a str."""
+    with open(file_path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            # An empty file cannot be mapped
+            return run_stream(Lexer('', file_path).scan_buffer(b''), engine, max_depth, memoizer, optimizer)
+        failure = None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            try:
+                run_stream(Lexer('', file_path).scan_buffer(source), engine, max_depth, memoizer, optimizer)
+            except errors.LanguageError as error:
+                # The traceback keeps the lexer, and its view of the map, alive; the map cannot close with it
+                failure = error.with_traceback(None)
+        if failure is not None:
+            raise failure
+
+
+def run_code_from_file(file_path, engine=Interpreter, max_depth=MAX_DEPTH, use_cache=True, memoizer=None,
+                       optimizer=None, flat=False, check_types=False):
     code = read_code_from_file(file_path)
 
-    lexer = Lexer(code)
-    parser = Parser(lexer)
-    interpreter = Interpreter(parser)
-    interpreter.interpret()
+    if use_cache:
+        statements = astcache.parse_file(file_path, code).statements
+    else:
+        statements = Parser(Lexer(code, file_path)).parse_statements()
+    if optimizer is not None:
+        statements = map(optimizer.optimize, statements)
+    report = None
+    if check_types:
+        statements = list(statements)
+        report = typecheck.check(statements)
+        for diagnostic in report.diagnostics:
+            print(f"warning: {diagnostic}", file=sys.stderr)
+    if optimizer is not None and not flat:
+        # Int-only functions run natively, see native.py
+        statements = typecheck.specialize(statements, report)
+    # A flat tree is encoded statement by statement and never held as objects all at once
+    tree = FlatTree.from_statements(statements) if flat else BlockNode(statements)
+    interpreter = engine(None, max_depth=max_depth, memo=memoizer)
+    interpreter.interpret(tree)
 
 
-def run_repl():
+def run_repl(engine=Interpreter, max_depth=MAX_DEPTH, memoizer=None, optimizer=None):
+    session = ReplSession(engine, max_depth, memoizer, optimizer)
     while True:
         try:
-            text = input('New_line> ')
+            text = input(session.prompt)
         except EOFError:
             break
-        if not text:
+        if not text and not session.pending:
             continue
 
-        lexer = Lexer(text)
-        parser = Parser(lexer)
-        interpreter = Interpreter(parser)
-        result = interpreter.interpret()
+        try:
+            tree = session.push(text)
+            if tree is None:
+                continue
+            result = session.run(tree)
+        except REPORTED_ERRORS as error:
+            print(f"Error: {describe_error(error)}")
+            continue
+        # Results were printed by the engine
         if result is None:
             print("Command executed")
-        else:
-            print(result)
+
+
+def run_check(target, jobs=None):
+    """Print every syntax error in `target`, a .lambda file or a directory of them, without running anything.
+
+    Returns the exit status: 1 when an error was found.
+    """
+    try:
+        files = check.collect_files([target])
+    except OSError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        return 1
+    found = failed = 0
+    for file_path, messages in check.check_files(files, jobs):
+        for message in messages:
+            print(message)
+        if messages:
+            found += len(messages)
+            failed += 1
+    print(f"{len(files)} files checked: {found} errors in {failed} files", file=sys.stderr)
+    return 1 if found else 0
+
+
+def describe_error(error):
+    if isinstance(error, RecursionError):
+        # Raised outside the engines, which report it the same way: parsing, optimizing or checking deep nesting
+        return "Maximum nesting depth exceeded"
+    return str(error)
+
+
+def print_error(error):
+    """Print an error to stderr, after the calls that led to it when it happened inside a function."""
+    if isinstance(error, errors.RuntimeError) and len(error.trace) > 1:
+        for line in error.format_trace():
+            print(line, file=sys.stderr)
+    print(f"Error: {describe_error(error)}", file=sys.stderr)
+
+
+def print_stats(memoizer, optimizer):
+    if optimizer is not None:
+        print(f"optimizer: eliminated {optimizer.eliminated} of {optimizer.nodes_before} nodes", file=sys.stderr)
+    if memoizer is None:
+        return
+    for name, counters in sorted(memoizer.stats().items()):
+        print(f"memo {name}: {counters['hits']} hits, {counters['misses']} misses, {counters['size']} cached",
+              file=sys.stderr)
+
+
+def print_profile(profiler, stacks_path=None):
+    profiler.report(sys.stderr)
+    if stacks_path:
+        with open(stacks_path, 'w') as stacks:
+            profiler.write_collapsed(stacks)
+
+
+def add_engine_arguments(arg_parser):
+    """Options choosing how programs run, shared with batch.py."""
+    arg_parser.add_argument('--vm', action='store_true',
+                            help='compile to bytecode and run on the stack VM instead of the tree walker')
+    arg_parser.add_argument('--max-depth', type=int, default=MAX_DEPTH,
+                            help=f'limit on nested (non-tail) calls, default {MAX_DEPTH}')
+    arg_parser.add_argument('--max-steps', type=int, default=None, metavar='N',
+                            help='stop a program after N steps (function calls, operators and sequence items)')
+    arg_parser.add_argument('--no-cache', action='store_true',
+                            help=f'always re-parse instead of using the {astcache.CACHE_DIR} directory')
+    arg_parser.add_argument('--memo', action='store_true', help='cache the results of pure functions')
+    arg_parser.add_argument('--memo-size', type=int, default=memo.DEFAULT_SIZE, metavar='N',
+                            help=f'results kept per memoized function, default {memo.DEFAULT_SIZE}')
+    arg_parser.add_argument('-O', '--optimize', action='store_true',
+                            help='fold constants and simplify the program before running it, and run functions '
+                                 'only ever called with ints as native Python code')
+    arg_parser.add_argument('--flat', action='store_true',
+                            help='hold the parsed program as a compact flat tree, for very large programs')
 
 
 def main():
-    if len(sys.argv) > 1:
-        file_path = sys.argv[1]
+    arg_parser = argparse.ArgumentParser(description='Run a .lambda program, or start the REPL when no file is given.')
+    arg_parser.add_argument('file', nargs='?', help="path to a .lambda program, or '-' to read one from stdin")
+    add_engine_arguments(arg_parser)
+    arg_parser.add_argument('--stream', action='store_true',
+                            help='run each statement as soon as it is read instead of parsing the whole file first')
+    arg_parser.add_argument('--mmap', action='store_true',
+                            help='like --stream, but lex the memory-mapped file in place, for very large programs')
+    arg_parser.add_argument('--stats', action='store_true',
+                            help='print optimizer and memoization statistics to stderr')
+    arg_parser.add_argument('--typecheck', action='store_true',
+                            help='print type and arity mismatches found before running the program to stderr')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='print per-function call counts and times, and the hottest call sites, to stderr')
+    arg_parser.add_argument('--profile-stacks', metavar='FILE',
+                            help='with --profile, write collapsed stacks for flamegraph tools to FILE')
+    arg_parser.add_argument('--check', action='store_true',
+                            help='report every syntax error in the file, or in each .lambda file under a directory, '
+                                 'without running anything')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='with --check, number of processes checking files, default one per CPU')
+    args = arg_parser.parse_args()
+
+    if args.check:
+        if args.file in (None, '-'):
+            arg_parser.error('--check needs a .lambda file or a directory')
+        sys.exit(run_check(args.file, args.jobs))
+
+    engine = VirtualMachine if args.vm else Interpreter
+    profiler = None
+    if args.profile or args.profile_stacks:
+        if args.vm:
+            arg_parser.error('--profile runs on the tree-walking interpreter and cannot be combined with --vm')
+        profiler = Profiler()
+        engine = functools.partial(ProfilingInterpreter, profiler=profiler)
+    if args.max_steps is not None:
+        engine = functools.partial(engine, max_steps=args.max_steps)
+    memoizer = memo.Memoizer(args.memo_size) if args.memo else None
+    optimizer = Optimizer() if args.optimize else None
+    if args.typecheck and (args.file in (None, '-') or args.stream or args.mmap):
+        arg_parser.error('--typecheck needs a whole program file and cannot be combined with --stream or --mmap')
+    if args.file:
         # Check if the file ends with .lambda
-        if not file_path.endswith('.lambda'):
+        if args.file != '-' and not args.file.endswith('.lambda'):
             print("Error: The file must have a .lambda extension.")
             sys.exit(1)
-        run_code_from_file(file_path)
+        try:
+            if args.file == '-' or args.stream or args.mmap:
+                # Results show up as they are produced, even through a pipe
+                sys.stdout.reconfigure(line_buffering=True)
+                if args.file == '-':
+                    run_stream(Lexer('', '<stdin>').scan_file(sys.stdin), engine, args.max_depth, memoizer, optimizer)
+                elif args.mmap:
+                    run_mapped_file(args.file, engine, args.max_depth, memoizer, optimizer)
+                else:
+                    with open(args.file, 'r') as file:
+                        run_stream(Lexer('', args.file).scan_file(file), engine, args.max_depth, memoizer,
+                                   optimizer)
+            else:
+                run_code_from_file(args.file, engine, args.max_depth, not args.no_cache, memoizer, optimizer,
+                                   args.flat, args.typecheck)
+        except REPORTED_ERRORS as error:
+            print_error(error)
+            sys.exit(1)
+        finally:
+            if args.stats:
+                print_stats(memoizer, optimizer)
+            if profiler is not None:
+                print_profile(profiler, args.profile_stacks)
     else:
-        run_repl()
+        run_repl(engine, args.max_depth, memoizer, optimizer)
+        if args.stats:
+            print_stats(memoizer, optimizer)
+        if profiler is not None:
+            print_profile(profiler, args.profile_stacks)
 
 
 if __name__ == '__main__':
-    run_code_from_file('/Users/ariguterman/Documents/School/Second year/Second semester/Programming Languages/Interpreter project/Interpreter/program_test.lambda')
-    #main()
+    main()
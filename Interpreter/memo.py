@@ -0,0 +1,147 @@
+# memo.py
+
+"""Opt-in memoization of pure defun functions.
+
+A function is pure when its body only reads its own parameters, does
+arithmetic and comparisons, branches with `if`, and calls other pure
+functions. Such a function returns the same value for the same arguments, so
+its results can be kept in a bounded LRU table keyed by the argument tuple.
+"""
+
+from collections import OrderedDict
+from parser import (
+    Var, LocalVar, Num, Boolean, BinOp, Operation, UnaryOp, IfNode, BlockNode, ReturnNode, FunctionCallNode,
+)
+
+DEFAULT_SIZE = 4096
+
+# Returned by LRUCache.get on a miss, since None is a valid cached result
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # Memoizer generation at which the entries were last known valid
+
+    def get(self, key, default=MISSING):
+        entries = self.entries
+        if key in entries:
+            entries.move_to_end(key)
+            self.hits += 1
+            return entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        entries = self.entries
+        entries[key] = value
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+
+def _is_locally_pure(node, params, called):
+    if isinstance(node, (Num, Boolean)) or node is None:
+        return True
+    if isinstance(node, (Var, LocalVar)):
+        return node.name in params
+    if isinstance(node, (BinOp, Operation)):
+        return _is_locally_pure(node.left, params, called) and _is_locally_pure(node.right, params, called)
+    if isinstance(node, UnaryOp):
+        return _is_locally_pure(node.expr, params, called)
+    if isinstance(node, IfNode):
+        return (_is_locally_pure(node.condition, params, called)
+                and _is_locally_pure(node.block, params, called)
+                and _is_locally_pure(node.else_block, params, called))
+    if isinstance(node, BlockNode):
+        return all(_is_locally_pure(statement, params, called) for statement in node.statements)
+    if isinstance(node, ReturnNode):
+        return _is_locally_pure(node.expr, params, called)
+    if isinstance(node, FunctionCallNode):
+        # Calling a parameter means calling a lambda value we know nothing about
+        if node.name in params:
+            return False
+        called.add(node.name)
+        return all(_is_locally_pure(arg, params, called) for arg in node.args)
+    # Globals, assignments, lambdas and nested defuns
+    return False
+
+
+class Memoizer:
+    """Per-function LRU tables for the pure functions of one interpreter.
+
+    Purity is worked out lazily, per called function, over the functions it
+    can reach, so defining a function costs the same however many are
+    already defined.
+    """
+
+    def __init__(self, maxsize=DEFAULT_SIZE):
+        self.maxsize = maxsize
+        self.caches = {}
+        self.generation = 0  # bumped by every definition
+        self._tables = {}    # name -> LRU table or None, for functions looked up since the last definition
+        self._local = {}     # name -> (node, names it calls, or None when not locally pure)
+        self._defined = {}   # name -> generation of its latest definition
+        self._cleared = 0    # generation of the last invalidate() of every function
+
+    def invalidate(self, name=None):
+        """Forget purity results; called whenever function `name` (None: any function) is (re)defined."""
+        self.generation += 1
+        self._tables = {}
+        if name is None:
+            self._local.clear()
+            self._cleared = self.generation
+        else:
+            self._defined[name] = self.generation
+
+    def table_for(self, name, functions):
+        """The LRU table of function `name`, or None when it is not pure."""
+        table = self._tables.get(name, MISSING)
+        if table is MISSING:
+            table = self._tables[name] = self._table(name, functions)
+        return table
+
+    def _table(self, name, functions):
+        # Pure when every function reachable through calls is defined and locally pure
+        reachable = {name}
+        pending = [name]
+        newest = self._cleared
+        while pending:
+            current = pending.pop()
+            func = functions.get(current)
+            if func is None:
+                return None
+            # `functions` may hold compiled functions that keep their FunctionDecNode as .node
+            called = self._locally_pure(current, getattr(func, 'node', func))
+            if called is None:
+                return None
+            newest = max(newest, self._defined.get(current, 0))
+            for callee in called:
+                if callee not in reachable:
+                    reachable.add(callee)
+                    pending.append(callee)
+
+        cache = self.caches.get(name)
+        if cache is None:
+            cache = self.caches[name] = LRUCache(self.maxsize)
+        elif cache.generation < newest:
+            # Old results may depend on a replaced definition; the counters are kept
+            cache.entries.clear()
+        cache.generation = self.generation
+        return cache
+
+    def _locally_pure(self, name, func_def):
+        entry = self._local.get(name)
+        if entry is None or entry[0] is not func_def:
+            params = {param.name for param in func_def.params}
+            called = set()
+            entry = self._local[name] = (func_def, called if _is_locally_pure(func_def.block, params, called) else None)
+        return entry[1]
+
+    def stats(self):
+        """{function name: {'hits', 'misses', 'size'}} for every function that was memoized."""
+        return {name: {'hits': cache.hits, 'misses': cache.misses, 'size': len(cache.entries)}
+                for name, cache in self.caches.items() if cache.hits or cache.misses}
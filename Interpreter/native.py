@@ -0,0 +1,110 @@
+# native.py
+
+"""Int-only defuns (see typecheck.py) run as Python code.
+
+A defun marked int_only is translated, together with the int-only defuns it
+calls, into Python functions, once per engine and set of definitions. A call
+then costs one Python call instead of an interpreted frame, and the
+operators are applied without going through the engine.
+
+The translation keeps the engines' limit on nested calls: every function
+counts down a shared depth cell, set to what the engine has left before each
+call from the engine. Steps cannot be counted and results cannot be
+memoized, so the engines only take this path with neither a step budget, a
+Control nor a Memoizer, and with exactly as many arguments as parameters.
+
+Translated code keeps no positions. When a call fails, the engine runs it
+again interpreted, with rerun(), so the error is reported where it happened
+and with the calls that led to it; int-only functions only compute, so
+running them twice changes nothing else.
+"""
+
+import sys
+
+from parser import FunctionDecNode
+from operators import divide, modulo
+from memo import MISSING
+from sequences import translate
+import errors
+
+# Python frames one translated call uses, to size the host recursion limit
+PYTHON_FRAMES_PER_CALL = 2
+
+
+class NativeFunction:
+    """What the VM defines for an int-only defun: its compiled Function, callable natively."""
+
+    def __init__(self, function):
+        self.function = function  # the bytecode.Function
+        self.name = function.name
+        self.params = function.params
+        self.node = function.node
+
+
+def _too_deep(max_depth, name):
+    raise errors.RuntimeError(f"Maximum recursion depth of {max_depth} exceeded in '{name}'")
+
+
+def build(func_def, functions, max_depth):
+    """(Python function, depth cell) running `func_def` with `functions` (name -> definition), or None."""
+    names = {}  # defun name -> Python function name, for every defun reached
+    bodies = []
+    pending = [func_def]
+
+    def call(node, args):
+        callee = functions.get(node.name)
+        callee = getattr(callee, 'node', callee)
+        # Definitions may have changed since the program was checked
+        if type(callee) is not FunctionDecNode or not callee.int_only or len(args) != len(callee.params):
+            return None
+        if callee.name not in names:
+            names[callee.name] = f'_f{len(names)}'
+            pending.append(callee)
+        return f"{names[callee.name]}({', '.join(args)})"
+
+    names[func_def.name] = '_f0'
+    while pending:
+        current = pending.pop()
+        body = translate(current.block, call)
+        if body is None:
+            return None
+        params = ', '.join(f's{slot}' for slot in range(len(current.params)))
+        bodies.append(f'def {names[current.name]}({params}):\n'
+                      f'    if _depth[0] <= 0:\n'
+                      f'        _too_deep({max_depth}, {current.name!r})\n'
+                      f'    _depth[0] -= 1\n'
+                      f'    result = {body}\n'
+                      f'    _depth[0] += 1\n'
+                      f'    return result\n')
+    depth = [max_depth]
+    namespace = {'_depth': depth, '_too_deep': _too_deep, '_divide': divide, '_modulo': modulo}
+    exec('\n'.join(bodies), namespace)
+    limit = max_depth * PYTHON_FRAMES_PER_CALL + 1000
+    if sys.getrecursionlimit() < limit:
+        sys.setrecursionlimit(limit)
+    return namespace['_f0'], depth
+
+
+def compiled(engine, func_def, argc, depth):
+    """The Python function for calling int-only `func_def` from `engine` with `argc` arguments and `depth`
+    nested calls left, or None when the call has to be interpreted."""
+    if engine.natives is None or engine.fuel is not None or engine.memo is not None or argc != len(func_def.params):
+        return None
+    native = engine.natives.get(func_def, MISSING)
+    if native is MISSING:
+        native = engine.natives[func_def] = build(func_def, engine.env.functions, engine.max_depth)
+    if native is None:
+        return None
+    function, cell = native
+    cell[0] = depth
+    return function
+
+
+def rerun(engine, call, *args):
+    """`call(*args)` with native execution turned off in `engine`, to report an error native code raised."""
+    natives = engine.natives
+    engine.natives = None
+    try:
+        return call(*args)
+    finally:
+        engine.natives = natives
@@ -0,0 +1,43 @@
+# operators.py
+
+"""The functions computing binary operators, keyed by the operator's token type.
+
+The resolver turns each BinOp it can into an Operation holding its function,
+so the operator is looked up once per node instead of on every evaluation;
+the optimizer folds constants with the same functions. `&&` and `||` are not
+here: they stay BinOps, which evaluate their right side only when it decides
+the result.
+"""
+
+import operator
+
+import errors
+
+
+def divide(left, right):
+    if right == 0:
+        raise errors.RuntimeError("Division by zero error")
+    return left // right
+
+
+def modulo(left, right):
+    if right == 0:
+        raise errors.RuntimeError("Modulo by zero error")
+    return left % right
+
+
+BINARY_HANDLERS = {
+    'PLUS': operator.add,
+    'MINUS': operator.sub,
+    'MUL': operator.mul,
+    'DIV': divide,
+    'MODULO': modulo,
+    'EQEQ': operator.eq,
+    'NEQUAL': operator.ne,
+    'GT': operator.gt,
+    'LT': operator.lt,
+    'GTE': operator.ge,
+    'LTE': operator.le,
+}
+
+SHORT_CIRCUIT = ('AND', 'OR')
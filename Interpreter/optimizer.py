@@ -0,0 +1,143 @@
+# optimizer.py
+
+"""Constant folding and algebraic simplification between Parser.parse and Interpreter.interpret.
+
+The pass never removes a runtime error: division by zero and operators the
+interpreter does not support are left in the tree to fail when evaluated.
+Identities such as `x * 1` and `x + 0` only hold when `x` is an integer
+(`true * 1` is 1, and `s + 0` fails for a sequence `s`), so they are only
+applied when `x` is known to be one: an integer literal or the result of an
+arithmetic operator.
+"""
+
+from parser import (
+    AST, Num, Boolean, TRUE, FALSE, BinOp, UnaryOp, IfNode, BlockNode, ReturnNode, Assign,
+    FunctionCallNode, FunctionDecNode, LambdaNode,
+)
+from operators import BINARY_HANDLERS
+
+FOLDABLE = dict(
+    BINARY_HANDLERS,
+    # Both sides are constants when folding, so nothing is left to short-circuit
+    AND=lambda left, right: left and right,
+    OR=lambda left, right: left or right,
+)
+
+# Operators whose result is always an int, when they do not fail
+ARITHMETIC = ('PLUS', 'MINUS', 'MUL', 'DIV', 'MODULO')
+
+
+def is_constant(node):
+    return isinstance(node, (Num, Boolean))
+
+
+def make_constant(value):
+    if type(value) is bool:
+        return TRUE if value else FALSE
+    return Num(value)
+
+
+def is_int(node, value):
+    return isinstance(node, Num) and node.value == value
+
+
+def is_known_int(node):
+    return (isinstance(node, Num)
+            or (isinstance(node, BinOp) and node.op in ARITHMETIC)
+            or (isinstance(node, UnaryOp) and node.op in ('MINUS', 'PLUS')))
+
+
+def count_nodes(node):
+    """Number of AST nodes (literals included) under `node`."""
+    if isinstance(node, tuple):
+        return sum(count_nodes(child) for child in node)
+    if not isinstance(node, AST):
+        return 0
+    return 1 + sum(count_nodes(getattr(node, name)) for name in node.__slots__)
+
+
+class Optimizer:
+    def __init__(self):
+        self.nodes_before = 0
+        self.nodes_after = 0
+
+    @property
+    def eliminated(self):
+        return self.nodes_before - self.nodes_after
+
+    def optimize(self, tree):
+        """Return an optimized copy of `tree`; the original is left untouched."""
+        self.nodes_before += count_nodes(tree)
+        tree = self.visit(tree)
+        self.nodes_after += count_nodes(tree)
+        return tree
+
+    def visit(self, node):
+        method = getattr(self, f'visit_{type(node).__name__}', None)
+        return method(node) if method is not None else node
+
+    def visit_BlockNode(self, node):
+        return BlockNode([self.visit(statement) for statement in node.statements])
+
+    def visit_ReturnNode(self, node):
+        return ReturnNode(self.visit(node.expr))
+
+    def visit_Assign(self, node):
+        return Assign(node.variable, self.visit(node.expr))
+
+    def visit_FunctionDecNode(self, node):
+        return FunctionDecNode(node.name, node.params, self.visit(node.block), node.local_names, node.position,
+                               node.int_only)
+
+    def visit_FunctionCallNode(self, node):
+        return FunctionCallNode(node.name, [self.visit(arg) for arg in node.args], node.slot, node.position)
+
+    def visit_LambdaNode(self, node):
+        arg = [self.visit(arg) for arg in node.arg] if node.arg is not None else None
+        return LambdaNode(node.params, self.visit(node.expr), arg, node.local_names, node.captures)
+
+    def visit_IfNode(self, node):
+        condition = self.visit(node.condition)
+        block = self.visit(node.block)
+        else_block = self.visit(node.else_block) if node.else_block is not None else None
+        if is_constant(condition):
+            # The taken branch evaluates exactly like the if would; no branch means None
+            if condition.value:
+                return block
+            return else_block if else_block is not None else BlockNode([])
+        return IfNode(condition, block, else_block)
+
+    def visit_UnaryOp(self, node):
+        expr = self.visit(node.expr)
+        if is_constant(expr):
+            value = expr.value
+            if node.op == 'NOT':
+                return make_constant(not value)
+            if node.op == 'MINUS':
+                return make_constant(-value)
+            if node.op == 'PLUS':
+                return make_constant(+value)
+        return UnaryOp(node.op, expr, node.position)
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        op = node.op
+
+        if is_constant(left) and is_constant(right) and op in FOLDABLE:
+            if not (op in ('DIV', 'MODULO') and right.value == 0):
+                return make_constant(FOLDABLE[op](left.value, right.value))
+
+        # x + 0, 0 + x, x - 0, x * 1, 1 * x, x / 1
+        if is_known_int(left):
+            if (op in ('PLUS', 'MINUS') and is_int(right, 0)) or (op in ('MUL', 'DIV') and is_int(right, 1)):
+                return left
+        if is_known_int(right):
+            if (op == 'PLUS' and is_int(left, 0)) or (op == 'MUL' and is_int(left, 1)):
+                return right
+
+        # true && e and false || e both evaluate to e
+        if isinstance(left, Boolean) and ((op == 'AND' and left.value) or (op == 'OR' and not left.value)):
+            return right
+
+        return BinOp(left, node.op, right, node.position)
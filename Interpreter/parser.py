@@ -1,95 +1,230 @@
+from lexer import Lexer, TokenStream
+from errors import ParseError
+
+
 class AST(object):
-    pass
+    """Base of the AST nodes.
+
+    Nodes keep their fields in __slots__ and are immutable once built: passes
+    such as the resolver and the optimizer return new nodes instead of editing
+    them. The constructor arguments follow __slots__ order, which pickling and
+    flattree rely on.
+
+    Nodes an error can be raised at (calls, variable reads and operators) and
+    defuns end with a `position`, see errors.pack; it is None for nodes built
+    by other passes from nothing.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"'{type(self).__name__}' nodes are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"'{type(self).__name__}' nodes are immutable")
+
+    def __reduce__(self):
+        return type(self), tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+# Nodes set their fields once, in __init__, through object.__setattr__
+_set = object.__setattr__
 
 
 class LambdaNode(AST):
-    def __init__(self, params, expr, arg):
-        self.params = params
-        self.expr = expr
-        self.arg = arg
+    __slots__ = ('params', 'expr', 'arg', 'local_names', 'captures')
+
+    def __init__(self, params, expr, arg, local_names=None, captures=None):
+        _set(self, 'params', tuple(params))
+        _set(self, 'expr', expr)
+        _set(self, 'arg', tuple(arg) if arg is not None else None)
+        # Frame slot -> name, set by the resolver: parameters, captured names, then assigned names
+        _set(self, 'local_names', tuple(local_names) if local_names is not None else None)
+        # Slots of the enclosing frame copied into the closure, in local_names order, set by the resolver
+        _set(self, 'captures', tuple(captures) if captures is not None else None)
 
 
 class FunctionCallNode(AST):
-    def __init__(self, name, args):
-        if isinstance(name, Var):
-            self.name = name.name
-        else:
-            self.name = name
-        self.args = args
+    __slots__ = ('name', 'args', 'slot', 'position')
+
+    def __init__(self, name, args, slot=None, position=None):
+        _set(self, 'name', name.name if isinstance(name, Var) else name)
+        _set(self, 'args', tuple(args))
+        _set(self, 'slot', slot)  # frame slot when the name is a local, set by the resolver
+        _set(self, 'position', position)
 
 
 class FunctionDecNode(AST):
-    def __init__(self, name, params, block):
-        self.name = name
-        self.params = params
-        self.block = block
+    __slots__ = ('name', 'params', 'block', 'local_names', 'position', 'int_only')
+
+    def __init__(self, name, params, block, local_names=None, position=None, int_only=False):
+        _set(self, 'name', name)
+        _set(self, 'params', tuple(params))
+        _set(self, 'block', block)
+        # Frame slot -> name, set by the resolver
+        _set(self, 'local_names', tuple(local_names) if local_names is not None else None)
+        _set(self, 'position', position)  # of the `defun`
+        # Only ever called with ints, and simple enough to run as Python code, set by typecheck.specialize
+        _set(self, 'int_only', int_only)
 
 
 class ReturnNode(AST):
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
-        self.expr = expr
+        _set(self, 'expr', expr)
 
 
-class Assign:
+class Assign(AST):
+    __slots__ = ('variable', 'expr')
+
     def __init__(self, variable, expr):
-        self.variable = variable
-        self.expr = expr
+        _set(self, 'variable', variable)
+        _set(self, 'expr', expr)
+
 
+class Var(AST):
+    __slots__ = ('name', 'position')
 
-class Var:
-    def __init__(self, name):
-        self.name = name
+    def __init__(self, name, position=None):
+        _set(self, 'name', name)
+        _set(self, 'position', position)
+
+
+class LocalVar(AST):
+    """A variable read resolved to a slot of the current frame."""
+    __slots__ = ('name', 'slot', 'position')
+
+    def __init__(self, name, slot, position=None):
+        _set(self, 'name', name)
+        _set(self, 'slot', slot)
+        _set(self, 'position', position)
+
+
+class GlobalVar(AST):
+    """A variable read resolved to a module-level slot."""
+    __slots__ = ('name', 'slot', 'position')
+
+    def __init__(self, name, slot, position=None):
+        _set(self, 'name', name)
+        _set(self, 'slot', slot)
+        _set(self, 'position', position)
+
+
+class LocalAssign(AST):
+    __slots__ = ('name', 'slot', 'expr')
+
+    def __init__(self, name, slot, expr):
+        _set(self, 'name', name)
+        _set(self, 'slot', slot)
+        _set(self, 'expr', expr)
+
+
+class GlobalAssign(AST):
+    __slots__ = ('name', 'slot', 'expr')
+
+    def __init__(self, name, slot, expr):
+        _set(self, 'name', name)
+        _set(self, 'slot', slot)
+        _set(self, 'expr', expr)
 
 
 class Boolean(AST):
-    def __init__(self, token):
-        self.token = token
-        self.value = token.value == 'true'
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        _set(self, 'value', value)
+
+
+class Num(AST):
+    __slots__ = ('value',)
 
+    def __init__(self, value):
+        _set(self, 'value', value)
 
 
 class BinOp(AST):
-    def __init__(self, left, op, right):
-        self.left = left
-        self.token = self.op = op
-        self.right = right
+    """`op` is the operator's token type ('PLUS', 'EQEQ', ...), an interned string."""
+    __slots__ = ('left', 'op', 'right', 'position')
 
+    def __init__(self, left, op, right, position=None):
+        _set(self, 'left', left)
+        _set(self, 'op', op)
+        _set(self, 'right', right)
+        _set(self, 'position', position)  # of the operator
 
-class BlockNode:
-    def __init__(self, statements):
-        self.statements = statements
 
+class Operation(AST):
+    """A BinOp resolved to the function computing it (see operators.BINARY_HANDLERS), set by the resolver."""
+    __slots__ = ('left', 'op', 'right', 'handler', 'position')
 
-class Num(AST):
-    def __init__(self, token):
-        self.token = token
-        self.value = token.value
+    def __init__(self, left, op, right, handler, position=None):
+        _set(self, 'left', left)
+        _set(self, 'op', op)
+        _set(self, 'right', right)
+        _set(self, 'handler', handler)
+        _set(self, 'position', position)
+
+
+class BlockNode(AST):
+    __slots__ = ('statements',)
+
+    def __init__(self, statements):
+        _set(self, 'statements', tuple(statements))
 
 
 class UnaryOp(AST):
-    def __init__(self, op, expr):
-        self.token = self.op = op
-        self.expr = expr
+    __slots__ = ('op', 'expr', 'position')
+
+    def __init__(self, op, expr, position=None):
+        _set(self, 'op', op)
+        _set(self, 'expr', expr)
+        _set(self, 'position', position)
 
 
 class IfNode(AST):
+    __slots__ = ('condition', 'block', 'else_block')
+
     def __init__(self, condition, block, else_block):
-        self.condition = condition
-        self.block = block
-        self.else_block = else_block
+        _set(self, 'condition', condition)
+        _set(self, 'block', block)
+        _set(self, 'else_block', else_block)
+
+
+class StatementStream:
+    """Top-level statements produced lazily, under the `statements` name a BlockNode uses.
+
+    The engines run each statement as it is produced, so a program read with
+    Lexer.scan_file starts running before the rest of it has been read.
+    """
+
+    def __init__(self, statements):
+        self.statements = statements
+
+
+# Parsed literals are shared: the nodes are immutable
+TRUE = Boolean(True)
+FALSE = Boolean(False)
 
 
 class Parser(object):
-    def __init__(self, lexer):
-        self.lexer = lexer
-        self.current_token = self.lexer.get_next_token()
+    def __init__(self, source):
+        """`source` is a Lexer, a TokenStream, or a list / iterator of tokens."""
+        if isinstance(source, Lexer):
+            source = source.tokenize()
+        self.tokens = source if isinstance(source, TokenStream) else TokenStream(source)
+        self.current_token = self.tokens.peek()
+        self.diagnostics = None  # the ParseErrors recovered from, while parse_recovering() runs
 
     def error(self, message="Invalid syntax"):
-        raise Exception(message)
+        raise ParseError(message, self.current_token.position)
 
     def eat(self, token_type):
         if self.current_token.type == token_type:
-            self.current_token = self.lexer.get_next_token()
+            self.current_token = self.tokens.advance()
         else:
             self.error(f"Expected token {token_type}, but got {self.current_token.type} instead.")
 
@@ -107,35 +242,34 @@ class Parser(object):
         token = self.current_token
         if token.type == 'PLUS':
             self.eat('PLUS')
-            node = UnaryOp(token, self.factor())
+            node = UnaryOp(token.type, self.factor(), token.position)
             return node
         elif token.type == 'MINUS':
             self.eat('MINUS')
-            node = UnaryOp(token, self.factor())
+            node = UnaryOp(token.type, self.factor(), token.position)
             return node
         elif token.type == 'NOT':
             self.eat('NOT')
-            node = UnaryOp(token, self.factor())
+            node = UnaryOp(token.type, self.factor(), token.position)
             return node
         elif token.type == 'INTEGER':
             self.eat('INTEGER')
-            return token.value
+            return Num(token.value)
         elif token.type == 'LPAREN':
             self.eat('LPAREN')
             node = self.expr()
             self.eat('RPAREN')
             return node
         elif token.type == 'BOOLEAN':
-            node = Boolean(token)
             self.eat('BOOLEAN')
-            return node
+            return TRUE if token.value == 'true' else FALSE
         elif token.type == 'VARIABLE':
             var_name = token.value
             self.eat('VARIABLE')
             if self.current_token.type == 'LPAREN':
-                return self.function_call(var_name)
+                return self.function_call(var_name, token.position)
             else:
-                return Var(var_name)
+                return Var(var_name, token.position)
         elif token.type == 'IF':
             node = self.ifStatement()
             return node
@@ -163,7 +297,7 @@ class Parser(object):
             elif token.type == 'OR':
                 self.eat('OR')
 
-            node = BinOp(left=node, op=token, right=self.factor())
+            node = BinOp(left=node, op=token.type, right=self.factor(), position=token.position)
 
         return node
 
@@ -182,7 +316,7 @@ class Parser(object):
         while self.current_token.type in ('PLUS', 'MINUS', 'EQEQ', 'NEQUAL', 'GT', 'LT', 'GTE', 'LTE', 'AND', 'OR'):
             token = self.current_token
             self.eat(token.type)
-            node = BinOp(left=node, op=token, right=self.term())
+            node = BinOp(left=node, op=token.type, right=self.term(), position=token.position)
 
         return node
 
@@ -203,10 +337,10 @@ class Parser(object):
             return self.function_declaration()
 
         elif token.type == 'VARIABLE':
-            next_token = self.lexer.peek_next_token()
+            next_token = self.tokens.peek(1)
             if next_token.type == 'LPAREN':
                 self.eat('VARIABLE')
-                return self.function_call(token.value)
+                return self.function_call(token.value, token.position)
             elif next_token.type == 'EQUAL':
                 return self.assignment_statement()
             else:
@@ -245,7 +379,12 @@ class Parser(object):
         """block : (statement NEWLINE)*"""
         statements = []
         while self.current_token.type != 'RBRACE' and self.current_token.type != 'EOF':
-            statement = self.statement()
+            if self.diagnostics is None:
+                statement = self.statement()
+            else:
+                statement = self.recovering_statement()
+                if statement is None:
+                    continue
             statements.append(statement)
             if self.current_token.type == 'NEWLINE':
                 self.eat('NEWLINE')
@@ -279,6 +418,7 @@ class Parser(object):
         """
         function_declaration : DEFUN VARIABLE LPAREN parameters RPAREN LBRACE block RBRACE
         """
+        position = self.current_token.position
         self.eat('DEFUN')
         name = self.current_token.value
         self.eat('VARIABLE')
@@ -289,16 +429,16 @@ class Parser(object):
         block = self.block()
         self.eat('RBRACE')
 
-        return FunctionDecNode(name=name, params=params, block=block)
+        return FunctionDecNode(name=name, params=params, block=block, position=position)
 
-    def function_call(self, func_name):
+    def function_call(self, func_name, position=None):
         """
         function_call : VARIABLE LPAREN arguments RPAREN
         """
         self.eat('LPAREN')
         args = self.arguments()
         self.eat('RPAREN')
-        return FunctionCallNode(name=func_name, args=args)
+        return FunctionCallNode(name=func_name, args=args, position=position)
 
     def lambda_function(self):
         """
@@ -328,12 +468,58 @@ class Parser(object):
             return LambdaNode(params=params, expr=expr,arg=arg)
         return LambdaNode(params=params, expr=expr,arg=None)
 
+    def parse_statements(self):
+        """Yield the top-level statements one at a time, as they are parsed."""
+        while self.current_token.type != 'EOF':
+            if self.current_token.type == 'NEWLINE':
+                self.eat('NEWLINE')
+                continue
+            yield self.statement()
+
     def parse(self):
+        return BlockNode(self.parse_statements())
+
+    def parse_recovering(self):
+        """Parse the whole program, going on after syntax errors instead of stopping at the first one.
+
+        Returns a BlockNode of the statements that parsed, function bodies and
+        if blocks keeping whatever parsed in them, and the list of ParseErrors
+        in source order. The lexer emits no NEWLINE tokens, so a statement that
+        fails is skipped up to the next line, the closing brace of its block or
+        a defun, outside of any braces opened on the way.
+        """
+        self.diagnostics = []
         statements = []
         while self.current_token.type != 'EOF':
             if self.current_token.type == 'NEWLINE':
                 self.eat('NEWLINE')
                 continue
-            statement = self.statement()
-            statements.append(statement)
-        return BlockNode(statements)
+            statement = self.recovering_statement(top_level=True)
+            if statement is not None:
+                statements.append(statement)
+        return BlockNode(statements), self.diagnostics
+
+    def recovering_statement(self, top_level=False):
+        """A statement, or None after recording its ParseError and skipping the rest of it."""
+        try:
+            return self.statement()
+        except ParseError as error:
+            self.diagnostics.append(error)
+        line = self.current_token.line_position
+        depth = 0
+        while self.current_token.type != 'EOF':
+            token = self.current_token
+            if depth == 0:
+                if token.type == 'DEFUN' or token.line_position != line:
+                    break
+                if token.type == 'RBRACE':
+                    # It closes the enclosing block, if there is one
+                    if top_level:
+                        self.current_token = self.tokens.advance()
+                    break
+            if token.type == 'LBRACE':
+                depth += 1
+            elif token.type == 'RBRACE':
+                depth -= 1
+            self.current_token = self.tokens.advance()
+        return None
@@ -0,0 +1,204 @@
+# profiler.py
+
+"""Per-function profile of a program run on the tree walker (main.py --profile).
+
+ProfilingInterpreter times every defun call: how often each function was
+called, its total time (callees included, counted once however deeply it
+recurses), its self time, and how many calls of it were active at once. Calls
+are also counted per source line of the call site, and self time is kept per
+call path, which write_collapsed() writes in the collapsed-stack format read by
+flamegraph tools:
+
+    <module>;main;fib 1234
+
+with the self time of each path in microseconds. Lambda calls are not timed
+separately; their time counts as the calling function's own.
+
+The plain Interpreter has none of this code on its paths, so profiling costs
+nothing unless it is asked for.
+"""
+
+import time
+
+from Interpreter import Interpreter, TailCall, MAX_DEPTH
+from environment import Closure
+from resolver import UNSET
+import errors
+from errors import line_of
+
+MODULE = '<module>'
+
+
+class CallStats:
+    """Counters of one function, or of one call-site line."""
+    __slots__ = ('calls', 'total', 'self_time', 'active', 'max_depth', 'line')
+
+    def __init__(self, line=None):
+        self.calls = 0
+        self.total = 0      # ns, outermost calls only
+        self.self_time = 0  # ns, callees excluded
+        self.active = 0     # calls in progress
+        self.max_depth = 0  # most calls in progress at once
+        self.line = line    # source line of the defun
+
+
+class Profiler:
+    def __init__(self, clock=time.perf_counter_ns):
+        self.clock = clock
+        self.functions = {}   # name -> CallStats
+        self.lines = {}       # call-site line -> CallStats
+        # Call tree: every distinct call path gets an index, with its parent and function name
+        self.paths = [(None, MODULE)]
+        self.path_index = {}  # (parent index, name) -> index
+        self.path_self = [0]  # ns spent in each path itself
+        self.stack = []       # [function stats, line stats, path index, start, ns spent in callees]
+        self.elapsed = 0
+        self._started = None
+        self._in_calls = 0    # ns spent in top-level calls since start()
+
+    def start(self):
+        self._started = self.clock()
+        self._in_calls = 0
+
+    def stop(self):
+        elapsed = self.clock() - self._started
+        self.elapsed += elapsed
+        self.path_self[0] += elapsed - self._in_calls
+        self._started = None
+
+    def enter(self, func_def, line):
+        name = func_def.name
+        stats = self.functions.get(name)
+        if stats is None:
+            stats = self.functions[name] = CallStats(line_of(func_def.position))
+        stats.calls += 1
+        stats.active += 1
+        if stats.active > stats.max_depth:
+            stats.max_depth = stats.active
+
+        line_stats = None
+        if line is not None:
+            line_stats = self.lines.get(line)
+            if line_stats is None:
+                line_stats = self.lines[line] = CallStats(line)
+            line_stats.calls += 1
+            line_stats.active += 1
+
+        key = (self.stack[-1][2] if self.stack else 0, name)
+        path = self.path_index.get(key)
+        if path is None:
+            path = self.path_index[key] = len(self.paths)
+            self.paths.append(key)
+            self.path_self.append(0)
+        self.stack.append([stats, line_stats, path, self.clock(), 0])
+
+    def leave(self):
+        now = self.clock()
+        stats, line_stats, path, start, in_callees = self.stack.pop()
+        elapsed = now - start
+        self.path_self[path] += elapsed - in_callees
+        stats.self_time += elapsed - in_callees
+        stats.active -= 1
+        if not stats.active:
+            stats.total += elapsed
+        if line_stats is not None:
+            line_stats.self_time += elapsed - in_callees
+            line_stats.active -= 1
+            if not line_stats.active:
+                line_stats.total += elapsed
+        if self.stack:
+            self.stack[-1][4] += elapsed
+        else:
+            self._in_calls += elapsed
+
+    def collapsed(self):
+        """{'<module>;f;g': self time in microseconds} for every call path that took any."""
+        names = {}
+        stacks = {}
+        for index, (parent, name) in enumerate(self.paths):
+            names[index] = name if parent is None else f'{names[parent]};{name}'
+            micros = self.path_self[index] // 1000
+            if micros:
+                stacks[names[index]] = micros
+        return stacks
+
+    def write_collapsed(self, file):
+        for stack, micros in self.collapsed().items():
+            file.write(f'{stack} {micros}\n')
+
+    def report(self, file, limit=20):
+        """Print the functions by self time, then the call-site lines by total time."""
+        print(f"profile: {self.elapsed / 1e9:.3f}s, {sum(s.calls for s in self.functions.values())} calls "
+              f"of {len(self.functions)} functions", file=file)
+        print(f"{'function':<24} {'calls':>10} {'total s':>10} {'self s':>10} {'depth':>7} {'line':>6}", file=file)
+        for name, stats in sorted(self.functions.items(), key=lambda item: -item[1].self_time)[:limit]:
+            line = stats.line if stats.line is not None else '-'
+            print(f"{name:<24} {stats.calls:>10} {stats.total / 1e9:>10.4f} {stats.self_time / 1e9:>10.4f} "
+                  f"{stats.max_depth:>7} {line:>6}", file=file)
+        if self.lines:
+            print(f"{'hot line':<24} {'calls':>10} {'total s':>10} {'self s':>10}", file=file)
+            for line, stats in sorted(self.lines.items(), key=lambda item: -item[1].total)[:limit]:
+                print(f"{line:<24} {stats.calls:>10} {stats.total / 1e9:>10.4f} {stats.self_time / 1e9:>10.4f}",
+                      file=file)
+
+
+class ProfilingInterpreter(Interpreter):
+    """Interpreter recording every defun call in `profiler`."""
+
+    def __init__(self, parser, max_depth=MAX_DEPTH, memo=None, env=None, max_steps=None, control=None,
+                 profiler=None):
+        super().__init__(parser, max_depth, memo, env, max_steps, control)
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.call_line = None  # call-site line of the call about to be made
+
+    def interpret(self, tree=None):
+        self.profiler.start()
+        try:
+            return super().interpret(tree)
+        finally:
+            self.profiler.stop()
+
+    def visit_FunctionCallNode(self, node):
+        func_def = self.env.functions.get(node.name)
+        if func_def is None or (node.slot is not None and type(self.call_stack[-1][node.slot]) is Closure):
+            return super().visit_FunctionCallNode(node)
+        args = [self.visit(arg) for arg in node.args][:len(func_def.params)]
+        # Set after the arguments, whose own calls would overwrite it
+        self.call_line = line_of(node.position)
+        if self.memo is not None:
+            return self.call_memoized(func_def, args)
+        return self.call_function(func_def, args)
+
+    def call_function(self, func_def, args, captured=None):
+        profiler = self.profiler
+        self.push_frame(None, func_def.name if captured is None else '<lambda>')
+        # Lambdas are not profiled: their time counts in the defun that called them
+        profiled = captured is None
+        if profiled:
+            profiler.enter(func_def, self.call_line)
+        try:
+            while True:
+                if self.fuel is not None:
+                    self.charge(1)
+                if captured is None:
+                    self.call_stack[-1] = args + [UNSET] * (len(func_def.local_names) - len(args))
+                    result = self.visit_tail(func_def.block)
+                else:
+                    self.call_stack[-1] = self.lambda_frame(func_def, captured, args)
+                    result = self.visit_tail(func_def.expr)
+                if type(result) is not TailCall:
+                    return result
+                # The tail call replaces this call, in the profile as on the stack
+                if profiled:
+                    profiler.leave()
+                profiled = result.captured is None
+                if profiled:
+                    profiler.enter(result.func_def, line_of(result.position))
+                func_def, args, captured = result.func_def, result.args, result.captured
+        except errors.RuntimeError as error:
+            error.leave(func_def.name if captured is None else '<lambda>')
+            raise
+        finally:
+            self.call_stack.pop()
+            if profiled:
+                profiler.leave()
@@ -0,0 +1,65 @@
+# repl.py
+
+"""Interactive session state for main.run_repl.
+
+A ReplSession owns a single engine for the whole session, so defined
+functions, compiled code and variables stay in place between inputs. Each
+line is tokenized once, when it is entered. A fragment whose braces are not
+balanced yet (a multi-line defun, say) waits for more lines. Once the braces
+balance, only the new fragment is parsed and run. A line therefore costs the
+same no matter how much the session has already defined.
+"""
+
+from lexer import Lexer, Token
+from parser import Parser
+from Interpreter import Interpreter, MAX_DEPTH
+from errors import pack, MAX_COLUMN
+
+PROMPT = 'New_line> '
+CONTINUATION_PROMPT = '........> '
+
+
+class ReplSession:
+    def __init__(self, engine=Interpreter, max_depth=MAX_DEPTH, memoizer=None, optimizer=None):
+        self.interpreter = engine(None, max_depth=max_depth, memo=memoizer)
+        self.optimizer = optimizer
+        self.lexer = Lexer('')
+        self.line = 0  # lines entered so far, so tokens carry session-wide line numbers
+        self.reset()
+
+    def reset(self):
+        """Drop a partially entered fragment."""
+        self.pending = []  # tokens of the fragment being entered, EOF excluded
+        self.depth = 0     # braces opened and not closed yet in the fragment
+
+    @property
+    def prompt(self):
+        return CONTINUATION_PROMPT if self.pending else PROMPT
+
+    def push(self, text):
+        """Add a line of input; return the parsed fragment once it is complete, else None."""
+        self.line += 1
+        try:
+            for token in self.lexer.scan_lines([text], self.line):
+                if token.type == 'EOF':
+                    break
+                if token.type == 'LBRACE':
+                    self.depth += 1
+                elif token.type == 'RBRACE':
+                    self.depth -= 1
+                self.pending.append(token)
+        except Exception:
+            self.reset()
+            raise
+        if not self.pending or self.depth > 0:
+            return None
+        tokens = self.pending
+        tokens.append(Token('EOF', None, pack(0, self.line, 0), min(len(text) + 1, MAX_COLUMN)))
+        self.reset()
+        return Parser(tokens).parse()
+
+    def run(self, tree):
+        """Run a fragment returned by push(); its result, or None when it printed nothing."""
+        if self.optimizer is not None:
+            tree = self.optimizer.optimize(tree)
+        return self.interpreter.interpret(tree)
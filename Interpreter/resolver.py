@@ -0,0 +1,207 @@
+# resolver.py
+
+"""Resolves every variable to a fixed slot, and every operator to its function, before the program runs.
+
+Inside a defun or lambda, the parameters and the names assigned in its body
+are locals: each gets an index in the call's frame, a plain list. Every other
+name is a global and gets an index in the GlobalTable. A local read that finds
+its slot still unset falls back to the global of the same name, as a frame
+lookup followed by a global lookup did before.
+
+A lambda inside a function also gets locals for the names of the enclosing
+function it reads. Their values are copied from the enclosing frame into the
+closure when the lambda is evaluated (see environment.Closure).
+"""
+
+from parser import (
+    AST, Var, Assign, BlockNode, IfNode, ReturnNode, BinOp, UnaryOp, FunctionCallNode,
+    FunctionDecNode, LambdaNode, LocalVar, GlobalVar, LocalAssign, GlobalAssign, Operation,
+)
+from operators import BINARY_HANDLERS
+import errors
+
+# Marks a frame or global slot that has not been assigned yet
+UNSET = object()
+
+
+class GlobalTable:
+    """Module-level variables: a list of values indexed by the slots the resolver hands out.
+
+    fork() shares the containers with the copy; whichever side changes them
+    first takes its own copies (see own()).
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.names = []
+        self.values = []
+        self.shared = False  # the containers are also used by a fork
+
+    def fork(self):
+        table = GlobalTable.__new__(GlobalTable)
+        table.slots, table.names, table.values = self.slots, self.names, self.values
+        table.shared = self.shared = True
+        return table
+
+    def own(self):
+        """Copy the containers if a fork still uses them; callers holding `values` must re-read it."""
+        if self.shared:
+            self.slots = dict(self.slots)
+            self.names = list(self.names)
+            self.values = list(self.values)
+            self.shared = False
+
+    def slot(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            self.own()
+            slot = self.slots[name] = len(self.values)
+            self.names.append(name)
+            self.values.append(UNSET)
+        return slot
+
+    def store(self, slot, value):
+        self.own()
+        self.values[slot] = value
+
+    def load(self, slot):
+        value = self.values[slot]
+        if value is UNSET:
+            raise errors.RuntimeError(f"Variable '{self.names[slot]}' not found.")
+        return value
+
+    def lookup(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            raise errors.RuntimeError(f"Variable '{name}' not found.")
+        return self.load(slot)
+
+
+def assigned_names(node, found):
+    """Collect the names assigned in a function body, not counting nested defuns and lambdas."""
+    if isinstance(node, Assign):
+        if node.variable.name not in found:
+            found.append(node.variable.name)
+        assigned_names(node.expr, found)
+    elif isinstance(node, BlockNode):
+        for statement in node.statements:
+            assigned_names(statement, found)
+    elif isinstance(node, IfNode):
+        for child in (node.condition, node.block, node.else_block):
+            assigned_names(child, found)
+    elif isinstance(node, BinOp):
+        assigned_names(node.left, found)
+        assigned_names(node.right, found)
+    elif isinstance(node, (UnaryOp, ReturnNode)):
+        assigned_names(node.expr, found)
+    elif isinstance(node, FunctionCallNode):
+        for arg in node.args:
+            assigned_names(arg, found)
+    elif isinstance(node, LambdaNode) and node.arg is not None:
+        # Only the immediate arguments run in this scope
+        for arg in node.arg:
+            assigned_names(arg, found)
+    return found
+
+
+def read_names(node, found):
+    """Collect the names a lambda body reads or calls, nested lambdas included, nested defuns not."""
+    if isinstance(node, tuple):
+        for child in node:
+            read_names(child, found)
+    elif isinstance(node, (Var, FunctionCallNode)):
+        if node.name not in found:
+            found.append(node.name)
+        if isinstance(node, FunctionCallNode):
+            read_names(node.args, found)
+    elif isinstance(node, Assign):
+        read_names(node.expr, found)
+    elif isinstance(node, AST) and not isinstance(node, FunctionDecNode):
+        for name in node.__slots__:
+            read_names(getattr(node, name), found)
+    return found
+
+
+class Resolver:
+    def __init__(self, global_table):
+        self.globals = global_table
+        self.scope = None  # name -> slot of the function being resolved, None at module level
+
+    def resolve(self, tree):
+        """Return a copy of `tree` (a BlockNode or flattree.FlatTree) with Var/Assign replaced by slot-addressed nodes."""
+        return BlockNode([self.visit(statement) for statement in tree.statements])
+
+    def visit(self, node):
+        method = getattr(self, f'visit_{type(node).__name__}', None)
+        return method(node) if method is not None else node
+
+    def function_scope(self, params, body, captured=()):
+        local_names = list(params)
+        local_names.extend(captured)
+        local_names.extend(name for name in assigned_names(body, []) if name not in local_names)
+        # A repeated parameter name refers to its last occurrence
+        scope = {}
+        for slot, name in enumerate(local_names):
+            if name not in scope or slot < len(params):
+                scope[name] = slot
+        return local_names, scope
+
+    def visit_in_scope(self, scope, node):
+        outer = self.scope
+        self.scope = scope
+        try:
+            return self.visit(node)
+        finally:
+            self.scope = outer
+
+    def visit_Var(self, node):
+        if self.scope is not None and node.name in self.scope:
+            return LocalVar(node.name, self.scope[node.name], node.position)
+        return GlobalVar(node.name, self.globals.slot(node.name), node.position)
+
+    def visit_Assign(self, node):
+        name = node.variable.name
+        expr = self.visit(node.expr)
+        if self.scope is not None and name in self.scope:
+            return LocalAssign(name, self.scope[name], expr)
+        return GlobalAssign(name, self.globals.slot(name), expr)
+
+    def visit_BlockNode(self, node):
+        return BlockNode([self.visit(statement) for statement in node.statements])
+
+    def visit_IfNode(self, node):
+        else_block = self.visit(node.else_block) if node.else_block is not None else None
+        return IfNode(self.visit(node.condition), self.visit(node.block), else_block)
+
+    def visit_ReturnNode(self, node):
+        return ReturnNode(self.visit(node.expr))
+
+    def visit_BinOp(self, node):
+        handler = BINARY_HANDLERS.get(node.op)
+        if handler is None:
+            # && and ||, which short-circuit, and operators left to fail when evaluated
+            return BinOp(self.visit(node.left), node.op, self.visit(node.right), node.position)
+        return Operation(self.visit(node.left), node.op, self.visit(node.right), handler, node.position)
+
+    def visit_UnaryOp(self, node):
+        return UnaryOp(node.op, self.visit(node.expr), node.position)
+
+    def visit_FunctionCallNode(self, node):
+        slot = self.scope.get(node.name) if self.scope is not None else None
+        return FunctionCallNode(node.name, [self.visit(arg) for arg in node.args], slot, node.position)
+
+    def visit_FunctionDecNode(self, node):
+        params = [param.name for param in node.params]
+        local_names, scope = self.function_scope(params, node.block)
+        block = self.visit_in_scope(scope, node.block)
+        return FunctionDecNode(node.name, node.params, block, local_names, node.position, node.int_only)
+
+    def visit_LambdaNode(self, node):
+        captured = []
+        if self.scope is not None:
+            captured = [name for name in read_names(node.expr, []) if name in self.scope and name not in node.params]
+        local_names, scope = self.function_scope(node.params, node.expr, captured)
+        expr = self.visit_in_scope(scope, node.expr)
+        # Immediate arguments belong to the enclosing scope
+        arg = [self.visit(arg) for arg in node.arg] if node.arg is not None else None
+        return LambdaNode(node.params, expr, arg, local_names, [self.scope[name] for name in captured])
@@ -0,0 +1,278 @@
+# sequences.py
+
+"""Lazy sequence values and the builtins working on them.
+
+    range(n) / range(start, stop) / range(start, stop, step)
+    map(f, seq)       f(x) for every x
+    filter(f, seq)    the x for which f(x) is true
+    take(n, seq)      the first n items
+    reduce(f, seq)    f(f(x0, x1), x2)..., or reduce(f, seq, initial)
+    sum(seq)
+    len(seq)
+
+range, map and filter build nothing: a sequence is a source (a Python range,
+or the items take() kept) plus the map and filter stages applied to it.
+Iterating chains the stages over the source as Python iterators, so a whole
+pipeline runs in one pass, one item at a time, and reduce, sum, len and take
+use constant memory however long the range is. A sequence is computed again
+each time it is used, and a callback's errors show up when its items are.
+
+The items take() keeps are stored in an array('q') when they are all 64-bit
+ints, 8 bytes an item, and in a tuple otherwise.
+
+When the callback is a lambda whose body is plain arithmetic, comparisons and
+`if` over its parameters, captured values and literals, it is translated once
+into a Python function, which the iterators call without going through the
+engine. Any other callback is called through the engine, one item at a time.
+
+When the engine counts steps (see control.py), every item reduce, sum, len
+and take consume is charged as a step.
+"""
+
+from array import array
+from functools import reduce
+from itertools import islice, repeat, zip_longest
+
+from parser import (
+    LambdaNode, Num, Boolean, LocalVar, Operation, BinOp, UnaryOp, IfNode, BlockNode, ReturnNode, FunctionCallNode,
+)
+from operators import divide, modulo
+from resolver import UNSET
+from memo import MISSING
+import errors
+
+# Python spelling of the operators the native translation supports
+PYTHON_OPERATORS = {
+    'PLUS': '+', 'MINUS': '-', 'MUL': '*',
+    'EQEQ': '==', 'NEQUAL': '!=', 'GT': '>', 'LT': '<', 'GTE': '>=', 'LTE': '<=',
+    'AND': 'and', 'OR': 'or',
+}
+PYTHON_FUNCTIONS = {'DIV': '_divide', 'MODULO': '_modulo'}
+PYTHON_UNARY = {'NOT': 'not ', 'MINUS': '-', 'PLUS': '+'}
+
+# Translated lambdas by LambdaNode (None when the body cannot be translated)
+NATIVE_CACHE_SIZE = 1024
+_native = {}
+
+
+MAP, FILTER = 'map', 'filter'
+
+
+class Sequence:
+    __slots__ = ('source', 'stages')
+
+    def __init__(self, source, stages=()):
+        self.source = source  # a range, an array('q') or a tuple
+        self.stages = stages  # ((MAP | FILTER, function), ...), applied in order
+
+    @classmethod
+    def from_values(cls, values):
+        values = list(values)
+        if all(type(value) is int for value in values):
+            try:
+                return cls(array('q', values))
+            except OverflowError:
+                pass
+        return cls(tuple(values))
+
+    def then(self, kind, function):
+        """This sequence with one more stage; nothing is computed."""
+        return Sequence(self.source, self.stages + ((kind, function),))
+
+    def __iter__(self):
+        items = iter(self.source)
+        for kind, function in self.stages:
+            items = map(function, items) if kind is MAP else filter(function, items)
+        return items
+
+    def __len__(self):
+        if all(kind is MAP for kind, function in self.stages):
+            # Maps keep the length, though an error in a callback then goes unnoticed
+            return len(self.source)
+        return sum(1 for item in self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return False
+        missing = object()
+        return all(a == b for a, b in zip_longest(self, other, fillvalue=missing))
+
+    def __str__(self):
+        return '[' + ', '.join(map(str, self)) + ']'
+
+    __repr__ = __str__
+
+
+def translate(node, call=None):
+    """Python source for a resolved expression, or None when it is not plain arithmetic.
+
+    With `call`, a function call is translated as call(node, translated arguments), which returns its
+    source or None.
+    """
+    if type(node) is Num:
+        return repr(node.value)
+    if type(node) is Boolean:
+        return repr(node.value)
+    if type(node) is LocalVar:
+        return f's{node.slot}'
+    if type(node) in (Operation, BinOp):
+        left, right = translate(node.left, call), translate(node.right, call)
+        if left is None or right is None:
+            return None
+        if node.op in PYTHON_FUNCTIONS:
+            return f'{PYTHON_FUNCTIONS[node.op]}({left}, {right})'
+        if node.op in PYTHON_OPERATORS:
+            return f'({left} {PYTHON_OPERATORS[node.op]} {right})'
+        return None
+    if type(node) is UnaryOp and node.op in PYTHON_UNARY:
+        expr = translate(node.expr, call)
+        return f'({PYTHON_UNARY[node.op]}{expr})' if expr is not None else None
+    if type(node) is IfNode:
+        condition, block = translate(node.condition, call), translate(node.block, call)
+        else_block = translate(node.else_block, call) if node.else_block is not None else 'None'
+        if condition is None or block is None or else_block is None:
+            return None
+        return f'({block} if {condition} else {else_block})'
+    if type(node) is BlockNode and len(node.statements) == 1:
+        return translate(node.statements[0], call)
+    if type(node) is ReturnNode and node.expr is not None:
+        return translate(node.expr, call)
+    if type(node) is FunctionCallNode and call is not None:
+        args = [translate(arg, call) for arg in node.args]
+        return call(node, args) if None not in args else None
+    return None
+
+
+def _factory(node):
+    """A function taking the captured values and returning the translated lambda, or None."""
+    # One lookup: another thread may clear the cache in between two
+    factory = _native.get(node, MISSING)
+    if factory is not MISSING:
+        return factory
+    factory = None
+    body = translate(node.expr)
+    if body is not None:
+        params = ', '.join(f's{slot}' for slot in range(len(node.params)))
+        captured = ', '.join(f's{slot}' for slot in range(len(node.params), len(node.params) + len(node.captures)))
+        source = f'lambda {captured}: lambda {params}: {body}'
+        factory = eval(source, {'_divide': divide, '_modulo': modulo})
+    if len(_native) >= NATIVE_CACHE_SIZE:
+        _native.clear()
+    _native[node] = factory
+    return factory
+
+
+def native(func, arity):
+    """A plain Python function doing what calling closure `func` with `arity` arguments does, or None."""
+    function = getattr(func, 'function', None)
+    # The VM's closures hold a compiled Function, which keeps its LambdaNode
+    node = getattr(function, 'node', function)
+    if not isinstance(node, LambdaNode) or len(node.params) != arity or node.captures is None:
+        return None
+    # A captured local that was unset reads the global of the same name instead
+    if any(value is UNSET for value in func.captured):
+        return None
+    factory = _factory(node)
+    return factory(*func.captured) if factory is not None else None
+
+
+def _sequence(name, value):
+    if not isinstance(value, Sequence):
+        raise errors.RuntimeError(f"{name} expects a sequence, got {value}")
+    return value
+
+
+def _arguments(name, args, counts):
+    if len(args) not in counts:
+        raise errors.RuntimeError(f"{name} takes {' or '.join(map(str, counts))} arguments, got {len(args)}")
+
+
+def _metered(engine, seq):
+    """The items of `seq`, charged to the engine's step count when it keeps one.
+
+    Each item is charged once computed. No frame of ours stays on the stack
+    while a callback computes the next one, which may nest sequences as deep
+    as the engine allows.
+    """
+    if engine.fuel is None:
+        return iter(seq)
+    return map(_charged, repeat(engine), seq)
+
+
+def _charged(engine, item):
+    engine.charge(1)
+    return item
+
+
+def _callback(engine, func, arity):
+    """`func` as a Python function of `arity` arguments: translated, or calling through the engine."""
+    fast = native(func, arity)
+    if fast is not None:
+        return fast
+    if arity == 1:
+        return lambda item: engine.call_value(func, [item])
+    return lambda result, item: engine.call_value(func, [result, item])
+
+
+def builtin_range(engine, args):
+    _arguments('range', args, (1, 2, 3))
+    if any(type(arg) is not int for arg in args):
+        raise errors.RuntimeError("range expects integer arguments")
+    if len(args) == 3 and args[2] == 0:
+        raise errors.RuntimeError("range step must not be zero")
+    return Sequence(range(*args))
+
+
+def builtin_map(engine, args):
+    _arguments('map', args, (2,))
+    return _sequence('map', args[1]).then(MAP, _callback(engine, args[0], 1))
+
+
+def builtin_filter(engine, args):
+    _arguments('filter', args, (2,))
+    return _sequence('filter', args[1]).then(FILTER, _callback(engine, args[0], 1))
+
+
+def builtin_take(engine, args):
+    _arguments('take', args, (2,))
+    count, seq = args[0], _sequence('take', args[1])
+    if type(count) is not int or count < 0:
+        raise errors.RuntimeError("take expects a count of zero or more")
+    return Sequence.from_values(_metered(engine, islice(seq, count)))
+
+
+def builtin_reduce(engine, args):
+    _arguments('reduce', args, (2, 3))
+    func, items = args[0], _metered(engine, _sequence('reduce', args[1]))
+    if len(args) == 3:
+        result = args[2]
+    else:
+        result = next(items, UNSET)
+        if result is UNSET:
+            raise errors.RuntimeError("reduce of an empty sequence with no initial value")
+    return reduce(_callback(engine, func, 2), items, result)
+
+
+def builtin_sum(engine, args):
+    _arguments('sum', args, (1,))
+    return sum(_metered(engine, _sequence('sum', args[0])))
+
+
+def builtin_len(engine, args):
+    _arguments('len', args, (1,))
+    seq = _sequence('len', args[0])
+    if engine.fuel is not None and any(kind is FILTER for kind, function in seq.stages):
+        return sum(1 for item in _metered(engine, seq))
+    return len(seq)
+
+
+# Called as builtin(engine, args) for a call to a name no defun or global lambda has
+BUILTINS = {
+    'range': builtin_range,
+    'map': builtin_map,
+    'filter': builtin_filter,
+    'take': builtin_take,
+    'reduce': builtin_reduce,
+    'sum': builtin_sum,
+    'len': builtin_len,
+}
@@ -0,0 +1,556 @@
+# server.py
+
+"""Serve .lambda programs over a local socket from a pool of warm worker processes.
+
+    python3 server.py --unix PATH | --port N [--host HOST]
+                      [--workers N] [--timeout SECONDS] [--max-steps N] [--prelude FILE]
+
+Clients send one JSON object per line and get JSON lines back. A request runs
+a program given as source text, or as a parsed module: the base64 of a
+BlockNode pickled on its own (an astcache entry also holds a digest and a file
+id). Positions in a module name files by ids the worker does not know, so its
+errors show `<unknown>` as the file. A module is unpickled by ModuleUnpickler,
+which builds the parser's node classes and nothing else. A client can still
+make a worker busy for as long as the limits allow, so TCP listens on
+127.0.0.1 unless told otherwise.
+
+    {"id": 1, "source": "defun f(n) { n * 2 } f(21)"}
+    {"id": 2, "module": "<base64>", "timeout": 0.5, "max_steps": 10000, "max_depth": 500}
+    {"id": 3, "op": "cancel", "target": 2}
+    {"id": 4, "op": "stats"}
+
+Each line a program prints is sent as soon as it is printed, then one final
+record closes the request:
+
+    {"id": 1, "output": "42"}
+    {"id": 1, "status": "ok" | "error" | "timeout" | "cancelled" | "step_limit" | "crashed",
+     "seconds", "queued", "steps", "error"}
+
+`seconds` is the run time in the worker, `queued` the time spent waiting for
+one and `steps` the steps the program took (see control.py). A request may
+lower the server's --timeout, --max-steps and --max-depth, never raise them.
+A request with a field of the wrong type, a limit that is not a non-negative
+number say, only gets an error record.
+
+A program past its timeout, or cancelled by a request from the same
+connection, is stopped at its next checkpoint and its worker stays warm. A
+worker that does not reach a checkpoint within GRACE seconds, stuck printing a
+huge sequence say, is killed and replaced.
+
+Workers import the interpreter and load the --prelude once, when they start.
+Every request then runs in a copy-on-write fork of the prelude's environment
+(see Environment.fork), so requests never see each other's definitions.
+
+The stats request returns the queue depth, requests by status, and histograms
+of queue wait and total latency in milliseconds.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import signal
+import sys
+import time
+
+from lexer import Lexer
+import parser
+from parser import Parser, AST, BlockNode
+from Interpreter import Interpreter
+from vm import VirtualMachine
+from environment import Environment
+from control import Control, Cancelled
+from main import add_engine_arguments, read_code_from_file
+import memo
+from optimizer import Optimizer
+
+# Upper bounds of the latency histogram buckets, in milliseconds; the last bucket is unbounded
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+# Longest request line accepted, programs included
+MAX_REQUEST_BYTES = 16 * 2 ** 20
+# Seconds a stopped program has to reach a checkpoint before its worker is killed
+GRACE = 1.0
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+
+    def add(self, millis):
+        index = 0
+        while index < len(self.bounds) and millis > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += millis
+
+    def as_dict(self):
+        count = sum(self.counts)
+        buckets = {f'<={bound}': n for bound, n in zip(self.bounds, self.counts)}
+        buckets[f'>{self.bounds[-1]}'] = self.counts[-1]
+        return {'count': count, 'mean': round(self.total / count, 3) if count else None, 'buckets': buckets}
+
+
+class OutputStream:
+    """Stand-in for stdout in a worker: sends each complete line to the server."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.partial = ''
+
+    def write(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.conn.send(('output', line))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.partial:
+            self.conn.send(('output', self.partial))
+            self.partial = ''
+
+
+class ModuleUnpickler(pickle.Unpickler):
+    """Unpickles a parse tree: the only classes it builds are the parser's nodes."""
+
+    def find_class(self, module, name):
+        if module == 'parser':
+            node_class = getattr(parser, name, None)
+            if isinstance(node_class, type) and issubclass(node_class, AST):
+                return node_class
+        raise pickle.UnpicklingError(f'{module}.{name} is not a parse tree node')
+
+
+def load_module(data):
+    """The BlockNode pickled in the base64 string `data`."""
+    tree = ModuleUnpickler(io.BytesIO(base64.b64decode(data))).load()
+    if not isinstance(tree, BlockNode):
+        raise pickle.UnpicklingError(f'a module is a pickled BlockNode, not {type(tree).__name__}')
+    return tree
+
+
+def load_prelude(engine, options):
+    """The environment every request starts from: empty, or what --prelude defines."""
+    env = Environment()
+    if options.prelude:
+        tree = Parser(Lexer(read_code_from_file(options.prelude))).parse()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            engine(None, max_depth=options.max_depth, env=env).interpret(tree)
+    return env
+
+
+class SharedFlagControl(Control):
+    """Cancelled once the server writes this job's number into a flag shared with the worker."""
+
+    def __init__(self, flag, number):
+        super().__init__()
+        self.flag = flag
+        self.number = number
+
+    def checkpoint(self):
+        if self.flag.value == self.number:
+            self.cancel()
+        super().checkpoint()
+
+
+def run_request(job, engine, prelude, options, conn, flag):
+    """Run one program in a fork of `prelude`, streaming its output over `conn`; returns the final record."""
+    output = OutputStream(conn)
+    interpreter = None
+    error = None
+    status = 'ok'
+    start = time.perf_counter()
+    try:
+        if job.get('module') is not None:
+            tree = load_module(job['module'])
+        else:
+            tree = Parser(Lexer(job.get('source') or '')).parse()
+        if options.optimize:
+            tree = Optimizer().optimize(tree)
+        memoizer = memo.Memoizer(options.memo_size) if options.memo else None
+        interpreter = engine(None, max_depth=job['max_depth'], memo=memoizer, env=prelude.fork(),
+                             max_steps=job['max_steps'], control=SharedFlagControl(flag, job['number']))
+        with contextlib.redirect_stdout(output):
+            interpreter.interpret(tree)
+    except Cancelled as exc:
+        error = str(exc)
+        status = 'cancelled'
+    except Exception as exc:
+        error = str(exc)
+        status = 'step_limit' if interpreter is not None and interpreter.out_of_steps else 'error'
+    output.close()
+    return {'status': status, 'seconds': round(time.perf_counter() - start, 6),
+            'steps': interpreter.steps_taken if interpreter is not None else None, 'error': error}
+
+
+def worker_main(conn, flag, options):
+    """Warm up, then run the jobs sent over `conn` until the server goes away."""
+    engine = VirtualMachine if options.vm else Interpreter
+    prelude = load_prelude(engine, options)
+    conn.send(('ready', None))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        conn.send(('done', run_request(job, engine, prelude, options, conn, flag)))
+
+
+class Job:
+    """A program waiting for a worker, or running on one."""
+
+    def __init__(self, program, timeout, send):
+        self.program = program  # what the worker gets: source or module, and limits
+        self.timeout = timeout
+        self.send = send        # coroutine function sending an output line to the client
+        self.received = time.monotonic()
+        self.done = asyncio.get_running_loop().create_future()
+        self.stopped = None     # 'timeout' or 'cancelled' once the server stopped it
+
+
+class Worker:
+    """A worker process, and the messages it sent that were not read yet."""
+
+    def __init__(self, context, options):
+        self.conn, child_conn = context.Pipe()
+        # The number of the job to cancel; the worker's checkpoints read it
+        self.cancel_flag = context.RawValue('q', 0)
+        self.process = context.Process(target=worker_main, args=(child_conn, self.cancel_flag, options),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.messages = asyncio.Queue()
+        self.jobs = 0      # jobs sent so far, which numbers them
+        self.job = None    # the running job
+        self._kill_timer = None
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self._readable)
+
+    def _readable(self):
+        try:
+            message = self.conn.recv()
+        except (EOFError, OSError):
+            # The process is gone; None tells whoever waits
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            message = None
+        self.messages.put_nowait(message)
+
+    async def ready(self):
+        message = await self.messages.get()
+        if message is None:
+            raise RuntimeError(f'worker exited with code {self.process.exitcode} while starting')
+
+    def stop(self, job, reason):
+        """Ask the running `job` to stop at its next checkpoint, and kill the worker if it does not."""
+        if self.job is not job or job.stopped is not None:
+            return
+        job.stopped = reason
+        self.cancel_flag.value = self.jobs
+        self._kill_timer = asyncio.get_running_loop().call_later(GRACE, self.kill)
+
+    async def run(self, job):
+        """Run `job`, sending its output lines as they come; the final record, without id.
+
+        When this raises, the worker is killed: it may still be running the job, and its messages
+        would reach the next one.
+        """
+        loop = asyncio.get_running_loop()
+        self.jobs += 1
+        self.job = job
+        timer = None
+        try:
+            self.conn.send(dict(job.program, number=self.jobs))
+            if job.timeout is not None:
+                timer = loop.call_later(job.timeout, self.stop, job, 'timeout')
+            while True:
+                message = await self.messages.get()
+                if message is None:
+                    self.process.join()
+                    record = {'status': 'crashed', 'error': f'worker exited with code {self.process.exitcode}'}
+                    break
+                kind, value = message
+                if kind == 'output':
+                    await job.send({'output': value})
+                else:
+                    record = value
+                    break
+        except BaseException:
+            self.kill()
+            raise
+        finally:
+            self.job = None
+            for pending in (timer, self._kill_timer):
+                if pending is not None:
+                    pending.cancel()
+            self._kill_timer = None
+        if job.stopped is not None and record['status'] in ('cancelled', 'crashed'):
+            record['status'] = job.stopped
+            record['error'] = (f'timed out after {job.timeout} seconds' if job.stopped == 'timeout'
+                               else 'cancelled by the client')
+        return record
+
+    def kill(self):
+        with contextlib.suppress(ValueError, OSError):
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+        # Whoever waits for a message learns the process is gone
+        self.messages.put_nowait(None)
+
+
+class Server:
+    def __init__(self, options, workers=None, timeout=None, max_steps=None):
+        self.options = options
+        self.size = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_steps = max_steps
+        # Forked replacements would inherit the client sockets and keep them open
+        self.context = multiprocessing.get_context('spawn')
+        self.queue = asyncio.Queue()
+        self.workers = []
+        self.tasks = []
+        self.max_queue_depth = 0
+        self.statuses = {}
+        self.restarts = 0
+        self.waits = Histogram()
+        self.latencies = Histogram()
+        self.started = time.monotonic()
+
+    async def start(self):
+        """Start the workers and wait until every one is warm."""
+        self.workers = [Worker(self.context, self.options) for _ in range(self.size)]
+        await asyncio.gather(*(worker.ready() for worker in self.workers))
+        self.tasks = [asyncio.create_task(self.dispatch(index)) for index in range(self.size)]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for worker in self.workers:
+            worker.kill()
+
+    async def dispatch(self, index):
+        """Feed queued jobs to worker `index`, replacing it when it was killed or crashed."""
+        while True:
+            job = await self.queue.get()
+            started = time.monotonic()
+            self.waits.add((started - job.received) * 1000)
+            if job.stopped is not None:
+                # Cancelled while queued
+                record = {'status': job.stopped, 'seconds': 0.0, 'steps': None, 'error': 'cancelled by the client'}
+            else:
+                worker = self.workers[index]
+                try:
+                    record = await worker.run(job)
+                except Exception as exc:
+                    record = {'status': 'crashed', 'error': str(exc)}
+                if not worker.process.is_alive():
+                    worker.kill()
+                    self.restarts += 1
+                    worker = self.workers[index] = Worker(self.context, self.options)
+                    with contextlib.suppress(RuntimeError):
+                        await worker.ready()
+            record.setdefault('seconds', round(time.monotonic() - started, 6))
+            record.setdefault('steps', None)
+            record['queued'] = round(started - job.received, 6)
+            if not job.done.cancelled():
+                job.done.set_result(record)
+
+    def limit(self, request, field, server_limit, kinds=(int,)):
+        """The smaller of the server's limit and the request's `field`, either of which may be missing.
+
+        Raises ValueError when the request's value is not a number of one of `kinds`, or is negative.
+        """
+        requested = request.get(field)
+        if requested is None:
+            return server_limit
+        if type(requested) not in kinds or requested < 0:
+            raise ValueError(f'{field} must be a non-negative {"number" if float in kinds else "integer"}')
+        return requested if server_limit is None else min(requested, server_limit)
+
+    def submit(self, request, send):
+        """Queue one program; its Job's `done` future gets the final record.
+
+        Raises ValueError, before anything is queued, for a request whose fields have the wrong type.
+        """
+        for field in ('source', 'module'):
+            if request.get(field) is not None and not isinstance(request[field], str):
+                raise ValueError(f'{field} must be a string')
+        job = Job({
+            'source': request.get('source'),
+            'module': request.get('module'),
+            'max_steps': self.limit(request, 'max_steps', self.max_steps),
+            'max_depth': self.limit(request, 'max_depth', self.options.max_depth),
+        }, self.limit(request, 'timeout', self.timeout, (int, float)), send)
+        self.queue.put_nowait(job)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        job.done.add_done_callback(lambda done: self.finished(job, done))
+        return job
+
+    def finished(self, job, done):
+        if done.cancelled():
+            return
+        status = done.result()['status']
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latencies.add((time.monotonic() - job.received) * 1000)
+
+    def cancel(self, job):
+        """Stop a queued or running job; False when it already finished."""
+        if job.done.done():
+            return False
+        for worker in self.workers:
+            if worker.job is job:
+                worker.stop(job, 'cancelled')
+                return True
+        job.stopped = 'cancelled'
+        return True
+
+    def stats(self):
+        return {
+            'uptime': round(time.monotonic() - self.started, 3),
+            'workers': self.size,
+            'restarts': self.restarts,
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'requests': dict(self.statuses),
+            'queue_wait_ms': self.waits.as_dict(),
+            'latency_ms': self.latencies.as_dict(),
+        }
+
+    async def handle(self, reader, writer):
+        """Serve one client connection; its requests run concurrently and answer in any order."""
+        lock = asyncio.Lock()
+        pending = set()
+        jobs = {}  # request id -> Job, until it finishes
+
+        async def send(message):
+            async with lock:
+                writer.write(json.dumps(message).encode() + b'\n')
+                await writer.drain()
+
+        async def run(request):
+            request_id = request.get('id')
+            try:
+                job = self.submit(request, lambda message: send(dict(message, id=request_id)))
+            except ValueError as error:
+                await send({'id': request_id, 'status': 'error', 'error': f'bad request: {error}'})
+                return
+            jobs[request_id] = job
+            try:
+                record = await job.done
+            finally:
+                if jobs.get(request_id) is job:
+                    del jobs[request_id]
+            await send(dict(record, id=request_id))
+
+        async def serve(request):
+            request_id = request.get('id')
+            op = request.get('op', 'run')
+            try:
+                if op == 'run':
+                    await run(request)
+                elif op == 'cancel':
+                    job = jobs.get(request.get('target'))
+                    await send({'id': request_id, 'cancelled': job is not None and self.cancel(job)})
+                elif op == 'stats':
+                    await send({'id': request_id, 'stats': self.stats()})
+                else:
+                    await send({'id': request_id, 'status': 'error', 'error': f"unknown op {op!r}"})
+            except ConnectionError:
+                pass
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    await send({'id': None, 'status': 'error', 'error': 'request too large'})
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('a request is a JSON object')
+                except ValueError as error:
+                    await send({'id': None, 'status': 'error', 'error': f'bad request: {error}'})
+                    continue
+                task = asyncio.create_task(serve(request))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            # Finish what the client asked for before hanging up
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            for job in jobs.values():
+                self.cancel(job)
+            for task in pending:
+                task.cancel()
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+
+async def serve(args):
+    server = Server(args, args.workers, args.timeout, args.max_steps)
+    await server.start()
+    if args.unix:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix, limit=MAX_REQUEST_BYTES)
+        where = args.unix
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port, limit=MAX_REQUEST_BYTES)
+        where = ', '.join(str(sock.getsockname()) for sock in listener.sockets)
+    print(f"serving on {where} with {server.size} workers", file=sys.stderr)
+    # Stop on SIGTERM as on Ctrl-C, so the workers and the socket file are cleaned up
+    serving = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, serving.cancel)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await server.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Serve .lambda programs over a local socket.')
+    where = arg_parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--unix', metavar='PATH', help='listen on this Unix socket')
+    where.add_argument('--port', type=int, help='listen on this TCP port')
+    arg_parser.add_argument('--host', default='127.0.0.1', help='TCP address to listen on, default 127.0.0.1')
+    arg_parser.add_argument('-j', '--workers', type=int, default=None,
+                            help='number of worker processes, default one per CPU')
+    arg_parser.add_argument('--timeout', type=float, default=None, metavar='SECONDS',
+                            help='stop a program running longer than this')
+    arg_parser.add_argument('--prelude', metavar='FILE', help='a .lambda file every worker loads once, at start')
+    add_engine_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    if args.unix and os.path.exists(args.unix):
+        os.remove(args.unix)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
+
+
+if __name__ == '__main__':
+    main()
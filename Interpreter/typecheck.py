@@ -0,0 +1,378 @@
+# typecheck.py
+
+"""Static type and arity inference over a whole program, before it runs.
+
+    check(statements)       a TypeReport: diagnostics, inferred types and arities
+    specialize(statements)  the statements with their int-only defuns marked
+
+Values are ints, bools, functions (lambda values), sequences or None. The
+type of a defun's parameter is what its call sites pass, and its return type
+what its body gives back; both are worked out together, repeating until
+nothing changes, since functions call each other. A type that can be two
+different things is ANY, and nothing is reported about ANY values.
+
+A defun defined twice, or inside another statement, is only known at run
+time, so its calls are not checked. Everything reported is a warning: the
+language stays dynamically typed and the program runs as written.
+
+A defun is int-only when every call passes it ints, with exactly its number
+of parameters, and its body only does arithmetic, comparisons and `if` over
+them and calls other int-only defuns. The engines run such a function as
+Python code (see native.py) instead of one interpreted call per call.
+Functions with a tail call back into themselves stay interpreted, since only
+the engines' trampolines keep tail recursion from nesting.
+"""
+
+from parser import (
+    AST, Num, Boolean, Var, BinOp, UnaryOp, IfNode, BlockNode, ReturnNode, Assign, LambdaNode, FunctionCallNode,
+    FunctionDecNode,
+)
+from errors import describe
+from sequences import PYTHON_OPERATORS, PYTHON_FUNCTIONS, PYTHON_UNARY
+
+INT, BOOL, FUNCTION, SEQUENCE, NONE, ANY = 'int', 'bool', 'function', 'sequence', 'none', 'any'
+
+ARITHMETIC = {'PLUS': '+', 'MINUS': '-', 'MUL': '*', 'DIV': '/', 'MODULO': '%'}
+ORDERING = {'GT': '>', 'LT': '<', 'GTE': '>=', 'LTE': '<='}
+EQUALITY = ('EQEQ', 'NEQUAL')
+
+# name -> (parameter types, required arguments, result type), as sequences.BUILTINS takes them
+BUILTIN_TYPES = {
+    'range': ((INT, INT, INT), 1, SEQUENCE),
+    'map': ((FUNCTION, SEQUENCE), 2, SEQUENCE),
+    'filter': ((FUNCTION, SEQUENCE), 2, SEQUENCE),
+    'take': ((INT, SEQUENCE), 2, SEQUENCE),
+    'reduce': ((FUNCTION, SEQUENCE, ANY), 2, ANY),
+    'sum': ((SEQUENCE,), 1, INT),
+    'len': ((SEQUENCE,), 1, INT),
+}
+
+
+def join(a, b):
+    """The type of a value that is either an `a` or a `b`; None is not known yet."""
+    if a is None:
+        return b
+    if b is None or a == b:
+        return a
+    return ANY
+
+
+def _article(value_type):
+    return ('an ' if value_type == INT else 'a ') + value_type
+
+
+def _known(value_type):
+    return value_type is not None and value_type != ANY
+
+
+class TypeReport:
+    def __init__(self, diagnostics, signatures, int_only):
+        self.diagnostics = diagnostics  # messages, in program order
+        self.signatures = signatures    # defun name -> (parameter types, return type)
+        self.int_only = int_only        # names of the int-only defuns
+
+
+class Inference:
+    def __init__(self, statements):
+        self.statements = statements
+        self.functions = {}  # name -> FunctionDecNode, for defuns defined once at top level
+        self.dynamic = set()  # defun names only known at run time
+        self.assigned = set()  # names assigned anywhere, which may hold lambdas
+        for statement in statements:
+            if type(statement) is FunctionDecNode:
+                if statement.name in self.functions:
+                    self.dynamic.add(statement.name)
+                self.functions[statement.name] = statement
+                self._collect(statement.block)
+            else:
+                self._collect(statement)
+        for name in self.dynamic:
+            del self.functions[name]
+        self.params = {name: [None] * len(func_def.params) for name, func_def in self.functions.items()}
+        self.returns = dict.fromkeys(self.functions)
+        self.exact_calls = set(self.functions)  # defuns every call of which passes all their parameters
+        self.diagnostics = None  # a list during the reporting pass
+        self.where = None  # (position, function name) for diagnostics
+
+    def _collect(self, node):
+        if type(node) is FunctionDecNode:
+            self.dynamic.add(node.name)
+            self.functions.setdefault(node.name, node)
+        elif type(node) is Assign:
+            self.assigned.add(node.variable.name)
+        for name in node.__slots__:
+            child = getattr(node, name)
+            for item in child if type(child) is tuple else (child,):
+                if isinstance(item, AST):
+                    self._collect(item)
+
+    def run(self):
+        changed = True
+        while changed:
+            before = (dict((name, tuple(types)) for name, types in self.params.items()), dict(self.returns))
+            self.visit_program()
+            changed = before != (dict((name, tuple(types)) for name, types in self.params.items()), self.returns)
+        self.diagnostics = []
+        self.visit_program()
+        signatures = {name: (tuple(self.params[name]), self.returns[name]) for name in self.functions}
+        return TypeReport(self.diagnostics, signatures, self.int_only())
+
+    def visit_program(self):
+        for statement in self.statements:
+            if type(statement) is FunctionDecNode:
+                if statement.name in self.functions and self.functions[statement.name] is statement:
+                    self.visit_function(statement)
+            else:
+                self.where = (getattr(statement, 'position', None), None)
+                self.visit(statement, {})
+
+    def visit_function(self, func_def):
+        self.where = (func_def.position, func_def.name)
+        scope = {}
+        _assigned_names(func_def.block, scope)
+        for param, param_type in zip(func_def.params, self.params[func_def.name]):
+            # A reassigned parameter may hold anything
+            scope[param.name] = ANY if param.name in scope else param_type
+        self.returns[func_def.name] = join(self.returns[func_def.name], self.visit(func_def.block, scope))
+
+    def report(self, message, position=None):
+        if self.diagnostics is None:
+            return
+        if position is None:
+            position = self.where[0]
+        function = self.where[1]
+        where = describe(position) if position is not None else "top level"
+        if function is not None:
+            where += f", in '{function}'"
+        diagnostic = f"{where}: {message}"
+        if diagnostic not in self.diagnostics:
+            self.diagnostics.append(diagnostic)
+
+    def visit(self, node, scope):
+        method = getattr(self, f'visit_{type(node).__name__}', None)
+        return method(node, scope) if method is not None else ANY
+
+    def visit_Num(self, node, scope):
+        return INT
+
+    def visit_Boolean(self, node, scope):
+        return BOOL
+
+    def visit_Var(self, node, scope):
+        # Globals are assigned at run time
+        return scope.get(node.name, ANY)
+
+    def visit_Assign(self, node, scope):
+        self.visit(node.expr, scope)
+        return NONE
+
+    def visit_BinOp(self, node, scope):
+        left, right = self.visit(node.left, scope), self.visit(node.right, scope)
+        if node.op in ARITHMETIC or node.op in ORDERING:
+            symbol = ARITHMETIC.get(node.op) or ORDERING[node.op]
+            for operand in (left, right):
+                if _known(operand) and operand != INT:
+                    self.report(f"'{symbol}' expects integers, got {operand}", node.position)
+            return INT if node.op in ARITHMETIC else BOOL
+        if node.op in EQUALITY:
+            return BOOL
+        # && and || give back one of their operands
+        return join(left, right)
+
+    def visit_UnaryOp(self, node, scope):
+        operand = self.visit(node.expr, scope)
+        if node.op == 'NOT':
+            return BOOL
+        if _known(operand) and operand != INT:
+            self.report(f"unary '{ARITHMETIC.get(node.op, node.op)}' expects an integer, got {operand}", node.position)
+        return INT
+
+    def visit_IfNode(self, node, scope):
+        self.visit(node.condition, scope)
+        result = self.visit(node.block, scope)
+        return join(result, self.visit(node.else_block, scope) if node.else_block is not None else NONE)
+
+    def visit_BlockNode(self, node, scope):
+        # A block gives its first `return`, or else its last statement
+        result = NONE
+        for statement in node.statements:
+            result = self.visit(statement, scope)
+            if type(statement) is ReturnNode:
+                return result
+        return result
+
+    def visit_ReturnNode(self, node, scope):
+        return self.visit(node.expr, scope)
+
+    def visit_FunctionDecNode(self, node, scope):
+        # Defined at run time; its body is checked with nothing known about its parameters
+        where = self.where
+        self.where = (node.position, node.name)
+        inner = dict(scope)
+        _assigned_names(node.block, inner)
+        inner.update((param.name, ANY) for param in node.params)
+        self.visit(node.block, inner)
+        self.where = where
+        return NONE
+
+    def visit_LambdaNode(self, node, scope):
+        inner = dict(scope)
+        _assigned_names(node.expr, inner)
+        if node.arg is None:
+            inner.update((param, ANY) for param in node.params)
+            self.visit(node.expr, inner)
+            return FUNCTION
+        args = [self.visit(arg, scope) for arg in node.arg]
+        # Extra arguments are ignored, missing ones read the globals of the same name
+        for index, param in enumerate(node.params):
+            inner[param] = args[index] if index < len(args) else ANY
+        return self.visit(node.expr, inner)
+
+    def visit_FunctionCallNode(self, node, scope):
+        where = self.where
+        if node.position is not None:
+            self.where = (node.position, where[1])
+        args = [self.visit(arg, scope) for arg in node.args]
+        try:
+            return self.call(node, args, scope)
+        finally:
+            self.where = where
+
+    def call(self, node, args, scope):
+        name = node.name
+        if name in scope:
+            # A lambda value held in a parameter or a local
+            if _known(scope[name]) and scope[name] != FUNCTION:
+                self.report(f"'{name}' is called but holds {_article(scope[name])}")
+            return ANY
+        func_def = self.functions.get(name)
+        if func_def is not None:
+            params = self.params[name]
+            if len(args) != len(params):
+                self.exact_calls.discard(name)
+                self.report(f"'{name}' takes {len(params)} arguments, got {len(args)}")
+            for index, arg in enumerate(args[:len(params)]):
+                params[index] = join(params[index], arg)
+            return self.returns[name]
+        if name in self.dynamic or name in self.assigned:
+            return ANY
+        if name in BUILTIN_TYPES:
+            return self.call_builtin(name, args)
+        self.report(f"'{name}' is not defined")
+        return ANY
+
+    def call_builtin(self, name, args):
+        param_types, required, result = BUILTIN_TYPES[name]
+        if not required <= len(args) <= len(param_types):
+            counts = ' or '.join(map(str, range(required, len(param_types) + 1)))
+            self.report(f"{name} takes {counts} arguments, got {len(args)}")
+            return result
+        for index, (arg, expected) in enumerate(zip(args, param_types)):
+            if _known(arg) and expected != ANY and arg != expected:
+                self.report(f"{name} expects {_article(expected)} as argument {index + 1}, got {arg}")
+        return result
+
+    def int_only(self):
+        """Names of the defuns that can run as Python code on ints."""
+        callees = {}
+        for name, func_def in self.functions.items():
+            params = {param.name for param in func_def.params}
+            called = set()
+            if (name in self.exact_calls and self.params[name] and all(t == INT for t in self.params[name])
+                    and self.returns[name] in (INT, BOOL) and _translatable(func_def.block, params, called)):
+                callees[name] = called
+
+        changed = True
+        while changed:
+            changed = False
+            for name in list(callees):
+                # Candidates calling anything else, or recursing through a tail call, stay interpreted
+                if not callees[name] <= callees.keys() or any(
+                        name in _reachable(callee, callees) for callee in _tail_calls(self.functions[name].block)):
+                    del callees[name]
+                    changed = True
+        return set(callees)
+
+
+def _assigned_names(node, scope):
+    """Mark the names assigned in `node` (outside nested lambdas and defuns) as locals of unknown type."""
+    if type(node) is Assign:
+        scope[node.variable.name] = ANY
+    if type(node) in (LambdaNode, FunctionDecNode):
+        return
+    for name in node.__slots__:
+        child = getattr(node, name)
+        for item in child if type(child) is tuple else (child,):
+            if isinstance(item, AST):
+                _assigned_names(item, scope)
+
+
+def _translatable(node, params, called):
+    """Whether sequences.translate can turn `node` into Python, given int parameters and int-only callees."""
+    if type(node) in (Num, Boolean):
+        return True
+    if type(node) is Var:
+        return node.name in params
+    if type(node) is BinOp:
+        return ((node.op in PYTHON_OPERATORS or node.op in PYTHON_FUNCTIONS)
+                and _translatable(node.left, params, called) and _translatable(node.right, params, called))
+    if type(node) is UnaryOp:
+        return node.op in PYTHON_UNARY and _translatable(node.expr, params, called)
+    if type(node) is IfNode:
+        return (node.else_block is not None and _translatable(node.condition, params, called)
+                and _translatable(node.block, params, called) and _translatable(node.else_block, params, called))
+    if type(node) is BlockNode:
+        return len(node.statements) == 1 and _translatable(node.statements[0], params, called)
+    if type(node) is ReturnNode:
+        return node.expr is not None and _translatable(node.expr, params, called)
+    if type(node) is FunctionCallNode:
+        if node.name in params:
+            return False
+        called.add(node.name)
+        return all(_translatable(arg, params, called) for arg in node.args)
+    return False
+
+
+def _tail_calls(node):
+    """Names called in tail position of a body, where the engines reuse the caller's frame."""
+    if type(node) is FunctionCallNode:
+        return {node.name}
+    if type(node) is BlockNode:
+        for statement in node.statements[:-1]:
+            if type(statement) is ReturnNode:
+                return _tail_calls(statement)
+        return _tail_calls(node.statements[-1]) if node.statements else set()
+    if type(node) is IfNode:
+        return _tail_calls(node.block) | (_tail_calls(node.else_block) if node.else_block is not None else set())
+    if type(node) is ReturnNode:
+        return _tail_calls(node.expr)
+    if type(node) is BinOp and node.op in ('AND', 'OR'):
+        return _tail_calls(node.right)
+    return set()
+
+
+def _reachable(name, callees):
+    reached = set()
+    pending = [name]
+    while pending:
+        current = pending.pop()
+        if current not in reached:
+            reached.add(current)
+            pending.extend(callees.get(current, ()))
+    return reached
+
+
+def check(statements):
+    """Infer the types of a whole program (parsed, not resolved); see TypeReport."""
+    return Inference(list(statements)).run()
+
+
+def specialize(statements, report=None):
+    """The statements with the top-level int-only defuns marked, for the engines' native calls."""
+    statements = list(statements)
+    if report is None:
+        report = check(statements)
+    return [FunctionDecNode(statement.name, statement.params, statement.block, statement.local_names,
+                            statement.position, True)
+            if type(statement) is FunctionDecNode and statement.name in report.int_only else statement
+            for statement in statements]
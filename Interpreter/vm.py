@@ -0,0 +1,339 @@
+from compiler import Compiler
+from parser import BlockNode
+import sys
+
+from Interpreter import MAX_DEPTH, PYTHON_FRAMES_PER_CALL
+from memo import MISSING
+from resolver import Resolver, UNSET
+from environment import Environment, Closure
+from control import Metered
+from native import NativeFunction, compiled, rerun
+from bytecode import (
+    Function, MAX_ARGS, MAX_SLOT, BINARY_FAST_CONST,
+    LOAD_CONST, LOAD_FAST, STORE_FAST, LOAD_GLOBAL, STORE_GLOBAL, POP_TOP, BINARY_ADD, BINARY_SUB,
+    BINARY_MUL, BINARY_DIV, BINARY_MOD, COMPARE_EQ, COMPARE_NE, COMPARE_GT, COMPARE_LT, COMPARE_GE,
+    COMPARE_LE, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, UNARY_NOT, UNARY_NEG, UNARY_POS, JUMP, JUMP_IF_FALSE,
+    MAKE_FUNCTION, DEFINE_FUNCTION, CALL_NAME, CALL_FAST, CALL_VALUE, RETURN_VALUE, PRINT_RESULT,
+)
+import errors
+
+
+class VirtualMachine(Metered):
+    """Stack machine executing the bytecode produced by compiler.Compiler.
+
+    Drop-in replacement for Interpreter: same constructor and interpret() behaviour.
+    Calls push a frame on an explicit frame list instead of recursing in Python,
+    and a call directly followed by RETURN_VALUE replaces the current frame.
+    """
+
+    def __init__(self, parser, max_depth=MAX_DEPTH, memo=None, env=None, max_steps=None, control=None):
+        self.parser = parser
+        self.max_depth = max_depth
+        self.memo = memo  # a memo.Memoizer, or None to evaluate every call
+        self.env = env if env is not None else Environment()
+        self.natives = {}  # int-only FunctionDecNode -> its Python translation, see native.py
+        self.depth = 0  # nested calls in progress in the run() calls below the innermost one, see call_value
+        self.init_budget(max_steps, control)
+
+    def interpret(self, tree=None):
+        resolver = Resolver(self.env.globals)
+        # Builtins calling back into run() nest Python calls; those are bounded by max_depth, as in Interpreter
+        limit = self.max_depth * PYTHON_FRAMES_PER_CALL + 1000
+        if sys.getrecursionlimit() < limit:
+            sys.setrecursionlimit(limit)
+        try:
+            if isinstance(tree, BlockNode):
+                return self.run(Compiler().compile_module(resolver.resolve(tree)))
+            # Statements produced lazily (a StatementStream, a FlatTree, the parser) are compiled and run one at a time
+            statements = tree.statements if tree is not None else self.parser.parse_statements()
+            result = None
+            for statement in statements:
+                result = self.run(Compiler().compile_module(BlockNode([resolver.visit(statement)])))
+            return result
+        except RecursionError:
+            self.depth = 0
+            raise errors.RuntimeError("Maximum nesting depth exceeded") from None
+
+    def call_value(self, value, args):
+        """Call a closure, or a builtin (see sequences.BUILTINS), from Python.
+
+        A closure runs in a nested run(), on top of the self.depth frames of the runs already in progress.
+        """
+        if type(value) is not Closure:
+            return value(self, args)
+        if self.depth >= self.max_depth:
+            raise errors.RuntimeError(f"Maximum recursion depth of {self.max_depth} exceeded in '<lambda>'")
+        func = value.function
+        # As CALL_VALUE lays out the frame
+        local_vars = (list(args) + [UNSET] * len(func.params))[:len(func.params)]
+        local_vars += value.captured
+        local_vars += func.padding
+        if self.fuel is not None:
+            try:
+                self.charge(1)
+            except errors.RuntimeError as error:
+                # Charged in the callee, as Interpreter charges it
+                error.leave(func.name)
+                raise
+        return self.run(func.code, local_vars)
+
+    def load_global(self, name, position):
+        """The global `name`, read by BINARY_FAST_CONST for a local still unset; a failure is reported at `position`."""
+        try:
+            return self.env.globals.lookup(name)
+        except errors.RuntimeError as error:
+            error.locate(position)
+            raise
+
+    def unwind(self, error, code_obj, pc, frames):
+        """Add the failing instruction and the calls in progress in this run() to `error`'s trace."""
+        error.locate(code_obj.position_at(pc - 2))
+        error.leave(code_obj.name)
+        for caller, return_pc, local_vars, memo_entry in reversed(frames):
+            error.locate(caller.position_at(return_pc - 2))
+            error.leave(caller.name)
+
+    def run(self, code_obj, local_vars=None):
+        """Run a code object until it returns, with `local_vars` as its frame (None at module level)."""
+        env = self.env
+        functions = env.functions
+        max_depth = self.max_depth
+        memo = self.memo
+        metered = self.fuel is not None  # a budget or a Control stays attached for the whole run
+        global_table = env.globals
+        global_values = global_table.values
+        code = code_obj.code
+        consts = code_obj.consts
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        frames = []
+        pc = 0
+        # Nested calls are counted across the runs in progress; a closure's run starts inside its own call
+        outer = self.depth
+        max_frames = max_depth - outer - (local_vars is not None)
+
+        try:
+            while True:
+                op = code[pc]
+                arg = code[pc + 1]
+                pc += 2
+                if metered and (BINARY_ADD <= op <= UNARY_POS or op == BINARY_FAST_CONST):
+                    # A step per operator, once its operands are computed, as Interpreter charges it
+                    self.charge(1)
+
+                # Opcodes are tested roughly in order of how often they run
+                if op == LOAD_FAST:
+                    value = local_vars[arg]
+                    if value is UNSET:
+                        value = global_table.lookup(code_obj.varnames[arg])
+                    push(value)
+                elif op == BINARY_FAST_CONST:
+                    value = local_vars[arg & MAX_SLOT]
+                    handler, right, position = consts[arg >> 16]
+                    if value is UNSET:
+                        value = self.load_global(code_obj.varnames[arg & MAX_SLOT], position)
+                    if code[pc] == JUMP_IF_FALSE:
+                        # An `if` condition: the jump is taken right away
+                        pc = pc + 2 if handler(value, right) else code[pc + 1]
+                    else:
+                        push(handler(value, right))
+                elif op == LOAD_CONST:
+                    push(consts[arg])
+                elif op == JUMP_IF_FALSE:
+                    if not pop():
+                        pc = arg
+                elif CALL_NAME <= op <= CALL_VALUE:
+                    if op == CALL_NAME:
+                        argc = arg & MAX_ARGS
+                        func = functions.get(code_obj.names[arg >> 8])
+                        if func is None:
+                            # A global variable holding a lambda, or a builtin
+                            func = env.callee(code_obj.names[arg >> 8])
+                    elif op == CALL_FAST:
+                        argc = arg & MAX_ARGS
+                        func = local_vars[arg >> 8]
+                        if type(func) is not Closure:
+                            # Not a lambda value, so the name refers to a defun
+                            func = functions.get(code_obj.varnames[arg >> 8])
+                            if func is None:
+                                func = env.callee(code_obj.varnames[arg >> 8])
+                    else:
+                        argc = arg
+                        func = stack[-argc - 1]
+                        if type(func) is not Closure:
+                            raise errors.RuntimeError(f"'{func}' is not callable.")
+                    if argc:
+                        args = stack[-argc:]
+                        del stack[-argc:]
+                    else:
+                        args = []
+                    if op == CALL_VALUE:
+                        pop()
+                    if type(func) is Function:
+                        captured = None
+                    elif type(func) is Closure:
+                        captured = func.captured
+                        func = func.function
+                    else:
+                        if type(func) is not NativeFunction:
+                            # A builtin, which may call closures in a nested run() through call_value
+                            self.depth = max_depth - max_frames + len(frames)
+                            push(func(self, args))
+                            self.depth = outer
+                            continue
+                        native = compiled(self, func.node, argc, max_frames - len(frames))
+                        if native is not None:
+                            try:
+                                push(native(*args))
+                            except errors.RuntimeError:
+                                # Interpreted in a nested run, the call raises the error with its position
+                                self.depth = max_depth - max_frames + len(frames)
+                                push(rerun(self, self.run, func.function.code, args + func.function.padding))
+                                self.depth = outer
+                            continue
+                        # Counted, memoized or with missing or extra arguments, the call runs the bytecode
+                        func = func.function
+                        captured = None
+                    params = func.params
+                    memo_entry = None
+                    if memo is not None and argc == len(params) and all(type(arg) is int for arg in args):
+                        table = memo.table_for(func.name, functions)
+                        if table is not None:
+                            key = tuple(args)
+                            result = table.get(key)
+                            if result is not MISSING:
+                                push(result)
+                                continue
+                            memo_entry = (table, key)
+                    if argc != len(params):
+                        # Extra arguments are ignored, missing ones stay unset
+                        args = (args + [UNSET] * len(params))[:len(params)]
+                    if code[pc] != RETURN_VALUE:
+                        if len(frames) >= max_frames:
+                            raise errors.RuntimeError(
+                                f"Maximum recursion depth of {max_depth} exceeded in '{func.name}'")
+                        # The memo entry is filled in when this frame's callee returns
+                        frames.append((code_obj, pc, local_vars, memo_entry))
+                    if captured:
+                        args += captured
+                    padding = func.padding
+                    local_vars = args + padding if padding else args
+                    code_obj = func.code
+                    code = code_obj.code
+                    consts = code_obj.consts
+                    pc = 0
+                    if metered:
+                        # Charged in the callee, before its first instruction, as Interpreter charges it; a
+                        # call that hit the memo or the depth limit costs nothing
+                        self.charge(1)
+                elif op == RETURN_VALUE:
+                    if not frames:
+                        return pop()
+                    code_obj, pc, local_vars, memo_entry = frames.pop()
+                    code = code_obj.code
+                    consts = code_obj.consts
+                    if memo_entry is not None:
+                        memo_entry[0].put(memo_entry[1], stack[-1])
+                elif op == BINARY_SUB:
+                    right = pop()
+                    stack[-1] = stack[-1] - right
+                elif op == BINARY_ADD:
+                    right = pop()
+                    stack[-1] = stack[-1] + right
+                elif op == BINARY_MUL:
+                    right = pop()
+                    stack[-1] = stack[-1] * right
+                elif op == COMPARE_LE:
+                    right = pop()
+                    stack[-1] = stack[-1] <= right
+                elif op == COMPARE_LT:
+                    right = pop()
+                    stack[-1] = stack[-1] < right
+                elif op == COMPARE_EQ:
+                    right = pop()
+                    stack[-1] = stack[-1] == right
+                elif op == COMPARE_NE:
+                    right = pop()
+                    stack[-1] = stack[-1] != right
+                elif op == COMPARE_GT:
+                    right = pop()
+                    stack[-1] = stack[-1] > right
+                elif op == COMPARE_GE:
+                    right = pop()
+                    stack[-1] = stack[-1] >= right
+                elif op == BINARY_DIV:
+                    right = pop()
+                    if right == 0:
+                        raise errors.RuntimeError("Division by zero error")
+                    stack[-1] = stack[-1] // right
+                elif op == JUMP:
+                    pc = arg
+                elif op == JUMP_IF_FALSE_OR_POP:
+                    if stack[-1]:
+                        pop()
+                    else:
+                        pc = arg
+                elif op == JUMP_IF_TRUE_OR_POP:
+                    if stack[-1]:
+                        pc = arg
+                    else:
+                        pop()
+                elif op == BINARY_MOD:
+                    right = pop()
+                    if right == 0:
+                        raise errors.RuntimeError("Modulo by zero error")
+                    stack[-1] = stack[-1] % right
+                elif op == UNARY_NOT:
+                    stack[-1] = not stack[-1]
+                elif op == UNARY_NEG:
+                    stack[-1] = -stack[-1]
+                elif op == UNARY_POS:
+                    stack[-1] = +stack[-1]
+                elif op == POP_TOP:
+                    pop()
+                elif op == LOAD_GLOBAL:
+                    value = global_values[arg]
+                    if value is UNSET:
+                        value = global_table.load(arg)
+                    push(value)
+                elif op == STORE_FAST:
+                    local_vars[arg] = pop()
+                    push(None)
+                elif op == STORE_GLOBAL:
+                    if global_table.shared:
+                        global_table.own()
+                        global_values = global_table.values
+                    global_values[arg] = pop()
+                    push(None)
+                elif op == MAKE_FUNCTION:
+                    func = consts[arg]
+                    push(Closure(func, tuple([local_vars[slot] for slot in func.captures]) if func.captures else ()))
+                elif op == DEFINE_FUNCTION:
+                    func = consts[arg]
+                    env.define(func.name, NativeFunction(func) if func.node.int_only else func)
+                    functions = env.functions
+                    self.natives.clear()
+                    if memo is not None:
+                        memo.invalidate(func.name)
+                    push(None)
+                elif op == PRINT_RESULT:
+                    result = stack[-1]
+                    # Function values print nothing, as in Interpreter
+                    if type(result) is Closure:
+                        stack[-1] = None
+                    elif result is not None:
+                        print(result)
+                else:
+                    raise Exception(f"Unknown opcode {op}")
+        except errors.RuntimeError as error:
+            self.depth = outer
+            self.unwind(error, code_obj, pc, frames)
+            raise
+        except errors.PYTHON_ERRORS as python_error:
+            # An operator applied to values it does not take
+            self.depth = outer
+            error = errors.RuntimeError(str(python_error))
+            self.unwind(error, code_obj, pc, frames)
+            raise error from None
+
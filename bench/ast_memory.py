@@ -0,0 +1,97 @@
+"""Bytes per AST node for a large generated program.
+
+Measures the memory retained by the object tree Parser.parse returns and by
+the same tree encoded as a flattree.FlatTree:
+
+    python bench/ast_memory.py [--functions N]
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Interpreter'))
+
+from lexer import Lexer
+from parser import Parser
+
+
+def generate_program(functions, seed=0):
+    """Source of `functions` defuns with arithmetic, branches, calls and lambdas, plus a call to each."""
+    rng = random.Random(seed)
+    ops = ['+', '-', '*', '/', '==', '<', '>=', '&&']
+
+    def expr(depth, names):
+        if depth == 0 or rng.random() < 0.3:
+            return rng.choice(names) if rng.random() < 0.6 else str(rng.randint(0, 1000))
+        return f'({expr(depth - 1, names)} {rng.choice(ops)} {expr(depth - 1, names)})'
+
+    lines = []
+    for index in range(functions):
+        names = ['a', 'b', 'c']
+        lines.append(f'defun f{index}(a, b, c) {{')
+        lines.append(f'    t = {expr(3, names)}')
+        lines.append(f'    if ({expr(2, names + ["t"])}) {{ return {expr(3, names + ["t"])} }}'
+                     f' else {{ return f{max(index - 1, 0)}(t, {expr(2, names)}, c) }}')
+        lines.append(f'    lambda x: x * {expr(2, names)}({expr(1, names)})')
+        lines.append('}')
+    for index in range(functions):
+        lines.append(f'f{index}({index}, {index + 1}, {index + 2})')
+    return '\n'.join(lines) + '\n'
+
+
+def count_nodes(node):
+    """AST nodes under `node`; plain ints count as (literal) nodes."""
+    if isinstance(node, (list, tuple)):
+        return sum(count_nodes(child) for child in node)
+    if type(node) is int:
+        return 1
+    if node is None or isinstance(node, (str, bool)) or not hasattr(node, '__module__'):
+        return 0
+    if type(node).__module__ != 'parser':
+        return 0
+    if type(node).__name__ == 'Num':
+        return 1
+    fields = getattr(type(node), '__slots__', None)
+    values = [getattr(node, name) for name in fields] if fields is not None else vars(node).values()
+    return 1 + sum(count_nodes(value) for value in values)
+
+
+def retained(build):
+    """Bytes still allocated after `build()` returns, and what it returned."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--functions', type=int, default=5000, help='number of generated defuns')
+    args = arg_parser.parse_args()
+
+    code = generate_program(args.functions)
+    tokens = Lexer(code).tokenize()
+    tree_bytes, tree = retained(lambda: Parser(tokens).parse())
+    nodes = count_nodes(tree)
+    sys.setrecursionlimit(10000)
+    print(f'source:       {len(code):>12,} bytes, {nodes:,} nodes')
+    print(f'object tree:  {tree_bytes:>12,} bytes  {tree_bytes / nodes:7.1f} bytes/node')
+
+    try:
+        from flattree import FlatTree
+    except ImportError:
+        return
+    flat_bytes, flat = retained(lambda: FlatTree.from_tree(tree))
+    print(f'flat tree:    {flat_bytes:>12,} bytes  {flat_bytes / nodes:7.1f} bytes/node')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Throughput and peak RSS of the three ways main.py can read a large program.
+
+    string  read the file into a str, tokenize it, parse (the default path, with --no-cache)
+    stream  lex lines as the file object reads them, parse statement by statement (--stream)
+    mmap    lex the memory-mapped bytes in place, parse statement by statement (--mmap)
+
+Each mode runs in a fresh process, so peak RSS is its own:
+
+    python bench/source_input.py [--megabytes N] [--file PROGRAM.lambda]
+"""
+
+import argparse
+import json
+import mmap
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'Interpreter'))
+sys.path.insert(0, HERE)
+
+MODES = ('string', 'stream', 'mmap')
+
+
+def parse(mode, file_path):
+    """Lex and parse `file_path`, discarding statements as they come; returns the statement count."""
+    from lexer import Lexer
+    from parser import Parser
+
+    if mode == 'string':
+        with open(file_path, 'r') as file:
+            code = file.read()
+        return sum(1 for _ in Parser(Lexer(code)).parse_statements())
+    if mode == 'stream':
+        with open(file_path, 'r') as file:
+            return sum(1 for _ in Parser(Lexer('').scan_file(file)).parse_statements())
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+        return sum(1 for _ in Parser(Lexer('').scan_buffer(source)).parse_statements())
+
+
+def child(mode, file_path):
+    start = time.perf_counter()
+    statements = parse(mode, file_path)
+    seconds = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+    print(json.dumps({'statements': statements, 'seconds': seconds, 'max_rss': rss}))
+
+
+def write_program(path, megabytes):
+    from ast_memory import generate_program
+    chunk = generate_program(500)
+    with open(path, 'w') as file:
+        for _ in range(max(1, megabytes * 1024 * 1024 // len(chunk))):
+            file.write(chunk)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--megabytes', type=int, default=20, help='size of the generated program')
+    arg_parser.add_argument('--file', help='measure this program instead of a generated one')
+    arg_parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.child:
+        child(args.child, args.file)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = args.file
+        if file_path is None:
+            file_path = os.path.join(tmp, 'program.lambda')
+            write_program(file_path, args.megabytes)
+        size = os.path.getsize(file_path)
+        print(f'{file_path}: {size / 2 ** 20:.1f} MB')
+        for mode in MODES:
+            output = subprocess.run([sys.executable, __file__, '--child', mode, '--file', file_path],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output)
+            print(f'{mode:<8} {result["seconds"]:7.2f} s  {size / 2 ** 20 / result["seconds"]:6.2f} MB/s'
+                  f'  peak RSS {result["max_rss"] / 2 ** 20:8.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Benchmark suite timing the lexer, the parser and both engines on representative workloads.
+
+    python bench/suite.py                    compare against bench/baseline.json
+    python bench/suite.py --save             record a new baseline
+    python bench/suite.py --only arithmetic --stages interpret vm
+
+Workloads are the .lambda files in bench/workloads plus a large generated
+program (see ast_memory.generate_program), which is only lexed and parsed.
+Each stage of each workload is measured on its own:
+
+    lex        Lexer(source).tokenize()           items: tokens
+    parse      Parser(tokens).parse()             items: AST nodes
+    interpret  Interpreter(None).interpret(tree)  items: runs
+    vm         VirtualMachine(None).interpret(tree)
+
+Every stage runs in a fresh process. Its time is the best of --repeat runs and
+its peak memory is how far those runs raised the process's maximum resident
+set above what the prepared input already took. A stage regresses when its
+time or peak memory is more than --threshold (a fraction) above the baseline,
+and by more than a small absolute slack, so that sub-millisecond stages and
+allocator noise do not fail the run; the exit status is then 1. Baselines are
+only comparable on the machine they were recorded on.
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'Interpreter'))
+sys.path.insert(0, HERE)
+
+from lexer import Lexer
+from parser import Parser
+from optimizer import count_nodes
+from Interpreter import Interpreter
+from vm import VirtualMachine
+from ast_memory import generate_program
+
+WORKLOAD_DIR = os.path.join(HERE, 'workloads')
+BASELINE = os.path.join(HERE, 'baseline.json')
+STAGES = ('lex', 'parse', 'interpret', 'vm')
+GENERATED = 'generated'
+GENERATED_FUNCTIONS = 3000
+# Differences below these never count as regressions
+TIME_SLACK = 0.005
+MEMORY_SLACK = 2 ** 20
+
+
+def load_workloads():
+    """{name: (source, stages)} for every workload, in name order."""
+    workloads = {}
+    for name in sorted(os.listdir(WORKLOAD_DIR)):
+        if name.endswith('.lambda'):
+            with open(os.path.join(WORKLOAD_DIR, name), 'r') as file:
+                workloads[name[:-len('.lambda')]] = (file.read(), STAGES)
+    # Big enough to dominate lexing and parsing; its calls are not meant to run
+    workloads[GENERATED] = (generate_program(GENERATED_FUNCTIONS), ('lex', 'parse'))
+    return workloads
+
+
+def stage_runner(stage, source):
+    """A function running `stage` once on `source`, and one counting the items in what it returned."""
+    if stage == 'lex':
+        return (lambda: Lexer(source).tokenize()), len
+    tokens = Lexer(source).tokenize()
+    if stage == 'parse':
+        return (lambda: Parser(list(tokens)).parse()), count_nodes
+    tree = Parser(tokens).parse()
+    engine = Interpreter if stage == 'interpret' else VirtualMachine
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine(None).interpret(tree)
+    return run, lambda result: 1
+
+
+def measure(stage, source, repeat):
+    """(best seconds, items, peak bytes) of `repeat` runs of `stage`, measured in a fresh process."""
+    context = multiprocessing.get_context()
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=measure_in_child, args=(child_conn, stage, source, repeat))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        raise RuntimeError(f'{stage} stage exited with code {process.exitcode}') from None
+    finally:
+        process.join()
+    if isinstance(result, str):
+        raise RuntimeError(f'{stage} stage failed: {result}')
+    return result
+
+
+def measure_in_child(conn, stage, source, repeat):
+    # tracemalloc slows deep Python recursion down quadratically, so peak memory
+    # is the growth of the process's maximum resident set instead
+    try:
+        run, count = stage_runner(stage, source)
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        best = result = None
+        for _ in range(repeat):
+            result = None
+            start = time.perf_counter()
+            result = run()
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+        items = count(result)
+        conn.send((best, items, peak))
+    except Exception as error:
+        conn.send(f'{type(error).__name__}: {error}')
+
+
+def run_suite(only=None, stages=STAGES, repeat=3, report=sys.stdout):
+    """{workload: {stage: {'seconds', 'items_per_sec', 'peak_bytes'}}} for the selected workloads and stages."""
+    results = {}
+    for name, (source, workload_stages) in load_workloads().items():
+        if only and name not in only:
+            continue
+        for stage in workload_stages:
+            if stage not in stages:
+                continue
+            seconds, items, peak = measure(stage, source, repeat)
+            results.setdefault(name, {})[stage] = {
+                'seconds': round(seconds, 6),
+                'items_per_sec': round(items / seconds, 1),
+                'peak_bytes': peak,
+            }
+            print(f'{name:<16} {stage:<10} {seconds:9.4f} s {items / seconds:14.1f} items/s '
+                  f'{peak / 2 ** 20:9.2f} MB peak', file=report)
+    return results
+
+
+def compare(results, baseline, threshold, report=sys.stdout):
+    """Print each stage's change from `baseline`; return the (workload, stage, metric) that regressed."""
+    regressions = []
+    for name, stages in results.items():
+        for stage, current in stages.items():
+            previous = baseline.get(name, {}).get(stage)
+            if previous is None:
+                print(f'{name:<16} {stage:<10} not in the baseline', file=report)
+                continue
+            changes = []
+            for metric, slack in (('seconds', TIME_SLACK), ('peak_bytes', MEMORY_SLACK)):
+                ratio = current[metric] / previous[metric] if previous[metric] else 1.0
+                changes.append(f'{metric} {ratio - 1:+7.1%}')
+                if ratio > 1 + threshold and current[metric] - previous[metric] > slack:
+                    regressions.append((name, stage, metric))
+            flag = '  REGRESSION' if any(r[:2] == (name, stage) for r in regressions) else ''
+            print(f'{name:<16} {stage:<10} ' + '  '.join(changes) + flag, file=report)
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--only', nargs='+', metavar='WORKLOAD', help='run only these workloads')
+    arg_parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    arg_parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best one counts')
+    arg_parser.add_argument('--baseline', default=BASELINE, help='baseline JSON file')
+    arg_parser.add_argument('--threshold', type=float, default=0.25,
+                            help='allowed slowdown or memory growth as a fraction, default 0.25')
+    arg_parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    args = arg_parser.parse_args()
+
+    results = run_suite(args.only, args.stages, args.repeat)
+    if args.save:
+        # Notes on the figures, written by hand, carry over to the new baseline
+        notes = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as file:
+                notes = json.load(file).get('notes', {})
+        with open(args.baseline, 'w') as file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results,
+                       'notes': notes}, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f'baseline written to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline}; run with --save to record one')
+        return
+    with open(args.baseline, 'r') as file:
+        baseline = json.load(file)['results']
+    print()
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f'{len(regressions)} regression(s) above {args.threshold:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The interpreter's modules import each other by their bare names, as main.py runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Interpreter'))
@@ -0,0 +1,29 @@
+"""--check reports the errors of a file, however its parse ends."""
+
+import check
+import errors
+
+
+def messages(source):
+    tree, diagnostics = check.check_source(source)
+    return tree, [str(error) for error in diagnostics]
+
+
+def test_every_syntax_error_is_reported():
+    tree, found = messages("x = 1 +\ny = $\nz = 3\n")
+    assert found == ['line 2, column 3: Unexpected token EQUAL in factor.',
+                     "line 2, column 5: Unexpected character '$'"]
+
+
+def test_deep_nesting_ends_the_check():
+    tree, found = messages("x = )\n" + "(" * 100000 + "1" + ")" * 100000 + "\n")
+    assert tree is None
+    assert found == ['line 1, column 5: Unexpected token RPAREN in factor.',
+                     'line 2, column 1: Nesting too deep to parse']
+
+
+def test_line_past_the_position_limits_ends_the_check():
+    tree, found = messages("x = 1\n" + "y" * (errors.MAX_COLUMN + 2) + "\n")
+    assert tree is None
+    assert found == ['line 2, column 1: Line 2 is too long or too far, '
+                     f'the limits are {errors.MAX_COLUMN} columns and {errors.MAX_LINE} lines']
@@ -0,0 +1,131 @@
+"""The tree walker and the VM agree on every program, and on the failures fixed in either."""
+
+import contextlib
+import io
+import os
+
+import pytest
+
+from lexer import Lexer
+from parser import Parser, BlockNode
+from Interpreter import Interpreter
+from vm import VirtualMachine
+from optimizer import Optimizer
+import errors
+import memo
+import typecheck
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PROGRAMS = [
+    os.path.join(ROOT, 'Interpreter', 'program_test.lambda'),
+    os.path.join(ROOT, 'Interpreter', 'test.lambda'),
+    os.path.join(ROOT, 'bench', 'workloads', 'deep_recursion.lambda'),
+    os.path.join(ROOT, 'bench', 'workloads', 'lambdas.lambda'),
+]
+ENGINES = [Interpreter, VirtualMachine]
+
+
+def run(source, engine, optimize=False, memoize=False, path='<test>', **options):
+    """(what `source` printed, its error with the trace as main.py shows it or None, steps taken) on `engine`.
+
+    `optimize` runs the optimizer and the native translation of int-only functions, as -O does.
+    """
+    statements = Parser(Lexer(source, path)).parse_statements()
+    if optimize:
+        statements = typecheck.specialize(map(Optimizer().optimize, statements))
+    interpreter = engine(None, memo=memo.Memoizer() if memoize else None, **options)
+    output = io.StringIO()
+    failure = None
+    try:
+        with contextlib.redirect_stdout(output):
+            interpreter.interpret(BlockNode(list(statements)))
+    except errors.RuntimeError as error:
+        failure = '\n'.join(error.format_trace() + [str(error)])
+    return output.getvalue(), failure, interpreter.steps_taken
+
+
+def run_both(source, **options):
+    """The results of both engines, checked to be the same."""
+    results = [run(source, engine, **options) for engine in ENGINES]
+    assert results[0] == results[1]
+    return results[0]
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'optimize': True},
+    {'memoize': True},
+    {'max_steps': 10 ** 9},
+    {'max_steps': 50},
+    {'max_depth': 20},
+], ids=['plain', 'optimize', 'memo', 'steps', 'step-limit', 'depth-limit'])
+@pytest.mark.parametrize('path', PROGRAMS, ids=os.path.basename)
+def test_engines_agree_on_sample_programs(path, options):
+    output, failure, steps = run_both(read(path), path=path, **options)
+    if not options:
+        assert output and failure is None
+
+
+def test_bare_return_is_none():
+    source = (
+        "defun f(n) { if (n > 0) { return } else { n } }\n"
+        "f(1)\n"
+        "!f(1)\n"
+    )
+    assert run_both(source)[:2] == ('True\n', None)
+
+
+def test_right_side_of_and_or_is_a_tail_call():
+    source = (
+        "defun even(n) { (n == 0) || odd(n - 1) }\n"
+        "defun odd(n) { (n != 0) && even(n - 1) }\n"
+        "even(3000)\n"
+        "odd(3001)\n"
+    )
+    assert run_both(source, max_depth=100)[:2] == ('True\nTrue\n', None)
+
+
+def test_closure_call_in_tail_position_reuses_the_frame():
+    source = (
+        "defun count(n) {\n"
+        "    step = lambda k: count(k)\n"
+        "    if (n == 0) { 0 } else { step(n - 1) }\n"
+        "}\n"
+        "count(3000)\n"
+    )
+    assert run_both(source, max_depth=100)[:2] == ('0\n', None)
+
+
+@pytest.mark.parametrize('options', [{}, {'max_steps': 10 ** 9}], ids=['plain', 'steps'])
+def test_depth_limit_holds_through_sequence_callbacks(options):
+    source = (
+        "defun r(n) { if (n == 0) { 0 } else { 1 + sum(map(lambda x: r(n - 1), range(1))) } }\n"
+        "r(50)\n"
+        "r(1000)\n"
+    )
+    output, failure, steps = run_both(source, max_depth=200, **options)
+    assert output == '50\n'
+    assert failure.endswith("Maximum recursion depth of 200 exceeded in '<lambda>'")
+
+
+def test_native_errors_keep_their_position_and_trace():
+    source = (
+        "defun down(n) { if (n == 0) { 1 / n } else { 1 + down(n - 1) } }\n"
+        "down(3)\n"
+    )
+    interpreted = run_both(source)
+    assert run_both(source, optimize=True) == interpreted
+    assert interpreted[1].endswith("<test>:1:50, in 'down'\n  [previous line repeated 2 more times]\n"
+                                   "  <test>:1:33, in 'down'\n<test>:1:33: Division by zero error")
+
+
+def test_operators_are_charged_without_calls():
+    source = "x = 1 + 2 * 3 - 4\n" * 10
+    assert run_both(source, max_steps=10 ** 9)[2] == 30
+    output, failure, steps = run_both(source, max_steps=20)
+    assert failure.endswith('Step limit of 20 exceeded')
@@ -0,0 +1,92 @@
+"""Requests the server refuses, and programs it runs on a real worker."""
+
+import argparse
+import asyncio
+import base64
+import os
+import pickle
+
+import pytest
+
+from lexer import Lexer
+from parser import Parser
+from main import add_engine_arguments
+import errors
+import server
+
+
+def options(*args):
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--prelude')
+    add_engine_arguments(arg_parser)
+    return arg_parser.parse_args(list(args))
+
+
+def module(source, path):
+    return base64.b64encode(pickle.dumps(Parser(Lexer(source, path)).parse())).decode()
+
+
+@pytest.mark.parametrize('request_fields', [
+    {'source': 1},
+    {'module': ['x']},
+    {'timeout': -1},
+    {'timeout': '2'},
+    {'max_steps': 1.5},
+    {'max_steps': True},
+    {'max_depth': -5},
+])
+def test_requests_with_fields_of_the_wrong_type_are_refused(request_fields):
+    with pytest.raises(ValueError):
+        server.Server(options(), 1).submit(dict({'source': '1'}, **request_fields), None)
+
+
+def test_requests_only_lower_the_server_limits():
+    limits = server.Server(options(), 1)
+    assert limits.limit({'max_steps': 10}, 'max_steps', 100) == 10
+    assert limits.limit({'max_steps': 1000}, 'max_steps', 100) == 100
+    assert limits.limit({}, 'max_steps', None) is None
+    assert limits.limit({'timeout': 0.5}, 'timeout', None, (int, float)) == 0.5
+
+
+def test_a_module_may_only_hold_parse_tree_nodes():
+    assert server.load_module(module('1 + 2', None)).statements
+    with pytest.raises(pickle.UnpicklingError):
+        server.load_module(base64.b64encode(pickle.dumps(os.getcwd)).decode())
+    with pytest.raises(pickle.UnpicklingError):
+        server.load_module(base64.b64encode(pickle.dumps([1, 2])).decode())
+
+
+def test_unknown_file_ids_are_described():
+    assert errors.describe(errors.pack(10 ** 6, 3, 5)) == '<unknown>:3:5'
+
+
+def test_worker_runs_programs_and_survives_a_failed_client():
+    async def serve():
+        pool = server.Server(options(), 1)
+        await pool.start()
+        try:
+            lines = []
+
+            async def keep(message):
+                lines.append(message['output'])
+
+            async def hang_up(message):
+                raise ConnectionError('client gone')
+
+            ran = await pool.submit({'source': 'defun f(n) { n * 2 }\nf(21)'}, keep).done
+            # Ids given out by another process name no file here
+            failed = await pool.submit({'module': module('1 / 0', 'elsewhere.lambda')}, keep).done
+            lost = await pool.submit({'source': '1\n2'}, hang_up).done
+            after = await pool.submit({'source': '6 * 7', 'max_steps': 0}, keep).done
+            return lines, ran, failed, lost, after, pool.restarts
+        finally:
+            await pool.close()
+
+    lines, ran, failed, lost, after, restarts = asyncio.run(serve())
+    assert lines == ['42']
+    assert ran['status'] == 'ok'
+    assert failed['status'] == 'error' and failed['error'].startswith('<unknown>:1:')
+    # The worker that was sending to the lost client is replaced, not left to answer the next job
+    assert lost['status'] == 'crashed' and lost['error'] == 'client gone'
+    assert after['status'] == 'step_limit'
+    assert restarts == 1